@@ -1,4 +1,4 @@
-from flask import Flask, request, session
+from flask import Flask, abort, request, session
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_migrate import Migrate
@@ -6,7 +6,12 @@ from flask_caching import Cache
 from flask_recaptcha import ReCaptcha
 from flask_babel import Babel, lazy_gettext as _l
 from markupsafe import Markup
+from app.music_engine.render_pool import RenderPool
+from app.jobs import JobRunner
+from app.admission import AdmissionControl
+from app.music_engine.storage import content_addressed, digest_named
 from config import config
+from werkzeug.security import safe_join
 import os
 
 # 初始化擴展
@@ -16,6 +21,9 @@ migrate = Migrate()
 cache = Cache()
 recaptcha = ReCaptcha()
 babel = Babel()
+render_pool = RenderPool()
+job_runner = JobRunner()
+admission = AdmissionControl()
 
 # Monkey patch Flask-ReCAPTCHA
 import flask_recaptcha
@@ -38,6 +46,9 @@ def create_app(config_name='default'):
     migrate.init_app(app, db)
     cache.init_app(app)
     recaptcha.init_app(app)
+    render_pool.init_app(app)
+    job_runner.init_app(app)
+    admission.init_app(app)
     
     # 设置语言本地化
     def get_locale():
@@ -67,10 +78,34 @@ def create_app(config_name='default'):
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
     
+    # 註冊命令行工具
+    from app import cli
+    cli.register(app)
+    
     # 創建數據庫表
     with app.app_context():
         db.create_all()
     
+    # 生成文件带内容摘要的强 ETag，支持断点续传与条件请求；其中文件名就是内容摘要的（MIDI）
+    # 路径随内容改变，允许浏览器长期缓存，按渲染输入寻址的音频等可能重新渲染，每次重新验证
+    def static_file(filename):
+        if not content_addressed(filename):
+            return app.send_static_file(filename)
+        from app.main.routes import send_artifact
+
+        path = safe_join(app.static_folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = send_artifact(path)
+        if digest_named(path, response.get_etag()[0]):
+            response.cache_control.private = None
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config.get('IMMUTABLE_MAX_AGE', 365 * 24 * 3600)
+            response.cache_control.immutable = True
+        return response
+    app.view_functions['static'] = static_file
+    
     # 将LANGUAGE_NAMES添加到模板全局变量
     @app.context_processor
     def inject_language_names():
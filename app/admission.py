@@ -0,0 +1,142 @@
+import logging
+import math
+import time
+from typing import Dict, Optional
+
+from sqlalchemy import case, func, select, update
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRefused(Exception):
+    """請求超出準入限制：status 為 429（用戶自身的限制）或 503（角色共用的容量已滿）"""
+
+    def __init__(self, status: int, message: str, retry_after: int):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class AdmissionControl:
+    """按用戶角色限制生成消耗，權重為任務的估計成本（標準渲染秒數，見 Scheduler.estimate_cost）
+
+    每個角色可配置兩類限制（見 ADMISSION_LIMITS / ADMISSION_ROLE_LIMITS）：
+      - 令牌桶 rate / burst：令牌按每秒 rate 秒補充，最多 burst 秒，每次請求取走其成本
+      - 並發上限 concurrent_jobs / concurrent_seconds：排隊和執行中的任務數與總成本
+    ADMISSION_LIMITS 對每個用戶單獨計算，超出返回 429；ADMISSION_ROLE_LIMITS 由同一角色的
+    所有用戶共用，超出返回 503。未配置的角色（例如 admin）不受限制。
+
+    令牌桶保存在數據庫中，多個 Web 進程共用；並發數按 GenerationJob 統計，
+    與任務登記不在同一事務中，同時到達的請求可能略微超出上限。
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.user_limits: Dict[str, Dict] = {}
+        self.role_limits: Dict[str, Dict] = {}
+        self.busy_retry_after = 15
+
+    def init_app(self, app):
+        self.enabled = app.config.get('ADMISSION_CONTROL', self.enabled)
+        self.user_limits = app.config.get('ADMISSION_LIMITS', self.user_limits)
+        self.role_limits = app.config.get('ADMISSION_ROLE_LIMITS', self.role_limits)
+        self.busy_retry_after = app.config.get('ADMISSION_BUSY_RETRY_AFTER', self.busy_retry_after)
+        app.extensions['admission'] = self
+
+    def admit(self, user, seconds: float):
+        """檢查 user 能否提交成本為 seconds 的生成請求，通過時扣除令牌，否則拋出 AdmissionRefused"""
+        if not self.enabled:
+            return
+        from flask_babel import _
+        from app import db
+
+        role = user.role or 'user'
+        user_limits = self.user_limits.get(role)
+        role_limits = self.role_limits.get(role)
+
+        if user_limits and self._over_concurrency(user_limits, seconds, user_id=user.id):
+            raise AdmissionRefused(429, _('Too many generations in progress, please wait for them to finish'),
+                                   self.busy_retry_after)
+        if role_limits and self._over_concurrency(role_limits, seconds, role=role):
+            raise AdmissionRefused(503, _('The server is busy, please try again later'), self.busy_retry_after)
+
+        buckets = []
+        if user_limits and user_limits.get('rate'):
+            buckets.append((f'user:{user.id}', user_limits, 429))
+        if role_limits and role_limits.get('rate'):
+            buckets.append((f'role:{role}', role_limits, 503))
+        if not buckets:
+            return
+
+        now = time.time()
+        for key, limits, _status in buckets:
+            self._ensure_bucket(key, limits['burst'], now)
+        # 所有令牌桶在同一事務中扣除，任何一個不足時全部回滾
+        for key, limits, status in buckets:
+            wait = self._take(key, limits['rate'], limits['burst'], seconds, now)
+            if wait is not None:
+                db.session.rollback()
+                if status == 429:
+                    message = _('Generation rate limit exceeded, please try again later')
+                else:
+                    message = _('The server is busy, please try again later')
+                raise AdmissionRefused(status, message, max(1, math.ceil(wait)))
+        db.session.commit()
+
+    def _over_concurrency(self, limits: Dict, seconds: float, user_id: Optional[int] = None,
+                          role: Optional[str] = None) -> bool:
+        from app import db
+        from app.models import GenerationJob as Job, User
+
+        query = select(func.count(), func.coalesce(func.sum(Job.cost), 0)) \
+            .where(Job.status.in_((Job.WAITING, Job.QUEUED, Job.RUNNING)))
+        if user_id is not None:
+            query = query.where(Job.user_id == user_id)
+        else:
+            query = query.join(User, User.id == Job.user_id).where(func.coalesce(User.role, 'user') == role)
+        jobs, total = db.session.execute(query).one()
+
+        max_jobs = limits.get('concurrent_jobs')
+        max_seconds = limits.get('concurrent_seconds')
+        if max_jobs is not None and jobs + 1 > max_jobs:
+            return True
+        # 單個請求超過上限時，沒有其他任務在進行就放行
+        return max_seconds is not None and jobs > 0 and total + seconds > max_seconds
+
+    def _ensure_bucket(self, key: str, burst: float, now: float):
+        from app import db
+        from app.models import RateBucket
+
+        if db.session.execute(select(RateBucket.key).where(RateBucket.key == key)).first() is not None:
+            return
+        db.session.add(RateBucket(key=key, tokens=burst, updated_at=now))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()  # 其他進程剛好創建了同一個桶
+
+    def _take(self, key: str, rate: float, burst: float, seconds: float, now: float) -> Optional[float]:
+        """從令牌桶取走 seconds 個令牌，成功返回 None，令牌不足時返回需要等待的秒數
+
+        超過 burst 的請求按 burst 計算，令牌桶滿時總能提交一次最大時長的請求
+        """
+        from app import db
+        from app.models import RateBucket
+
+        cost = min(seconds, burst)
+        refilled = RateBucket.tokens + (now - RateBucket.updated_at) * rate
+        level = case((refilled > burst, burst), else_=refilled)
+        result = db.session.execute(
+            update(RateBucket)
+            .where(RateBucket.key == key, level >= cost)
+            .values(tokens=level - cost, updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount:
+            return None
+        tokens, updated_at = db.session.execute(
+            select(RateBucket.tokens, RateBucket.updated_at).where(RateBucket.key == key)).one()
+        available = min(burst, tokens + max(0.0, now - updated_at) * rate)
+        return (cost - available) / rate
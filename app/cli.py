@@ -0,0 +1,393 @@
+import multiprocessing
+import os
+import random
+import shutil
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, select
+
+from app.music_engine.generator import STYLE_SETTINGS
+from app.music_engine.soundfont import SoundFont, SoundFontError, measure_load, style_presets
+
+soundfont_cli = AppGroup('soundfont', help='SoundFont 预处理工具')
+jobs_cli = AppGroup('jobs', help='后台任务队列')
+storage_cli = AppGroup('storage', help='生成文件存储')
+
+DEFAULT_SOUNDFONT = os.path.join('app', 'static', 'soundfonts', 'FluidR3_GM', 'FluidR3_GM.sf2')
+
+
+def _parse_preset(value: str):
+    """把 bank:program 解析为元组"""
+    try:
+        bank, program = value.split(':')
+        return int(bank), int(program)
+    except ValueError:
+        raise click.BadParameter(f"音色格式应为 bank:program，收到 {value}")
+
+
+@soundfont_cli.command('subset')
+@click.argument('source', default=DEFAULT_SOUNDFONT)
+@click.option('--output', '-o', default=None, help='输出路径，默认为 SOUNDFONT_SUBSET 配置')
+@click.option('--preset', '-p', 'extra', multiple=True, help='额外保留的音色，格式 bank:program')
+def subset_command(source, output, extra):
+    """从完整音色库中提取生成器用到的音色"""
+    output = output or current_app.config['SOUNDFONT_SUBSET']
+    presets = style_presets(STYLE_SETTINGS) | {_parse_preset(value) for value in extra}
+    try:
+        with SoundFont(source) as soundfont:
+            stats = soundfont.subset(output, presets)
+    except (OSError, SoundFontError) as e:
+        raise click.ClickException(str(e))
+
+    click.echo(f"已写入 {output}")
+    click.echo(f"  音色 {stats['presets']}，乐器 {stats['instruments']}，采样 {stats['samples']}")
+    click.echo(f"  {stats['source_bytes'] / 1024 ** 2:.1f} MB -> {stats['output_bytes'] / 1024 ** 2:.1f} MB")
+    for bank, program in stats['missing']:
+        click.echo(f"  警告：源音色库中没有 {bank}:{program}")
+
+
+@soundfont_cli.command('measure')
+@click.argument('paths', nargs=-1)
+@click.option('--workers', '-w', default=2, show_default=True, help='依次创建的合成器数量')
+def measure_command(paths, workers):
+    """测量加载音色库的耗时与每个合成器增加的常驻内存
+
+    不指定路径时比较完整音色库与精简音色库（SOUNDFONT_SUBSET），最后输出 Markdown 表格，可直接记录到 README
+    """
+    sample_rate = current_app.config.get('AUDIO_SAMPLE_RATE', 44100)
+    paths = paths or (DEFAULT_SOUNDFONT, current_app.config['SOUNDFONT_SUBSET'])
+    rows = []
+    for path in paths:
+        if not os.path.exists(path):
+            click.echo(f"{path} 不存在，跳过")
+            continue
+        result = measure_load(path, sample_rate, workers)
+        click.echo(f"{path} ({result['file_bytes'] / 1024 ** 2:.1f} MB)")
+        if 'error' in result:
+            click.echo(f"  加载失败: {result['error']}")
+            continue
+        for i, engine in enumerate(result['engines'], start=1):
+            click.echo(f"  合成器 {i}: {engine['seconds'] * 1000:.0f} ms, RSS +{engine['rss_kb'] / 1024:.1f} MB")
+        rows.append((path, result))
+
+    if not rows:
+        raise click.ClickException('没有可以加载的音色库（需要 libfluidsynth 与有效的 .sf2 文件）')
+    click.echo('')
+    click.echo('| 音色库 | 文件 (MB) | 首个合成器加载 (ms) | 首个合成器 RSS (MB) | 其后每个合成器 RSS (MB) |')
+    click.echo('|---|---|---|---|---|')
+    for path, result in rows:
+        first, rest = result['engines'][0], result['engines'][1:]
+        extra = sum(engine['rss_kb'] for engine in rest) / len(rest) / 1024 if rest else 0.0
+        click.echo(f"| {os.path.basename(path)} | {result['file_bytes'] / 1024 ** 2:.1f} "
+                   f"| {first['seconds'] * 1000:.0f} | {first['rss_kb'] / 1024:.1f} | {extra:.1f} |")
+
+
+def _start_workers(config_name, processes, kinds, burst):
+    """以 spawn 方式启动工作进程（各自创建应用与数据库连接，Windows 上同样可用）"""
+    from app.jobs import worker_process
+
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=worker_process, args=(config_name, i, kinds, burst), daemon=False)
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+@jobs_cli.command('work')
+@click.option('--processes', '-p', default=1, show_default=True, help='工作进程数')
+@click.option('--kind', '-k', 'kinds', multiple=True, help='只处理指定类型的任务，默认全部')
+@click.option('--burst', is_flag=True, help='队列为空时退出')
+@click.option('--config', 'config_name', default=lambda: os.environ.get('FLASK_CONFIG', 'default'),
+              help='工作进程使用的配置名，默认读取 FLASK_CONFIG')
+def work_command(processes, kinds, burst, config_name):
+    """启动工作进程，领取并执行生成与渲染任务"""
+    from app import job_runner
+
+    kinds = list(kinds) or None
+    if processes <= 1:
+        processed = job_runner.work(kinds=kinds, burst=burst)
+        click.echo(f"执行了 {processed} 个任务")
+        return
+    workers = _start_workers(config_name, processes, kinds, burst)
+    click.echo(f"已启动 {processes} 个工作进程")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # 中断时正在执行的任务租约会过期，由其他工作者重新领取
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+
+@jobs_cli.command('stats')
+def stats_command():
+    """按类型与状态统计任务数"""
+    from app import db
+    from app.models import GenerationJob as Job
+
+    rows = db.session.execute(select(Job.kind, Job.status, func.count())
+                              .group_by(Job.kind, Job.status).order_by(Job.kind, Job.status)).all()
+    for kind, status, count in rows:
+        click.echo(f"{kind:16} {status:8} {count}")
+
+
+@jobs_cli.command('requeue')
+@click.argument('job_ids', nargs=-1)
+def requeue_command(job_ids):
+    """把死信任务重新排队，不指定 ID 时处理全部死信"""
+    from app import job_runner
+
+    count = job_runner.requeue(job_ids or None)
+    click.echo(f"重新排队 {count} 个任务")
+
+
+def _bench_noop(job, progress):
+    return {}
+
+
+def _remove_outputs(result):
+    """删除一次生成的 MIDI、音频及其附属文件"""
+    from app.main.routes import audio_sidecars
+    from app.music_engine.segments import segments_dir_for
+
+    audio_file = os.path.join(current_app.static_folder, result['audio_path'])
+    for path in [os.path.join(current_app.static_folder, result['midi_path'])] + audio_sidecars(audio_file):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(segments_dir_for(audio_file), ignore_errors=True)
+
+
+def _bench_generate(job, progress):
+    """真实负载：生成一段试听音频后删除输出文件，不创建项目"""
+    from app.main.routes import music_generator
+
+    result = music_generator.generate_music(job.get_params())
+    if result['status'] != 'success':
+        raise RuntimeError(result['message'])
+    _remove_outputs(result)
+    return {}
+
+
+BENCH_PAYLOADS = {
+    'noop': ('bench.noop', {}),
+    'generate': ('bench.generate', {'mode': 'simple', 'style': 'pop', 'mood': 'happy', 'tempo': 120,
+                                    'duration': 10, 'chord_progression': '', 'preview': True}),
+}
+
+
+@jobs_cli.command('bench')
+@click.option('--jobs', '-n', 'count', default=200, show_default=True, help='每轮任务数')
+@click.option('--processes', '-p', multiple=True, type=int, help='工作进程数，可多次指定，默认 1 2 4')
+@click.option('--payload', type=click.Choice(list(BENCH_PAYLOADS)), default='noop', show_default=True)
+@click.option('--config', 'config_name', default=lambda: os.environ.get('FLASK_CONFIG', 'default'),
+              help='工作进程使用的配置名，默认读取 FLASK_CONFIG')
+def bench_command(count, processes, payload, config_name):
+    """测量任务队列吞吐量（任务/秒）
+
+    每轮登记 count 个任务，启动工作进程以 burst 模式处理完后退出。
+    “队列”吞吐量按数据库中第一个任务开始到最后一个任务结束计算，不含进程启动时间。
+    """
+    from app import db, job_runner
+    from app.models import GenerationJob as Job
+
+    if db.engine.url.database in (None, '', ':memory:'):
+        raise click.ClickException('内存数据库无法在进程间共享，请使用文件数据库')
+    kind, params = BENCH_PAYLOADS[payload]
+    for processes_count in processes or (1, 2, 4):
+        db.session.execute(delete(Job).where(Job.kind == kind))
+        db.session.commit()
+
+        started = time.monotonic()
+        for _ in range(count):
+            job_runner.enqueue(None, params, kind=kind, max_attempts=1)
+        enqueue_seconds = time.monotonic() - started
+
+        started = time.monotonic()
+        for worker in _start_workers(config_name, processes_count, [kind], True):
+            worker.join()
+        wall_seconds = time.monotonic() - started
+
+        done, first, last = db.session.execute(
+            select(func.count(), func.min(Job.started_at), func.max(Job.finished_at))
+            .where(Job.kind == kind, Job.status == Job.DONE)).one()
+        queue_seconds = (last - first).total_seconds() if done else 0
+        click.echo(f"{payload} x{count}, {processes_count} 个进程: 登记 {count / enqueue_seconds:.0f} 个/秒, "
+                   f"完成 {done}, 队列 {done / max(queue_seconds, 1e-6):.1f} 个/秒 "
+                   f"(含进程启动 {done / wall_seconds:.1f} 个/秒)")
+
+    db.session.execute(delete(Job).where(Job.kind == kind))
+    db.session.commit()
+
+
+# 模拟负载：通道 -> (到达比例, 时长范围（秒）, 是否试听)
+SIMULATION_MIX = {
+    'preview': (0.40, (10, 30), True),
+    'premium': (0.15, (60, 240), False),
+    'standard': (0.35, (60, 300), False),
+    'batch': (0.10, (300, 300), False),
+}
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+@jobs_cli.command('simulate')
+@click.option('--workers', '-w', default=4, show_default=True, help='工作者数')
+@click.option('--hours', default=2.0, show_default=True, help='模拟的到达时长（小时）')
+@click.option('--load', default=0.9, show_default=True, help='平均利用率')
+@click.option('--burst', default=40, show_default=True, help='开始时一次到达的长时间免费任务数')
+@click.option('--speed', default=10.0, show_default=True, help='每个工作者每秒处理的标准渲染秒数')
+@click.option('--seed', default=1, show_default=True, help='随机种子')
+def simulate_command(workers, hours, load, burst, speed, seed):
+    """模拟混合负载下各通道的等待时间（p50 / p99），与单一先进先出队列对比
+
+    按 SIMULATION_MIX 的比例以泊松过程生成任务，成本由调度器按时长与风格估算；
+    只运行调度策略，不访问数据库，也不真正渲染
+    """
+    from app import job_runner
+    from app.scheduler import LANES, simulate
+
+    scheduler = job_runner.scheduler
+    rng = random.Random(seed)
+    lanes = list(SIMULATION_MIX)
+    shares = [SIMULATION_MIX[lane][0] for lane in lanes]
+    styles = list(STYLE_SETTINGS)
+
+    def job_cost(lane):
+        _, (low, high), preview = SIMULATION_MIX[lane]
+        return scheduler.estimate_cost({'duration': rng.uniform(low, high), 'style': rng.choice(styles),
+                                        'preview': preview})
+
+    mean_cost = sum(job_cost(rng.choices(lanes, shares)[0]) for _ in range(10000)) / 10000
+    rate = load * workers * speed / mean_cost
+    jobs = [(0.0, 'standard', scheduler.estimate_cost({'duration': 300, 'style': 'rock'}))
+            for _ in range(burst)]
+    arrival = 0.0
+    while True:
+        arrival += rng.expovariate(rate)
+        if arrival > hours * 3600:
+            break
+        lane = rng.choices(lanes, shares)[0]
+        jobs.append((arrival, lane, job_cost(lane)))
+
+    click.echo(f"{len(jobs)} 个任务（开始时 {burst} 个长任务），{workers} 个工作者，利用率 {load:.0%}")
+    click.echo(f"{'策略':6}{'通道':10}{'任务数':>8}{'p50 等待':>12}{'p99 等待':>12}")
+    for name, policy in (('fifo', None), ('lanes', scheduler)):
+        waits = simulate(policy, jobs, workers, speed)
+        for lane in LANES:
+            if lane in waits:
+                click.echo(f"{name:8}{lane:12}{len(waits[lane]):>8}"
+                           f"{_percentile(waits[lane], 50):>11.1f}s{_percentile(waits[lane], 99):>11.1f}s")
+
+
+def _storage_gc(job, progress):
+    """清理任务：参数同 StorageCollector.run（dry_run、retention）"""
+    from app.retention import StorageCollector
+
+    return StorageCollector.from_app(current_app).run(**job.get_params())
+
+
+def _echo_report(report, dry_run):
+    verb = '可回收' if dry_run else '已回收'
+    labels = {'orphans': '无引用的文件', 'temporary': '临时文件', 'retention': '不活跃项目的音频'}
+    for category, label in labels.items():
+        click.echo(f"  {label}: {report[category]['files']} 个，{report[category]['bytes'] / 1024 ** 2:.1f} MB")
+    total = sum(item['bytes'] for item in report.values())
+    click.echo(f"{verb} {total / 1024 ** 2:.1f} MB")
+
+
+@storage_cli.command('gc')
+@click.option('--dry-run', is_flag=True, help='只统计，不删除')
+@click.option('--no-retention', is_flag=True, help='不执行保留策略，只清理无引用与临时文件')
+@click.option('--enqueue', is_flag=True, help='登记为后台任务（batch 通道），由工作者执行')
+def gc_command(dry_run, no_retention, enqueue):
+    """清理生成目录：删除无引用的文件与临时文件，按保留策略删除不活跃项目的音频"""
+    from app import job_runner
+    from app.retention import StorageCollector
+
+    params = {'dry_run': dry_run, 'retention': not no_retention}
+    if enqueue:
+        job = job_runner.enqueue(None, params, kind='storage.gc', max_attempts=1)
+        click.echo(f"已登记清理任务 {job.id}")
+        return
+    _echo_report(StorageCollector.from_app(current_app).run(**params), dry_run)
+
+
+@storage_cli.command('check')
+@click.option('--jobs', '-n', 'count', default=16, show_default=True, help='生成请求数')
+@click.option('--threads', '-t', default=8, show_default=True, help='并行线程数')
+@click.option('--seeds', default=8, show_default=True, help='不同种子数，请求依次循环使用')
+@click.option('--duration', default=10.0, show_default=True, help='每段音乐的时长（秒）')
+@click.option('--keep', is_flag=True, help='保留生成的文件')
+def check_command(count, threads, seeds, duration, keep):
+    """并行生成音乐，检查生成文件的路径没有冲突
+
+    种子相同的请求内容相同，应得到相同的路径；种子不同的请求不应共用路径。
+    MIDI 按内容摘要发布，还检查文件内容的摘要与文件名一致（没有被其他请求覆盖）。
+    有冲突时以非零状态退出。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from app.main.routes import music_generator
+    from app.music_engine.storage import file_digest
+
+    # 随机的种子基数，避免与已有项目的文件重合（检查结束后会删除生成的文件）
+    base = random.randrange(1 << 30)
+    requests = [{'mode': 'simple', 'style': 'pop', 'mood': 'happy', 'tempo': 120, 'duration': duration,
+                 'chord_progression': '', 'preview': True, 'seed': base + i % seeds} for i in range(count)]
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(music_generator.generate_music, requests))
+    seconds = time.monotonic() - started
+
+    problems = []
+    paths = {}
+    for params, result in zip(requests, results):
+        if result['status'] != 'success':
+            problems.append(f"种子 {params['seed']}: 生成失败: {result['message']}")
+            continue
+        paths.setdefault(params['seed'], set()).add((result['midi_path'], result['audio_path']))
+        midi_file = os.path.join(current_app.static_folder, result['midi_path'])
+        audio_file = os.path.join(current_app.static_folder, result['audio_path'])
+        if not os.path.exists(midi_file) or file_digest(midi_file) not in os.path.basename(midi_file):
+            problems.append(f"{result['midi_path']}: 内容与文件名的摘要不一致")
+        if not os.path.exists(audio_file) or not os.path.getsize(audio_file):
+            problems.append(f"{result['audio_path']}: 音频缺失或为空")
+    for seed, outputs in paths.items():
+        if len(outputs) > 1:
+            problems.append(f"种子 {seed}: 相同的请求得到了不同的路径")
+    for index in range(2):
+        owners = {}
+        for seed, outputs in paths.items():
+            for output in outputs:
+                owners.setdefault(output[index], set()).add(seed)
+        problems.extend(f"{path}: 被种子 {sorted(owner)} 共用" for path, owner in owners.items() if len(owner) > 1)
+
+    if not keep:
+        for result in {(r['midi_path'], r['audio_path']): r for r in results if r['status'] == 'success'}.values():
+            _remove_outputs(result)
+
+    click.echo(f"{count} 个请求（{len(paths)} 个不同种子），{threads} 个线程，用时 {seconds:.1f} 秒: "
+               f"{len({p[0] for outputs in paths.values() for p in outputs})} 个 MIDI 文件，冲突 {len(problems)} 个")
+    for problem in problems:
+        click.echo(f"  {problem}")
+    if problems:
+        raise SystemExit(1)
+
+
+def register(app):
+    from app import job_runner
+
+    job_runner.register('bench.noop', _bench_noop)
+    job_runner.register('bench.generate', _bench_generate)
+    job_runner.register('storage.gc', _storage_gc)
+    app.cli.add_command(soundfont_cli)
+    app.cli.add_command(jobs_cli)
+    app.cli.add_command(storage_cli)
@@ -0,0 +1,587 @@
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, Optional
+
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from app.scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+
+def worker_name(suffix: str = '') -> str:
+    """工作者標識：主機名:進程號[:線程名]，寫入任務租約以便排查"""
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    return f"{name}:{suffix}" if suffix else name
+
+
+class JobProgress:
+    """任務進度記錄器，作為 progress(階段, **信息) 回調傳給處理函數
+
+    連續的同一階段事件合併為一條（保留階段開始時間 since），同一階段內
+    最多每 min_interval 秒寫一次數據庫，階段變化時立即寫入。寫入走獨立連接，
+    不影響處理函數所在的事務，可以在渲染線程中調用；寫入失敗只記錄日誌。
+    """
+
+    def __init__(self, runner: 'JobRunner', job_id: str, worker_id: str, events=None,
+                 min_interval: float = 0.5):
+        from app import db
+
+        self.runner = runner
+        self.engine = db.engine
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.events = list(events or [])
+        self.min_interval = min_interval
+        self._written = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, stage: str, **info):
+        event = {'stage': stage, 't': datetime.utcnow().isoformat(), **info}
+        with self._lock:
+            if self.events and self.events[-1]['stage'] == stage:
+                event['since'] = self.events[-1].get('since', self.events[-1]['t'])
+                self.events[-1] = event
+                if time.monotonic() - self._written < self.min_interval:
+                    return
+            else:
+                self.events.append(event)
+            self._write()
+
+    def add(self, stage: str, **info) -> str:
+        """追加事件但不寫入（由任務結束時的更新一起寫入），返回全部事件的 JSON"""
+        with self._lock:
+            self.events.append({'stage': stage, 't': datetime.utcnow().isoformat(), **info})
+            return json.dumps(self.events)
+
+    def _write(self):
+        from app.models import GenerationJob as Job
+
+        self._written = time.monotonic()
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(update(Job.__table__)
+                                   .where(Job.id == self.job_id, Job.locked_by == self.worker_id)
+                                   .values(progress=json.dumps(self.events)))
+        except Exception as e:
+            logger.warning(f"寫入任務 {self.job_id} 進度失敗: {str(e)}")
+            return
+        self.runner.watcher.update(self.job_id, status=Job.RUNNING, events=list(self.events))
+
+
+class JobWatcher:
+    """任務狀態的共享監視器，供 SSE 連接等待狀態變化
+
+    所有連接共用一個輪詢線程：每隔 interval 秒用一條查詢讀取所有被關注任務的狀態，
+    與連接數無關；本進程內工作者的進度則直接推送，不等輪詢。每個連接只是在
+    條件變量上等待，空閒時不佔用數據庫。沒有連接時輪詢線程退出。
+    """
+
+    def __init__(self, runner: 'JobRunner', interval: float = 1.0):
+        self.runner = runner
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._conditions: Dict[str, threading.Condition] = {}
+        self._watchers: Dict[str, int] = {}
+        self._snapshots: Dict[str, Dict] = {}
+        self._thread = None
+
+    def publish(self, job_id: str, snapshot: Dict):
+        with self._lock:
+            if job_id in self._watchers and snapshot != self._snapshots.get(job_id):
+                self._snapshots[job_id] = snapshot
+                self._conditions[job_id].notify_all()
+
+    def update(self, job_id: str, **changes):
+        """在已有快照上更新部分字段（本進程的工作者推送進度時使用）"""
+        with self._lock:
+            snapshot = self._snapshots.get(job_id)
+            if job_id not in self._watchers or snapshot is None:
+                return
+        self.publish(job_id, {**snapshot, **changes})
+
+    def _load(self, job_ids) -> Dict[str, Dict]:
+        from app import db
+        from app.models import GenerationJob as Job
+
+        rows = db.session.execute(select(Job.id, Job.status, Job.progress, Job.error, Job.project_id, Job.result)
+                                  .where(Job.id.in_(job_ids))).all()
+        db.session.rollback()
+        return {row.id: {'status': row.status, 'events': json.loads(row.progress) if row.progress else [],
+                         'error': row.error, 'project_id': row.project_id,
+                         'result': json.loads(row.result) if row.result else None} for row in rows}
+
+    def _poll(self):
+        from app import db
+
+        with self.runner.app.app_context():
+            try:
+                while True:
+                    with self._lock:
+                        job_ids = list(self._watchers)
+                        if not job_ids:
+                            self._thread = None
+                            return
+                    try:
+                        for job_id, snapshot in self._load(job_ids).items():
+                            self.publish(job_id, snapshot)
+                    except Exception as e:
+                        db.session.rollback()
+                        logger.warning(f"讀取任務狀態失敗: {str(e)}")
+                    time.sleep(self.interval)
+            finally:
+                db.session.remove()
+
+    def follow(self, job_id: str, keepalive: float = 15.0):
+        """生成器：產出任務狀態快照，首次立即產出，之後每次變化時產出；
+        keepalive 秒內沒有變化時產出 None（用於發送保活註釋），任務結束後停止
+        """
+        from app.models import GenerationJob as Job
+
+        with self._lock:
+            self._watchers[job_id] = self._watchers.get(job_id, 0) + 1
+            condition = self._conditions.setdefault(job_id, threading.Condition(self._lock))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll, name='job-watcher', daemon=True)
+                self._thread.start()
+        try:
+            for snapshot in self._load([job_id]).values():
+                self.publish(job_id, snapshot)
+            last = None
+            while True:
+                with self._lock:
+                    condition.wait_for(lambda: self._snapshots.get(job_id) is not last, timeout=keepalive)
+                    snapshot = self._snapshots.get(job_id)
+                if snapshot is last:
+                    yield None
+                    continue
+                last = snapshot
+                yield snapshot
+                if snapshot['status'] in (Job.DONE, Job.DEAD):
+                    return
+        finally:
+            with self._lock:
+                self._watchers[job_id] -= 1
+                if not self._watchers[job_id]:
+                    del self._watchers[job_id]
+                    self._conditions.pop(job_id, None)
+                    self._snapshots.pop(job_id, None)
+
+
+class JobRunner:
+    """持久化在數據庫中的任務隊列
+
+    請求只寫入一條 GenerationJob 記錄；工作者（Web 進程內的線程，或
+    `flask jobs work` 啟動的工作進程）用一條 UPDATE ... RETURNING 原子地領取任務，
+    同時寫入租約。執行期間由心跳線程續約，進程崩潰後租約過期，任務自動重新可見。
+    失敗的任務按指數退避重新排隊，次數用盡後轉為死信。不依賴額外的消息中間件。
+    """
+
+    def __init__(self, workers: int = 2):
+        self.workers = workers
+        self.visibility_timeout = 120.0
+        self.max_attempts = 3
+        self.backoff = 5.0
+        self.backoff_max = 300.0
+        self.poll_interval = 0.5
+        self.handlers: Dict[str, Callable] = {}
+        self.watcher = JobWatcher(self)
+        self.scheduler = Scheduler()
+        self.app = None
+        self._threads = []
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.workers = app.config.get('GENERATION_WORKERS', self.workers)
+        self.visibility_timeout = app.config.get('JOB_VISIBILITY_TIMEOUT', self.visibility_timeout)
+        self.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', self.max_attempts)
+        self.backoff = app.config.get('JOB_RETRY_BACKOFF', self.backoff)
+        self.backoff_max = app.config.get('JOB_RETRY_BACKOFF_MAX', self.backoff_max)
+        self.poll_interval = app.config.get('JOB_POLL_INTERVAL', self.poll_interval)
+        self.watcher.interval = app.config.get('JOB_EVENTS_POLL_INTERVAL', self.watcher.interval)
+        self.scheduler.init_app(app)
+        self.app = app
+        app.extensions['job_runner'] = self
+        # Web 進程在第一個請求時啟動進程內工作線程（GENERATION_WORKERS 為 0 時只靠工作進程）
+        app.before_request(self.start)
+
+    def register(self, kind: str, handler: Callable):
+        """登記任務類型的處理函數：handler(job, progress) -> 結果字典（可含 project_id），失敗時拋出異常
+
+        progress(階段, **信息) 記錄執行進度，可通過 JobWatcher 推送給客戶端
+        """
+        self.handlers[kind] = handler
+
+    # ---- 隊列操作 ----
+
+    def enqueue(self, user_id: Optional[int], params: Dict, kind: str = 'generate',
+                max_attempts: Optional[int] = None, dedupe_key: Optional[str] = None,
+                lane: Optional[str] = None, cost: Optional[float] = None,
+                project_id: Optional[int] = None):
+        """登記任務並喚醒本進程的工作線程，返回任務記錄
+
+        lane 為調度通道（見 Scheduler），默認按參數判斷，沒有用戶的任務歸入 batch；
+        cost 為估計成本，默認按參數估算，調度與準入控制都按它統計用量；
+        project_id 為任務處理的已有項目（重新生成、補渲染），便於按項目查找任務
+
+        指定 dedupe_key 時合併相同的請求：已有持有該鍵的任務在排隊或執行中，
+        就登記一個跟隨它的 waiting 任務，不重複生成。鍵的唯一約束由數據庫保證，
+        因此多個 Web 進程同時提交也只有一個成為領頭任務。
+        """
+        from app import db
+        from app.models import GenerationJob as Job
+
+        if lane is None:
+            lane = self.scheduler.lane_for(params, user_id is not None)
+        if cost is None:
+            cost = self.scheduler.estimate_cost(params)
+
+        def new_job(**values):
+            return Job(kind=kind, user_id=user_id, params=json.dumps(params),
+                       max_attempts=max_attempts or self.max_attempts,
+                       lane=lane, cost=cost, project_id=project_id, available_at=datetime.utcnow(), **values)
+
+        if dedupe_key is None:
+            job = new_job()
+            db.session.add(job)
+            db.session.commit()
+            self._wakeup.set()
+            return job
+
+        for _ in range(3):
+            job = new_job(dedupe_key=dedupe_key)
+            db.session.add(job)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+            else:
+                self._wakeup.set()
+                return job
+            leader_id = db.session.execute(select(Job.id).where(Job.dedupe_key == dedupe_key)).scalar()
+            if leader_id is None:
+                continue  # 領頭任務剛好結束並釋放了鍵，重新嘗試成為領頭任務
+            job = new_job(status=Job.WAITING, leader_id=leader_id)
+            db.session.add(job)
+            db.session.commit()
+            # 領頭任務可能在登記期間結束，此時由這裡放行
+            if self.release_followers():
+                self._wakeup.set()
+            logger.info(f"任務 {job.id} 合併到執行中的任務 {leader_id}")
+            return job
+        raise RuntimeError(f"無法登記任務：合併鍵 {dedupe_key} 持續衝突")
+
+    def release_followers(self) -> int:
+        """放行領頭任務已結束的跟隨任務，返回放行的數量
+
+        領頭任務結束、登記跟隨任務之後、以及空閒輪詢時都會調用，
+        無論兩者以何種順序提交，跟隨任務都不會一直等待
+        """
+        from app import db
+        from app.models import GenerationJob as Job
+
+        leader = aliased(Job)
+        finished = select(leader.id).where(leader.status.in_([Job.DONE, Job.DEAD]))
+        stmt = (update(Job)
+                .where(Job.status == Job.WAITING, Job.leader_id.in_(finished))
+                .values(status=Job.QUEUED, available_at=datetime.utcnow())
+                .execution_options(synchronize_session=False))
+        count = db.session.execute(stmt).rowcount
+        db.session.commit()
+        return count
+
+    def leader_result(self, job) -> Optional[Dict]:
+        """跟隨任務的領頭任務已成功時返回其結果，否則返回 None（需要自行生成）"""
+        from app import db
+        from app.models import GenerationJob as Job
+
+        if not job.leader_id:
+            return None
+        leader = db.session.get(Job, job.leader_id)
+        if leader is None or leader.status != Job.DONE:
+            return None
+        return leader.get_result()
+
+    @staticmethod
+    def _claimable(now: datetime):
+        from app.models import GenerationJob as Job
+
+        return or_(
+            and_(Job.status == Job.QUEUED, Job.available_at <= now),
+            # 租約過期的任務（工作者崩潰或卡死）重新可見
+            and_(Job.status == Job.RUNNING, Job.locked_until < now, Job.attempts < Job.max_attempts),
+        )
+
+    def claim(self, worker_id: str, kinds: Optional[Iterable[str]] = None):
+        """原子地領取一個任務並寫入租約，沒有可領取的任務時返回 None
+
+        先由調度器排出通道的先後，再在通道內按先進先出領取。
+        候選行與更新在同一條語句中完成：SQLite 在寫鎖內執行整條語句，
+        PostgreSQL 用 FOR UPDATE SKIP LOCKED 讓並發的工作者各自拿到不同的行，
+        外層 WHERE 再檢查一次可領取條件，因此同一任務不會被兩個工作者同時領取。
+        """
+        from app import db
+        from app.models import GenerationJob as Job
+
+        kinds = list(kinds) if kinds is not None else list(self.handlers)
+        now = datetime.utcnow()
+        for lane in self._lane_order(now, kinds):
+            candidate = (select(Job.id)
+                         .where(self._claimable(now), Job.kind.in_(kinds), Job.lane == lane)
+                         .order_by(Job.available_at, Job.created_at)
+                         .limit(1)
+                         .with_for_update(skip_locked=True)
+                         .scalar_subquery())
+            stmt = (update(Job)
+                    .where(Job.id == candidate, self._claimable(now))
+                    .values(status=Job.RUNNING, locked_by=worker_id,
+                            locked_until=now + timedelta(seconds=self.visibility_timeout),
+                            attempts=Job.attempts + 1, started_at=now)
+                    .returning(Job.id)
+                    .execution_options(synchronize_session=False))
+            job_id = db.session.execute(stmt).scalar()
+            db.session.commit()
+            if job_id is not None:
+                return db.session.get(Job, job_id, populate_existing=True)
+        return None
+
+    def _lane_order(self, now: datetime, kinds) -> list:
+        """有可領取任務的通道，按調度器的得分排序；只有一個通道時不統計用量"""
+        from app import db
+        from app.models import GenerationJob as Job
+
+        rows = db.session.execute(select(Job.lane, func.min(Job.available_at), func.avg(Job.cost))
+                                  .where(self._claimable(now), Job.kind.in_(kinds))
+                                  .group_by(Job.lane)).all()
+        if len(rows) <= 1:
+            return [row[0] for row in rows]
+        waiting = {lane: (now - oldest).total_seconds() for lane, oldest, _ in rows}
+        next_cost = {lane: float(cost or 0) for lane, _, cost in rows}
+        since = now - timedelta(seconds=self.scheduler.window)
+        usage = {lane: float(cost or 0) for lane, cost in db.session.execute(
+            select(Job.lane, func.sum(Job.cost)).where(Job.started_at >= since).group_by(Job.lane))}
+        return self.scheduler.rank(waiting, usage, next_cost)
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """延長租約，租約已被其他工作者接手時返回 False"""
+        from app import db
+        from app.models import GenerationJob as Job
+
+        stmt = (update(Job)
+                .where(Job.id == job_id, Job.locked_by == worker_id, Job.status == Job.RUNNING)
+                .values(locked_until=datetime.utcnow() + timedelta(seconds=self.visibility_timeout))
+                .execution_options(synchronize_session=False))
+        renewed = db.session.execute(stmt).rowcount == 1
+        db.session.commit()
+        return renewed
+
+    def _finish(self, job_id: str, worker_id: str, **values) -> bool:
+        """以租約為條件更新任務；租約已丟失時不寫入，返回 False"""
+        from app import db
+        from app.models import GenerationJob as Job
+
+        stmt = (update(Job)
+                .where(Job.id == job_id, Job.locked_by == worker_id, Job.status == Job.RUNNING)
+                .values(locked_by=None, locked_until=None, **values)
+                .execution_options(synchronize_session=False))
+        return db.session.execute(stmt).rowcount == 1
+
+    def retry_delay(self, attempts: int) -> float:
+        """第 attempts 次失敗後的等待時間：指數退避，加上最多 25% 的隨機抖動"""
+        delay = min(self.backoff * 2 ** max(attempts - 1, 0), self.backoff_max)
+        return delay * (1 + random.random() * 0.25)
+
+    def reap(self) -> int:
+        """把租約過期且重試次數已用盡的任務轉為死信，返回處理的數量"""
+        from app import db
+        from app.models import GenerationJob as Job
+
+        now = datetime.utcnow()
+        stmt = (update(Job)
+                .where(Job.status == Job.RUNNING, Job.locked_until < now, Job.attempts >= Job.max_attempts)
+                .values(status=Job.DEAD, locked_by=None, locked_until=None, finished_at=now, dedupe_key=None,
+                        error='工作者在執行中失去響應，重試次數已用盡')
+                .execution_options(synchronize_session=False))
+        count = db.session.execute(stmt).rowcount
+        db.session.commit()
+        self.release_followers()
+        return count
+
+    def requeue(self, job_ids: Optional[Iterable[str]] = None) -> int:
+        """把死信任務重新排隊（不指定 ID 時處理全部死信），重試次數清零"""
+        from app import db
+        from app.models import GenerationJob as Job
+
+        stmt = update(Job).where(Job.status == Job.DEAD)
+        if job_ids is not None:
+            stmt = stmt.where(Job.id.in_(list(job_ids)))
+        stmt = stmt.values(status=Job.QUEUED, attempts=0, available_at=datetime.utcnow(),
+                           finished_at=None).execution_options(synchronize_session=False)
+        count = db.session.execute(stmt).rowcount
+        db.session.commit()
+        self._wakeup.set()
+        return count
+
+    # ---- 執行 ----
+
+    def _keep_alive(self, job_id: str, worker_id: str, done: threading.Event):
+        """心跳線程：每隔三分之一個租約時間續約一次"""
+        interval = self.visibility_timeout / 3
+        with self.app.app_context():
+            from app import db
+            try:
+                while not done.wait(interval):
+                    try:
+                        if not self.heartbeat(job_id, worker_id):
+                            logger.warning(f"任務 {job_id} 的租約已被接手")
+                            return
+                    except Exception as e:
+                        db.session.rollback()
+                        logger.warning(f"任務 {job_id} 續約失敗: {str(e)}")
+            finally:
+                db.session.remove()
+
+    def run_job(self, job, worker_id: str) -> bool:
+        """執行已領取的任務並提交結果，返回是否成功
+
+        處理函數寫入的數據（例如新建的 Project）與任務完成狀態在同一事務中提交；
+        租約已丟失時整個事務回滾，由接手的工作者重新執行。
+        """
+        from app import db
+        from app.models import GenerationJob as Job
+
+        job_id = job.id
+        progress = JobProgress(self, job_id, worker_id, job.progress and json.loads(job.progress))
+        done = threading.Event()
+        keeper = threading.Thread(target=self._keep_alive, args=(job_id, worker_id, done), daemon=True)
+        keeper.start()
+        try:
+            handler = self.handlers.get(job.kind)
+            if handler is None:
+                raise RuntimeError(f"未知的任務類型: {job.kind}")
+            result = handler(job, progress) or {}
+        except Exception as e:
+            logger.error(f"任務 {job_id} 第 {job.attempts} 次執行失敗: {str(e)}", exc_info=True)
+            db.session.rollback()
+            job = db.session.get(Job, job_id, populate_existing=True)
+            now = datetime.utcnow()
+            if job.attempts >= job.max_attempts:
+                # 跟隨任務放行後各自生成
+                values = dict(status=Job.DEAD, finished_at=now, dedupe_key=None)
+            else:
+                values = dict(status=Job.QUEUED,
+                              available_at=now + timedelta(seconds=self.retry_delay(job.attempts)))
+            values['progress'] = progress.add(values['status'], error=str(e))
+            self._finish(job_id, worker_id, error=str(e), **values)
+            db.session.commit()
+            if values['status'] == Job.DEAD:
+                self.release_followers()
+            self.watcher.update(job_id, status=values['status'], events=list(progress.events), error=str(e))
+            return False
+        finally:
+            done.set()
+            keeper.join()
+
+        finished = self._finish(job_id, worker_id, status=Job.DONE, result=json.dumps(result), error=None,
+                                project_id=result.get('project_id'), finished_at=datetime.utcnow(),
+                                progress=progress.add(Job.DONE), dedupe_key=None)
+        if not finished:
+            logger.warning(f"任務 {job_id} 的租約已丟失，放棄本次結果")
+            db.session.rollback()
+            return False
+        db.session.commit()
+        if self.release_followers():
+            self._wakeup.set()
+        self.watcher.update(job_id, status=Job.DONE, events=list(progress.events), error=None,
+                            project_id=result.get('project_id'), result=result)
+        return True
+
+    def work(self, worker_id: Optional[str] = None, kinds: Optional[Iterable[str]] = None,
+             burst: bool = False, stop: Optional[threading.Event] = None) -> int:
+        """工作循環：領取並執行任務，隊列為空時等待；burst 模式下隊列為空即返回
+
+        需要在應用上下文中調用，返回執行的任務數
+        """
+        from app import db
+
+        worker_id = worker_id or worker_name()
+        stop = stop or self._stop
+        processed = 0
+        while not stop.is_set():
+            try:
+                job = self.claim(worker_id, kinds)
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"領取任務失敗: {str(e)}")
+                job = None
+            if job is None:
+                if burst:
+                    break
+                try:
+                    self.reap()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.warning(f"清理過期任務失敗: {str(e)}")
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            job_id = job.id
+            try:
+                self.run_job(job, worker_id)
+            except Exception as e:
+                # 處理函數以外的失敗（例如提交結果時數據庫被鎖），工作線程繼續運行；
+                # 任務的租約過期後由 reap() 重新排隊
+                db.session.rollback()
+                logger.error(f"執行任務 {job_id} 時發生錯誤: {str(e)}", exc_info=True)
+            finally:
+                db.session.remove()
+            processed += 1
+        return processed
+
+    def _thread_main(self):
+        with self.app.app_context():
+            self.work(worker_name(threading.current_thread().name))
+
+    def start(self):
+        """啟動進程內工作線程（只啟動一次）"""
+        if self._threads or not self.workers:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._thread_main, name=f'job-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            self._stop.set()
+            self._wakeup.set()
+            if wait:
+                for thread in self._threads:
+                    thread.join()
+            self._threads = []
+
+
+def worker_process(config_name: str, index: int, kinds: Optional[Iterable[str]] = None,
+                   burst: bool = False):
+    """工作進程入口：創建應用後運行工作循環（multiprocessing 以 spawn 方式啟動）"""
+    from app import create_app, job_runner
+
+    app = create_app(config_name)
+    with app.app_context():
+        started = time.monotonic()
+        processed = job_runner.work(worker_name(f'w{index}'), kinds, burst=burst)
+        logger.info(f"工作進程 {index} 退出：執行 {processed} 個任務，用時 {time.monotonic() - started:.1f} 秒")
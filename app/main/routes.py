@@ -1,19 +1,252 @@
-from flask import render_template, jsonify, request, current_app, send_file, abort, flash, redirect, url_for, session
+from flask import render_template, jsonify, request, current_app, send_file, send_from_directory, abort, flash, redirect, url_for, session, make_response, Response, stream_with_context
 from flask_login import current_user, login_required
 from app.main import bp
-from app import db
-from app.models import Project, MusicFile
+from app import db, cache, job_runner, render_pool, admission
+from app.admission import AdmissionRefused
+from app.retention import file_in_use, remove_artifact
+from app.models import GenerationJob, Project, MusicFile
 from app.music_engine import MusicGenerator, AudioConverter, ChordProcessor
+from app.music_engine.generator import ENGINE_VERSION, generation_key, generation_recipe
+from app.music_engine.cache import DerivedFileCache
+from app.music_engine.storage import file_digest
+from app.music_engine.peaks import compute_peaks, peaks_path_for, select_level
+from app.music_engine.delivery import OPUS_MIMETYPE, accepts_opus, available_tiers, choose_tier, tier_path
+from app.music_engine.segments import (PLAYLIST, PLAYLIST_MIMETYPE, SEGMENT_MIMETYPE, in_progress_dir,
+                                       playlist_complete, segment_audio_file, segments_dir_for)
 from flask_babel import _
-from datetime import datetime
+from sqlalchemy import select
+from datetime import datetime, timedelta
 import os
 import json
+import re
+import struct
+import zipfile
 
-# 初始化音樂生成器
-music_generator = MusicGenerator()
+# 初始化音樂生成器（音頻渲染交給共享的渲染池）
+music_generator = MusicGenerator(render_pool=render_pool)
 audio_converter = AudioConverter()
 chord_processor = ChordProcessor()
 
+# 導出時按需轉碼得到的其他格式（按項目緩存，藍圖註冊時按配置創建）
+EXPORT_FORMATS = ['wav', 'mp3', 'ogg', 'flac', 'opus']
+export_cache = None
+
+@bp.record_once
+def configure_music_generator(state):
+    """藍圖註冊時把應用配置傳給音樂生成器"""
+    global export_cache
+    music_generator.configure(state.app.config)
+    job_runner.register('generate', run_generation_job)
+    job_runner.register('render', run_render_job)
+    job_runner.register('restore', run_restore_job)
+    job_runner.register('render.full', run_full_render_job)
+    export_cache = DerivedFileCache(state.app.config['EXPORT_CACHE_DIR'],
+                                    state.app.config.get('EXPORT_CACHE_MAX_BYTES', 1024 ** 3))
+
+def missing_files(*paths):
+    """paths 中已不存在的生成文件"""
+    return [path for path in paths if path and not os.path.exists(os.path.join(current_app.static_folder, path))]
+
+def restorable(project):
+    """缺失的文件能否重新生成：音頻可從 MIDI 重新渲染，MIDI 需要當前引擎版本的生成配方"""
+    if project.midi_path and not missing_files(project.midi_path):
+        return True
+    recipe = project.get_recipe()
+    return bool(recipe) and recipe.get('engine') == ENGINE_VERSION
+
+def is_preview(path):
+    """是否為只渲染了前一段的試聽版音頻"""
+    return bool(path) and os.path.basename(path).startswith('preview_')
+
+def project_job(project, kind, params, lane):
+    """登記處理已有項目的任務並返回任務記錄，同一項目同一類型只登記一個（合併鍵為類型與項目 ID）
+
+    最近一次同類任務轉為死信後的 JOB_RETRY_BACKOFF_MAX 秒內返回該任務，由調用方報告失敗，
+    不重複登記註定失敗的任務；成本計入發起請求的用戶，超出配額時拋出 AdmissionRefused
+    """
+    dedupe_key = f'{kind}:{project.id}'
+    job = db.session.execute(select(GenerationJob).where(GenerationJob.dedupe_key == dedupe_key)).scalar()
+    if job is not None:
+        return job
+    
+    failed_after = datetime.utcnow() - timedelta(seconds=current_app.config.get('JOB_RETRY_BACKOFF_MAX', 300))
+    job = db.session.execute(select(GenerationJob)
+                             .where(GenerationJob.kind == kind, GenerationJob.project_id == project.id,
+                                    GenerationJob.status == GenerationJob.DEAD,
+                                    GenerationJob.finished_at >= failed_after)
+                             .order_by(GenerationJob.finished_at.desc()).limit(1)).scalar()
+    if job is not None:
+        return job
+    
+    cost = job_runner.scheduler.estimate_cost(params)
+    admission.admit(current_user, cost)
+    return job_runner.enqueue(current_user.id, params, kind=kind, dedupe_key=dedupe_key,
+                              lane=lane, cost=cost, project_id=project.id)
+
+def restore_job(project, *paths):
+    """paths（默認為項目的 MIDI 與音頻）有缺失時登記重新生成任務並返回任務記錄，
+    文件齊全或無法重新生成時返回 None
+
+    重新生成任務在 batch 通道執行，超出配額時拋出 AdmissionRefused
+    """
+    if not missing_files(*(paths or (project.midi_path, project.audio_path))) or not restorable(project):
+        return None
+    
+    # 只缺 MIDI 時音頻不必重新渲染，成本只按需要重新渲染的音頻估算
+    params = {
+        'project_id': project.id,
+        'style': project.style,
+        'duration': (project.duration or 0) if missing_files(project.audio_path) else 0,
+        'preview': is_preview(project.audio_path)
+    }
+    return project_job(project, 'restore', params, 'batch')
+
+def full_render_job(project):
+    """項目只有試聽版音頻時登記補渲染完整音頻的任務並返回任務記錄，否則返回 None
+
+    按用戶角色進入 premium 或 standard 通道，超出配額時拋出 AdmissionRefused
+    """
+    if not is_preview(project.audio_path) or not project.midi_path or missing_files(project.midi_path):
+        return None
+    
+    params = {
+        'project_id': project.id,
+        'style': project.style,
+        'duration': project.duration or 0,
+        'preview': False
+    }
+    return project_job(project, 'render.full', params,
+                       job_runner.scheduler.lane_for(params, True, current_user.role))
+
+def job_pending(start, message, failed_message, accepted=True):
+    """調用 start() 登記任務，任務未完成時返回響應，不需要任務時返回 None
+
+    accepted 為 True 時返回 202 與任務地址（下載與導出），否則返回 503（波形、分段等由播放器請求的資源），
+    都帶 Retry-After；任務失敗（死信）時返回 500 與 failed_message，超出配額時返回準入控制的狀態碼
+    """
+    try:
+        job = start()
+    except AdmissionRefused as e:
+        return jsonify({
+            'status': 'error',
+            'message': e.message
+        }), e.status, {'Retry-After': str(e.retry_after)}
+    if job is None:
+        return None
+    if job.status == GenerationJob.DEAD:
+        return jsonify({
+            'status': 'error',
+            'message': failed_message
+        }), 500
+    
+    headers = {'Retry-After': str(current_app.config.get('RESTORE_RETRY_AFTER', 5))}
+    if not accepted:
+        return jsonify({
+            'status': 'error',
+            'message': message
+        }), 503, headers
+    data = {
+        'status': 'queued',
+        'job_id': job.id,
+        'message': message
+    }
+    if job.user_id == current_user.id:
+        data.update(status_url=url_for('main.job_status', job_id=job.id),
+                    events_url=url_for('main.job_events', job_id=job.id))
+    return jsonify(data), 202, headers
+
+def restore_pending(project, *paths, accepted=True):
+    """文件缺失且正在重新生成時返回響應，文件齊全或無法重新生成時返回 None（由調用方按文件是否存在處理）"""
+    return job_pending(lambda: restore_job(project, *paths),
+                       _('The files of this project are being regenerated, please try again later'),
+                       _('Audio file not found, please regenerate the music'), accepted)
+
+def full_render_pending(project):
+    """只有試聽版音頻的項目在下載或導出前補渲染完整音頻，渲染完成前返回 202，失敗時返回 500"""
+    return job_pending(lambda: full_render_job(project),
+                       _('The full-quality audio is being rendered, please try again later'),
+                       _('The full-quality audio could not be rendered'))
+
+def release_file(path, project_id=None, music_id=None):
+    """刪除不再被其他記錄引用的生成文件及其旁路文件（內容尋址的文件可能被多個項目共用）"""
+    if path and not file_in_use(path, project_id, music_id):
+        remove_artifact(os.path.join(current_app.static_folder, path), current_app.config.get('OPUS_TIERS') or {})
+
+def audio_sidecars(audio_file):
+    """音頻文件及其派生文件（波形峰值、Opus 碼率檔位）"""
+    tiers = current_app.config.get('OPUS_TIERS') or {}
+    return [audio_file, peaks_path_for(audio_file)] + [tier_path(audio_file, tier) for tier in tiers]
+
+def opus_tier(project, negotiate=True):
+    """選擇項目的 Opus 檔位文件：?quality= 指定檔位，Save-Data 時取最低碼率
+
+    negotiate 為 True 時還要求客戶端在 Accept 中明確接受 Opus；沒有合適的檔位時返回 None
+    """
+    if negotiate and not accepts_opus(request.accept_mimetypes):
+        return None
+    audio_file = os.path.join(current_app.static_folder, project.audio_path)
+    tiers = available_tiers(audio_file, current_app.config.get('OPUS_TIERS') or {})
+    save_data = request.headers.get('Save-Data', '').lower() == 'on'
+    tier = choose_tier(tiers, request.args.get('quality'), save_data)
+    return tier[1] if tier else None
+
+def stems_archive(project):
+    """把項目的分軌打包為 ZIP（分軌已是壓縮格式，不再壓縮），打包結果保存在分軌目錄旁供下次直接使用"""
+    result = music_generator.render_stems(project.midi_path, project.audio_path)
+    if result['status'] != 'success' or not result['stems']:
+        current_app.logger.error(f"Stem render failed for project {project.id}: {result.get('message')}")
+        return None
+
+    audio_file = os.path.join(current_app.static_folder, project.audio_path)
+    archive_path = music_generator.stems_dir_for(audio_file) + '.zip'
+    stems = [os.path.join(current_app.static_folder, stem) for stem in result['stems']]
+    # 分軌重新渲染後，舊的壓縮包不再可用
+    if os.path.exists(archive_path) and \
+            os.path.getmtime(archive_path) >= max(os.path.getmtime(stem) for stem in stems):
+        return archive_path
+
+    tmp_path = f"{archive_path}.{os.getpid()}.part"
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for stem in stems:
+                archive.write(stem, os.path.basename(stem))
+        os.replace(tmp_path, archive_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return archive_path
+
+@cache.memoize(timeout=86400)
+def file_etag(path, mtime, size):
+    """文件內容的摘要（按修改時間與大小緩存，文件改變後重新計算）"""
+    return file_digest(path)
+
+def send_artifact(path, **kwargs):
+    """發送生成文件，支持斷點續傳與條件請求
+
+    ETag 為文件內容的摘要（強校驗，可用於 If-Range），Range 請求返回 206，
+    If-None-Match / If-Modified-Since 未變化時返回 304。下載與導出地址不變而內容可能改變
+    （試聽版補渲染為完整音頻、重新生成），所以不長期緩存，瀏覽器每次重新驗證
+    """
+    stat = os.stat(path)
+    response = send_file(path, etag=file_etag(path, stat.st_mtime_ns, stat.st_size), conditional=True, **kwargs)
+    response.accept_ranges = 'bytes'  # 完整響應也聲明，播放器據此判斷可以拖動
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def export_audio(project, format):
+    """返回項目音頻的指定格式文件；與存儲格式不同時轉碼一次並緩存"""
+    audio_file = os.path.join(current_app.static_folder, project.audio_path)
+    if os.path.splitext(audio_file)[1][1:].lower() == format:
+        return audio_file
+    if format == 'opus':
+        # 已隨渲染生成的碼率檔位直接使用
+        tier_file = opus_tier(project, negotiate=False)
+        if tier_file:
+            return tier_file
+    return export_cache.get_or_create(project.id, audio_file, format, audio_converter.convert)
+
 @bp.route('/')
 @bp.route('/index')
 def index():
@@ -37,7 +270,7 @@ def index():
 @bp.route('/create_music', methods=['POST'])
 @login_required
 def create_music():
-    """創建音樂"""
+    """創建音樂：登記生成任務後立即返回任務 ID，生成在後台進行"""
     # 獲取參數
     mode = request.form.get('mode', 'simple')
     style = request.form.get('style', 'pop')
@@ -45,6 +278,8 @@ def create_music():
     duration = float(request.form.get('duration', 60))
     tempo = int(request.form.get('tempo', 120))
     chord_progression = request.form.get('chord_progression', '')
+    preview = request.form.get('preview') == '1'
+    seed = request.form.get('seed') or None
     
     # 驗證參數
     if duration <= 0 or duration > current_app.config['MAX_DURATION']:
@@ -52,43 +287,244 @@ def create_music():
             'status': 'error',
             'message': _('Duration must be between 0 and %(max)d seconds', max=current_app.config['MAX_DURATION'])
         }), 400
+    if seed is not None:
+        try:
+            seed = int(seed)
+        except ValueError:
+            return jsonify({
+                'status': 'error',
+                'message': _('Seed must be an integer')
+            }), 400
     
-    # 生成音樂
-    result = music_generator.generate_music({
+    params = {
         'mode': mode,
         'style': style,
         'mood': mood,
         'duration': duration,
         'tempo': tempo,
-        'chord_progression': chord_progression
-    })
-    
-    if result['status'] == 'success':
-        # 創建新項目
-        project = Project(
-            user_id=current_user.id,
-            title=f"Project {datetime.now().strftime('%Y%m%d_%H%M%S')}",
-            style=style,
-            mood=mood,
-            tempo=tempo,
-            duration=duration,
-            chord_progression=chord_progression,
-            midi_path=result['midi_path'],
-            audio_path=result['audio_path']
-        )
-        db.session.add(project)
-        db.session.commit()
-        
-        return jsonify({
-            'status': 'success',
-            'project_id': project.id,
-            'message': _('Music created successfully')
-        })
-    else:
+        'chord_progression': chord_progression,
+        'preview': preview,
+        'seed': seed
+    }
+    # 準入控制：按估計成本（時長與風格）扣除用戶的生成配額
+    cost = job_runner.scheduler.estimate_cost(params)
+    try:
+        admission.admit(current_user, cost)
+    except AdmissionRefused as e:
         return jsonify({
             'status': 'error',
-            'message': result['message']
-        }), 500
+            'message': e.message
+        }), e.status, {'Retry-After': str(e.retry_after)}
+    
+    # 與執行中的相同請求（參數與種子相同）合併，只生成一次
+    dedupe_key = generation_key(params, 'generate') if current_app.config.get('COALESCE_GENERATIONS') else None
+    job = job_runner.enqueue(current_user.id, params, dedupe_key=dedupe_key,
+                             lane=job_runner.scheduler.lane_for(params, True, current_user.role), cost=cost)
+    
+    return jsonify({
+        'status': 'queued',
+        'job_id': job.id,
+        'status_url': url_for('main.job_status', job_id=job.id),
+        'events_url': url_for('main.job_events', job_id=job.id),
+        'message': _('Music generation started')
+    }), 202
+
+def coalesced_output(job, progress):
+    """跟隨任務：直接使用領頭任務生成的文件（按內容尋址，可以共用），
+    領頭任務失敗或文件已不存在時返回 None"""
+    leader = job_runner.leader_result(job)
+    if not leader:
+        return None
+    for path in (leader['midi_path'], leader['audio_path']):
+        if not os.path.exists(os.path.join(current_app.static_folder, path)):
+            current_app.logger.warning(f'任務 {job.leader_id} 的輸出 {path} 已不存在，改為重新生成')
+            return None
+    progress('coalesced', leader=job.leader_id)
+    return {'midi_path': leader['midi_path'], 'audio_path': leader['audio_path'], 'seed': leader.get('seed')}
+
+def run_generation_job(job, progress):
+    """生成任務：生成音樂並創建項目（項目與任務完成狀態一起提交）"""
+    params = job.get_params()
+    result = coalesced_output(job, progress) or music_generator.generate_music(params, progress)
+    if result.get('status', 'success') != 'success':
+        raise RuntimeError(result['message'])
+    
+    project = Project(
+        user_id=job.user_id,
+        title=f"Project {datetime.now().strftime('%Y%m%d_%H%M%S')}",
+        style=params['style'],
+        mood=params['mood'],
+        tempo=params['tempo'],
+        duration=params['duration'],
+        chord_progression=params['chord_progression'],
+        midi_path=result['midi_path'],
+        audio_path=result['audio_path'],
+        recipe=json.dumps(generation_recipe(params, result['seed']))
+    )
+    db.session.add(project)
+    db.session.flush()
+    return {'project_id': project.id, 'midi_path': result['midi_path'], 'audio_path': result['audio_path'],
+            'seed': result['seed']}
+
+def render_generation_params(params):
+    """渲染任務實際使用的生成參數"""
+    return {
+        'style': 'pop',
+        'mood': 'happy',
+        'duration': params['duration'],
+        'tempo': 120
+    }
+
+def run_render_job(job, progress):
+    """渲染任務：為已有項目生成一段音樂並保存為 MusicFile"""
+    params = job.get_params()
+    result = (coalesced_output(job, progress)
+              or music_generator.generate_music(render_generation_params(params), progress))
+    if result.get('status', 'success') != 'success':
+        raise RuntimeError(result.get('message', '生成音樂時發生錯誤'))
+    
+    music_file = MusicFile(
+        project_id=params['project_id'],
+        prompt=params['prompt'],
+        file_path=result['audio_path'],
+        duration=params['duration'],
+        temperature=params['temperature']
+    )
+    db.session.add(music_file)
+    db.session.flush()
+    return {'project_id': params['project_id'], 'music_id': music_file.id, 'file_path': result['audio_path'],
+            'midi_path': result['midi_path'], 'audio_path': result['audio_path'], 'seed': result['seed']}
+
+def run_restore_job(job, progress):
+    """重新生成任務：按生成配方重新生成項目缺失的文件並更新路徑（與任務完成狀態一起提交）"""
+    project_id = job.get_params()['project_id']
+    project = db.session.get(Project, project_id)
+    if project is None:
+        return {'project_id': None, 'restored': []}
+    
+    result = music_generator.restore(project.get_recipe(), project.midi_path, project.audio_path, progress)
+    if result['status'] != 'success':
+        raise RuntimeError(result['message'])
+    
+    project.midi_path = result['midi_path']
+    project.audio_path = result['audio_path']
+    return {'project_id': project.id, 'midi_path': result['midi_path'], 'audio_path': result['audio_path'],
+            'restored': result['restored']}
+
+def run_full_render_job(job, progress):
+    """補渲染任務：為只有試聽版的項目渲染完整音頻並更新路徑（試聽文件成為孤立文件，由 flask storage gc 回收）"""
+    project_id = job.get_params()['project_id']
+    project = db.session.get(Project, project_id)
+    if project is None:
+        return {'project_id': None, 'audio_path': None}
+    if not is_preview(project.audio_path):
+        return {'project_id': project.id, 'audio_path': project.audio_path}
+    
+    result = music_generator.render_full(project.midi_path, progress)
+    if result['status'] != 'success':
+        raise RuntimeError(result['message'])
+    
+    project.audio_path = result['audio_path']
+    return {'project_id': project.id, 'audio_path': result['audio_path']}
+
+def job_output_path(job):
+    """任務輸出的音頻路徑：完成後取結果，渲染中取 output 進度事件（跟隨任務看領頭任務的事件）"""
+    result = job.get_result()
+    if result and result.get('audio_path'):
+        return result['audio_path']
+    for candidate in (job, db.session.get(GenerationJob, job.leader_id) if job.leader_id else None):
+        if candidate is None:
+            continue
+        for event in reversed(candidate.get_progress()):
+            if event['stage'] == 'output':
+                return event['audio_path']
+    return None
+
+def stream_event(job_id, event):
+    """output 事件附帶渲染期間可播放的分段地址"""
+    if event['stage'] != 'output':
+        return event
+    return dict(event, stream_url=url_for('main.job_segments', job_id=job_id, name=PLAYLIST))
+
+def job_links(data):
+    """為已完成任務的狀態數據加上項目與文件地址，渲染中的任務加上分段播放地址"""
+    if data['status'] == GenerationJob.RUNNING:
+        for event in data.get('progress') or []:
+            if event['stage'] == 'output':
+                data['stream_url'] = stream_event(data['id'], event)['stream_url']
+    if data['status'] == GenerationJob.DONE:
+        data['project_url'] = url_for('main.project_detail', project_id=data['project_id'])
+        if data['result'] and data['result'].get('file_path'):
+            data['file_url'] = url_for('static', filename=data['result']['file_path'])
+    return data
+
+@bp.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    """查詢任務狀態：queued / running / done / dead，完成時附帶結果地址"""
+    job = db.session.get(GenerationJob, job_id)
+    if job is None or job.user_id != current_user.id:
+        abort(404)
+    
+    return jsonify({
+        'status': 'success',
+        'job': job_links(job.to_dict())
+    })
+
+@bp.route('/jobs/<job_id>/events')
+@login_required
+def job_events(job_id):
+    """以 Server-Sent Events 推送任務進度
+
+    每個進度事件（parsing / midi / rendering / encoding 及其百分比、時間戳）作為一條
+    progress 消息發送，id 為事件序號，斷線重連時按 Last-Event-ID 續傳；
+    同一階段的進度更新沿用同一序號。任務結束時發送 done 或 dead 消息後關閉連接。
+    合併到其他任務的請求在等待期間轉發領頭任務的進度（不帶序號）。
+    """
+    job = db.session.get(GenerationJob, job_id)
+    if job is None or job.user_id != current_user.id:
+        abort(404)
+    leader_id = job.leader_id if job.status == GenerationJob.WAITING else None
+    db.session.remove()  # 流式響應期間不佔用數據庫連接
+    
+    try:
+        resume = int(request.headers.get('Last-Event-ID', -1))
+    except ValueError:
+        resume = -1
+    keepalive = current_app.config.get('JOB_EVENTS_KEEPALIVE', 15)
+    
+    def stream():
+        yield "retry: 3000\n\n"
+        if leader_id:
+            forwarded_output = False
+            for snapshot in job_runner.watcher.follow(leader_id, keepalive):
+                if snapshot is None:
+                    yield ": keepalive\n\n"
+                elif snapshot['events'] and snapshot['status'] == GenerationJob.RUNNING:
+                    output = [event for event in snapshot['events'] if event['stage'] == 'output']
+                    if output and not forwarded_output:
+                        forwarded_output = True
+                        yield f"event: progress\ndata: {json.dumps(stream_event(job_id, output[-1]))}\n\n"
+                    yield f"event: progress\ndata: {json.dumps(snapshot['events'][-1])}\n\n"
+        sent = {}
+        for snapshot in job_runner.watcher.follow(job_id, keepalive):
+            if snapshot is None:
+                yield ": keepalive\n\n"
+                continue
+            for index, event in enumerate(snapshot['events']):
+                if index < resume or sent.get(index) == event:
+                    continue
+                sent[index] = event
+                yield f"id: {index}\nevent: progress\ndata: {json.dumps(stream_event(job_id, event))}\n\n"
+            if snapshot['status'] in (GenerationJob.DONE, GenerationJob.DEAD):
+                data = job_links({'id': job_id, **snapshot})
+                data.pop('events')
+                yield f"event: {snapshot['status']}\ndata: {json.dumps(data)}\n\n"
+    
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 關閉反向代理緩衝
+    return response
 
 @bp.route('/projects')
 @login_required
@@ -115,9 +551,143 @@ def project_detail(project_id):
     if project.user_id != current_user.id and not project.is_public:
         abort(403)
     
+    # 已被清理的文件在首次訪問時登記重新生成，頁面顯示等待狀態，完成後重新載入
+    try:
+        restoring = restore_job(project)
+    except AdmissionRefused as e:
+        flash(e.message, 'warning')
+        restoring = None
+    if restoring is not None and restoring.status == GenerationJob.DEAD:
+        flash(_('Audio file not found, please regenerate the music'), 'danger')
+    elif restoring is not None:
+        return render_template('main/project_detail.html',
+                             title=project.title,
+                             project=project,
+                             restoring=restoring,
+                             restore_events_url=url_for('main.job_events', job_id=restoring.id)
+                             if restoring.user_id == current_user.id else None,
+                             restore_retry_after=current_app.config.get('RESTORE_RETRY_AFTER', 5))
+    
+    # 瀏覽器按 <source> 的 type 選擇能播放的格式，Opus 檔位在前
+    opus_file = opus_tier(project, negotiate=False) if project.audio_path else None
+    opus_path = os.path.relpath(opus_file, current_app.static_folder).replace('\\', '/') if opus_file else None
+    
+    # 較長的完整音頻用分段播放，開始播放與拖動都不必等整個文件下載
+    hls_url = None
+    if project.audio_path and current_app.config.get('SEGMENTED_OUTPUT') \
+            and not is_preview(project.audio_path) \
+            and (project.duration or 0) >= current_app.config.get('SEGMENT_MIN_DURATION', 0):
+        hls_url = url_for('main.project_segments', project_id=project.id, name=PLAYLIST)
+    
     return render_template('main/project_detail.html',
                          title=project.title,
-                         project=project)
+                         project=project,
+                         opus_path=opus_path,
+                         opus_mimetype=OPUS_MIMETYPE,
+                         hls_url=hls_url)
+
+@cache.memoize(timeout=3600)
+def waveform_payload(peaks_file, mtime, width):
+    """波形數據：'<If' 點數與每點秒數，隨後是 min/max 交替的 int8"""
+    seconds_per_bin, level = select_level(peaks_file, width)
+    return struct.pack('<If', len(level), seconds_per_bin) + level.tobytes()
+
+@bp.route('/project/<int:project_id>/peaks')
+@login_required
+def project_peaks(project_id):
+    """播放器繪製波形用的峰值數據，按畫布寬度返回合適的精度"""
+    project = Project.query.get_or_404(project_id)
+    
+    # 检查权限
+    if project.user_id != current_user.id and not project.is_public:
+        abort(403)
+    if not project.audio_path:
+        abort(404)
+    
+    pending = restore_pending(project, project.audio_path, accepted=False)
+    if pending is not None:
+        return pending
+    width = max(1, min(request.args.get('width', 1000, type=int), 8192))
+    audio_file = os.path.join(current_app.static_folder, project.audio_path)
+    peaks_file = peaks_path_for(audio_file)
+    try:
+        if not os.path.exists(peaks_file):
+            # 旧项目或缓存命中时没有峰值文件，解码一次补上
+            if not os.path.exists(audio_file):
+                abort(404)
+            compute_peaks(audio_file, peaks_file)
+        mtime = os.path.getmtime(peaks_file)
+        payload = waveform_payload(peaks_file, mtime, width)
+    except (OSError, RuntimeError, ValueError) as e:
+        current_app.logger.error(f"Peaks error for project {project_id}: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+    
+    response = make_response(payload)
+    response.headers['Content-Type'] = 'application/octet-stream'
+    response.headers['Cache-Control'] = 'private, max-age=3600'
+    response.set_etag(f"{int(mtime)}-{width}")
+    return response.make_conditional(request)
+
+SEGMENT_NAME = re.compile(r'^seg_\d+\.ts$')
+
+@bp.route('/project/<int:project_id>/hls/<name>')
+@login_required
+def project_segments(project_id, name):
+    """分段播放：播放列表與音頻段；渲染中時提供已寫出的部分"""
+    project = Project.query.get_or_404(project_id)
+    
+    # 检查权限
+    if project.user_id != current_user.id and not project.is_public:
+        abort(403)
+    if not project.audio_path or (name != PLAYLIST and not SEGMENT_NAME.match(name)):
+        abort(404)
+    
+    pending = restore_pending(project, project.audio_path, accepted=False)
+    if pending is not None:
+        return pending
+    return send_segments(os.path.join(current_app.static_folder, project.audio_path), name)
+
+@bp.route('/jobs/<job_id>/hls/<name>')
+@login_required
+def job_segments(job_id, name):
+    """渲染中的任務：項目在任務完成後才創建，在此之前按任務提供分段，邊渲染邊播放"""
+    job = db.session.get(GenerationJob, job_id)
+    if job is None or job.user_id != current_user.id:
+        abort(404)
+    audio_path = job_output_path(job)
+    if not audio_path or (name != PLAYLIST and not SEGMENT_NAME.match(name)):
+        abort(404)
+    return send_segments(os.path.join(current_app.static_folder, audio_path), name)
+
+def send_segments(audio_file, name):
+    """發送音頻的播放列表或音頻段；渲染中時提供已寫出的部分"""
+    segments_dir = segments_dir_for(audio_file)
+    directory = segments_dir if os.path.exists(os.path.join(segments_dir, PLAYLIST)) else in_progress_dir(segments_dir)
+    if directory is None:
+        # 缓存命中或较早的项目没有分段，后台补做，第一段写出后即可开始播放
+        if not os.path.exists(audio_file):
+            abort(404)
+        directory = segment_audio_file(audio_file, segments_dir,
+                                       bitrate=current_app.config.get('SEGMENT_BITRATE', '128k'),
+                                       segment_seconds=current_app.config.get('SEGMENT_SECONDS', 6))
+        if directory is None:
+            abort(503)
+    
+    if name == PLAYLIST:
+        response = send_from_directory(directory, name, mimetype=PLAYLIST_MIMETYPE, max_age=0)
+        # 未完成的播放列表還會追加新段，播放器需要重新請求
+        response.headers['Cache-Control'] = 'private, max-age=86400' if playlist_complete(directory) \
+            else 'no-cache'
+    else:
+        if not os.path.exists(os.path.join(directory, name)) and os.path.exists(segments_dir):
+            # 请求期间分段刚好完成，临时目录已改名
+            directory = segments_dir
+        response = send_from_directory(directory, name, mimetype=SEGMENT_MIMETYPE, max_age=0)
+        response.headers['Cache-Control'] = 'private, max-age=86400'
+    return response
 
 @bp.route('/project/<int:project_id>/download')
 @login_required
@@ -129,12 +699,26 @@ def download_project(project_id):
     if project.user_id != current_user.id and not project.is_public:
         abort(403)
     
-    # 获取文件路径
-    file_path = os.path.join(current_app.static_folder, project.audio_path)
+    # 缺失的文件先登记重新生成，试听版本再登记补渲染完整音频，完成前都返回 202
+    pending = restore_pending(project, project.audio_path) or full_render_pending(project)
+    if pending is not None:
+        return pending
     
-    return send_file(file_path,
-                    as_attachment=True,
-                    download_name=f"{project.title}.mp3")
+    # 客户端明确接受 Opus 时提供更小的码率档位，否则提供原始音频
+    opus_file = opus_tier(project)
+    if opus_file:
+        response = send_artifact(opus_file,
+                                 mimetype=OPUS_MIMETYPE,
+                                 as_attachment=True,
+                                 download_name=f"{project.title}.opus")
+    else:
+        file_path = os.path.join(current_app.static_folder, project.audio_path)
+        extension = os.path.splitext(project.audio_path)[1] or '.mp3'
+        response = send_artifact(file_path,
+                                 as_attachment=True,
+                                 download_name=f"{project.title}{extension}")
+    response.vary.update(('Accept', 'Save-Data'))
+    return response
 
 @bp.route('/project/<int:project_id>/delete', methods=['DELETE'])
 @login_required
@@ -150,16 +734,10 @@ def delete_project(project_id):
         }), 403
     
     try:
-        # 删除相关文件
-        if project.audio_path:
-            audio_file = os.path.join(current_app.static_folder, project.audio_path)
-            if os.path.exists(audio_file):
-                os.remove(audio_file)
-        
-        if project.midi_path:
-            midi_file = os.path.join(current_app.static_folder, project.midi_path)
-            if os.path.exists(midi_file):
-                os.remove(midi_file)
+        # 删除相关文件（与其他项目共用的文件保留）
+        release_file(project.audio_path, project_id=project.id)
+        release_file(project.midi_path, project_id=project.id)
+        export_cache.drop(project.id)
         
         # 从数据库中删除
         db.session.delete(project)
@@ -186,12 +764,37 @@ def export_project(project_id):
     if project.user_id != current_user.id and not project.is_public:
         abort(403)
     
-    format = request.args.get('format', 'mp3')
-    if format not in ['midi', 'mp3', 'wav']:
+    # 未指定格式时按 Accept 协商：明确接受 Opus 的客户端得到 Opus，否则为 MP3
+    format = request.args.get('format') or ('opus' if accepts_opus(request.accept_mimetypes) else 'mp3')
+    if format not in ['midi', 'stems'] + EXPORT_FORMATS:
         abort(400)
     
     try:
-        if format == 'midi':
+        # 缺失的文件（被清理的音频、丢失的 MIDI）按生成配方登记重新生成，完成前返回 202
+        needed = {'midi': (project.midi_path,), 'stems': (project.midi_path, project.audio_path)}
+        pending = restore_pending(project, *needed.get(format, (project.audio_path,)))
+        if pending is not None:
+            return pending
+        
+        if format == 'stems':
+            if not project.midi_path or not project.audio_path:
+                return jsonify({
+                    'status': 'error',
+                    'message': _('MIDI file not available for this project')
+                }), 404
+            
+            pending = full_render_pending(project)
+            if pending is not None:
+                return pending
+            file_path = stems_archive(project)
+            if file_path is None:
+                return jsonify({
+                    'status': 'error',
+                    'message': _('Stems could not be rendered for this project')
+                }), 500
+            
+            filename = f"{project.title}_stems.zip"
+        elif format == 'midi':
             # 确保midi_path存在
             if not project.midi_path:
                 return jsonify({
@@ -201,9 +804,8 @@ def export_project(project_id):
                 
             file_path = os.path.join(current_app.static_folder, project.midi_path)
             if not os.path.exists(file_path):
-                # 如果MIDI文件不存在，尝试重新创建
-                current_app.logger.warning(f"MIDI file not found: {file_path}, attempting to recreate")
-                # 这里可以添加重新创建MIDI文件的逻辑
+                # 没有生成配方（较早的项目）或引擎版本已变，无法重新生成
+                current_app.logger.warning(f"MIDI file not found: {file_path}")
                 return jsonify({
                     'status': 'error',
                     'message': _('MIDI file not found, please regenerate the music')
@@ -216,6 +818,11 @@ def export_project(project_id):
                     'status': 'error',
                     'message': _('Audio file not available for this project')
                 }), 404
+            
+            # 试听版本在导出前补渲染完整音频
+            pending = full_render_pending(project)
+            if pending is not None:
+                return pending
                 
             file_path = os.path.join(current_app.static_folder, project.audio_path)
             if not os.path.exists(file_path):
@@ -223,15 +830,20 @@ def export_project(project_id):
                     'status': 'error',
                     'message': _('Audio file not found, please regenerate the music')
                 }), 404
-                
+            
+            # 其他格式在首次導出時轉碼，之後直接使用緩存
+            file_path = export_audio(project, format)
             filename = f"{project.title}.{format}"
         
         # 记录导出日志
         current_app.logger.info(f"Exporting project {project_id} as {format}: {file_path}")
         
-        return send_file(file_path,
-                        as_attachment=True,
-                        download_name=filename)
+        response = send_artifact(file_path,
+                                 mimetype=OPUS_MIMETYPE if format == 'opus' else None,
+                                 as_attachment=True,
+                                 download_name=filename)
+        response.vary.add('Accept')
+        return response
     except Exception as e:
         current_app.logger.error(f"Export error for project {project_id}: {str(e)}", exc_info=True)
         return jsonify({
@@ -363,34 +975,30 @@ def generate_music():
         if project.user_id != current_user.id:
             return jsonify({'error': '您沒有權限在此項目中生成音樂'}), 403
         
-        # 生成音樂
-        generator = MusicGenerator()
-        result = generator.generate_music({
-            'style': 'pop',
-            'mood': 'happy',
+        # 登記渲染任務，由工作者生成音樂並保存到項目；與執行中的相同生成合併
+        params = {
+            'project_id': project.id,
+            'prompt': prompt,
             'duration': duration,
-            'tempo': 120
-        })
-        
-        if result['status'] != 'success':
-            return jsonify({'error': result.get('message', '生成音樂時發生錯誤')}), 500
-        
-        # 保存音樂文件
-        music_file = MusicFile(
-            project_id=project_id,
-            prompt=prompt,
-            file_path=result['audio_path'],
-            duration=duration,
-            temperature=temperature
-        )
-        db.session.add(music_file)
-        db.session.commit()
+            'temperature': temperature
+        }
+        cost = job_runner.scheduler.estimate_cost(render_generation_params(params))
+        try:
+            admission.admit(current_user, cost)
+        except AdmissionRefused as e:
+            return jsonify({'error': e.message}), e.status, {'Retry-After': str(e.retry_after)}
+        dedupe_key = None
+        if current_app.config.get('COALESCE_GENERATIONS'):
+            dedupe_key = generation_key(render_generation_params(params), 'render')
+        job = job_runner.enqueue(current_user.id, params, kind='render', dedupe_key=dedupe_key,
+                                 lane=job_runner.scheduler.lane_for(params, True, current_user.role), cost=cost)
         
         return jsonify({
             'success': True,
-            'file_url': url_for('static', filename=result['audio_path']),
-            'music_id': music_file.id
-        })
+            'job_id': job.id,
+            'status_url': url_for('main.job_status', job_id=job.id),
+            'events_url': url_for('main.job_events', job_id=job.id)
+        }), 202
         
     except Exception as e:
         current_app.logger.error(f'生成音樂時發生錯誤: {str(e)}')
@@ -406,10 +1014,8 @@ def delete_music(music_id):
         return jsonify({'error': '您沒有權限刪除此音樂'}), 403
     
     try:
-        # 刪除文件
-        file_path = os.path.join(current_app.static_folder, music.file_path)
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        # 刪除文件（與其他記錄共用的文件保留）
+        release_file(music.file_path, music_id=music.id)
         
         # 刪除數據庫記錄
         db.session.delete(music)
@@ -1,3 +1,5 @@
+import json
+import uuid
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
@@ -46,10 +48,14 @@ class Project(db.Model):
     midi_path = db.Column(db.String(255))
     audio_path = db.Column(db.String(255))
     is_public = db.Column(db.Boolean, default=False)
+    recipe = db.Column(db.Text)  # JSON 格式的生成配方（參數、種子、引擎版本），文件缺失時據此重新生成
     music_files = db.relationship('MusicFile', backref='project', lazy='dynamic')
     
     def __repr__(self):
         return f'<Project {self.title}>'
+    
+    def get_recipe(self):
+        return json.loads(self.recipe) if self.recipe else None
 
 class MusicFile(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -61,4 +67,90 @@ class MusicFile(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def __repr__(self):
-        return f'<MusicFile {self.id}>' 
\ No newline at end of file
+        return f'<MusicFile {self.id}>'
+
+class GenerationJob(db.Model):
+    """後台任務（音樂生成、渲染等），持久化在數據庫中，工作進程重啟後仍會繼續執行
+
+    工作者領取任務時寫入租約（locked_by / locked_until），執行期間定期續約；
+    租約過期的任務會被其他工作者重新領取。失敗後按退避時間重新排隊，
+    超過 max_attempts 次後轉為 dead（死信），保留錯誤信息供人工處理。
+    
+    相同的請求在執行期間只生成一次：領頭任務持有 dedupe_key（唯一，結束時清空），
+    之後的相同請求記錄為 waiting 狀態的跟隨任務（leader_id），領頭任務結束後才可領取。
+    """
+    WAITING = 'waiting'
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    DEAD = 'dead'
+    
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    kind = db.Column(db.String(32), nullable=False, default='generate')
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)  # 系統任務為空
+    status = db.Column(db.String(20), nullable=False, default=QUEUED, index=True)
+    params = db.Column(db.Text, nullable=False)  # JSON 格式的任務參數
+    result = db.Column(db.Text)                  # JSON 格式的執行結果
+    progress = db.Column(db.Text)                # JSON 格式的進度事件列表
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'))
+    dedupe_key = db.Column(db.String(64), unique=True)  # 執行中的領頭任務持有
+    leader_id = db.Column(db.String(32), db.ForeignKey('generation_job.id'), index=True)
+    lane = db.Column(db.String(16), nullable=False, default='standard')  # 調度通道，見 app.scheduler
+    cost = db.Column(db.Float, nullable=False, default=0)  # 估計成本（標準渲染秒數），用於調度與準入控制
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # 在此之前不可領取（重試退避）
+    locked_by = db.Column(db.String(128))
+    locked_until = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, index=True)  # 調度器按最近開始的任務統計各通道用量
+    finished_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_generation_job_claim', 'status', 'available_at'),
+    )
+    
+    def __repr__(self):
+        return f'<GenerationJob {self.id} {self.kind} {self.status}>'
+    
+    def get_params(self):
+        return json.loads(self.params)
+    
+    def get_result(self):
+        return json.loads(self.result) if self.result else None
+    
+    def get_progress(self):
+        return json.loads(self.progress) if self.progress else []
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'lane': self.lane,
+            'status': self.status,
+            'project_id': self.project_id,
+            'leader_id': self.leader_id,
+            'result': self.get_result(),
+            'progress': self.get_progress(),
+            'error': self.error,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'cost': self.cost,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+class RateBucket(db.Model):
+    """準入控制的令牌桶，多個 Web 進程共用
+
+    tokens 為上次更新時的剩餘令牌（成本單位），updated_at 為 Unix 時間戳；
+    讀取時按經過的時間補充，取令牌與補充在同一條 UPDATE 中完成。
+    """
+    key = db.Column(db.String(64), primary_key=True)  # user:<id> 或 role:<角色>
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)
+    
+    def __repr__(self):
+        return f'<RateBucket {self.key} {self.tokens:.1f}>'
@@ -1,5 +1,6 @@
 from .generator import MusicGenerator
 from .converter import AudioConverter
 from .chord_processor import ChordProcessor
+from .render_pool import RenderPool
 
-__all__ = ['MusicGenerator', 'AudioConverter', 'ChordProcessor'] 
\ No newline at end of file
+__all__ = ['MusicGenerator', 'AudioConverter', 'ChordProcessor', 'RenderPool'] 
\ No newline at end of file
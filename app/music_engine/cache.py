@@ -0,0 +1,190 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache:
+    """磁盘文件缓存
+
+    条目按键的前两位分目录存放；写入先落到同目录的临时文件再原子改名，
+    读取时刷新修改时间，总大小超过上限时按最近最少使用的顺序淘汰。
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, key: str, ext: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.{ext}")
+
+    def get(self, key: str, ext: str) -> Optional[str]:
+        """命中时返回缓存文件路径，并把它标记为最近使用"""
+        path = self.path_for(key, ext)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, ext: str, src_path: str) -> str:
+        """把文件放入缓存（原子发布），返回缓存中的路径"""
+        path = self.path_for(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            shutil.copyfile(src_path, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=path)
+        return path
+
+    def copy_to(self, key: str, ext: str, dest_path: str) -> bool:
+        """把缓存条目复制到目标路径，未命中返回 False"""
+        path = self.get(key, ext)
+        if path is None:
+            return False
+        os.makedirs(os.path.dirname(dest_path) or '.', exist_ok=True)
+        tmp_path = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, dest_path)
+        except FileNotFoundError:
+            # 条目恰好在读取时被淘汰
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return True
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith(('.tmp', '.part')):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """淘汰最久未使用的条目直到总大小低于上限，返回释放的字节数；keep 指定的条目不淘汰"""
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            freed = 0
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                freed += size
+            if freed:
+                logger.info(f"缓存 {self.root} 淘汰了 {freed} 字节")
+            return freed
+
+
+class DerivedFileCache(FileCache):
+    """按项目存放的派生文件缓存（例如导出时转码得到的其他格式）
+
+    条目路径为 root/<项目>/<源文件指纹>.<扩展名>，源文件重新渲染后指纹改变，旧条目随之失效。
+    同一条目同时只生成一次，其他请求等待结果；总大小超过上限时整个缓存按 LRU 淘汰。
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        super().__init__(root, max_bytes)
+        self._pending = {}
+
+    @staticmethod
+    def source_key(source_path: str) -> str:
+        st = os.stat(source_path)
+        identity = f"{os.path.abspath(source_path)}:{st.st_size}:{st.st_mtime_ns}"
+        return hashlib.sha256(identity.encode()).hexdigest()[:16]
+
+    def project_dir(self, project_id) -> str:
+        return os.path.join(self.root, str(project_id))
+
+    def get_or_create(self, project_id, source_path: str, ext: str,
+                      produce: Callable[[str, str], None]) -> str:
+        """返回 source_path 的 ext 格式派生文件，不存在时调用 produce(源路径, 目标路径) 生成
+
+        produce 需要原子地写出目标文件
+        """
+        key = self.source_key(source_path)
+        path = os.path.join(self.project_dir(project_id), f"{key}.{ext}")
+        while True:
+            try:
+                os.utime(path)
+                return path
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                event = self._pending.get(path)
+                if event is None:
+                    event = self._pending[path] = threading.Event()
+                    break
+            # 其他线程正在生成同一文件
+            event.wait()
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            produce(source_path, path)
+            self._remove_stale(path, ext)
+        finally:
+            with self._lock:
+                self._pending.pop(path, None)
+            event.set()
+        self.evict(keep=path)
+        return path
+
+    def _remove_stale(self, path: str, ext: str):
+        """删除同一项目中由旧源文件生成的同格式条目"""
+        directory = os.path.dirname(path)
+        for name in os.listdir(directory):
+            stale = os.path.join(directory, name)
+            if name.endswith(f".{ext}") and stale != path:
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+
+    def drop(self, project_id):
+        """删除项目的全部派生文件"""
+        shutil.rmtree(self.project_dir(project_id), ignore_errors=True)
+
+
+def soundfont_identity(path: Optional[str]) -> str:
+    """SoundFont 的身份标识：路径、大小与修改时间（避免每次哈希上百 MB 的文件）"""
+    if not path or not os.path.exists(path):
+        return 'none'
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}:{st.st_size}:{int(st.st_mtime)}"
+
+
+def render_cache_key(midi_path: str, soundfont: Optional[str], **settings) -> str:
+    """渲染缓存键：MIDI 内容 + SoundFont 身份 + 合成与编码参数"""
+    hasher = hashlib.sha256()
+    with open(midi_path, 'rb') as f:
+        hasher.update(f.read())
+    hasher.update(soundfont_identity(soundfont).encode())
+    for name in sorted(settings):
+        hasher.update(f"|{name}={settings[name]}".encode())
+    return hasher.hexdigest()
@@ -1,44 +1,122 @@
+import logging
 import os
-from pydub import AudioSegment
-from typing import Optional
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .encoder import CODECS, LOSSLESS_CODECS, EncoderError, find_ffmpeg
+
+logger = logging.getLogger(__name__)
+
+# 各格式的默認碼率（無損格式不需要）
+DEFAULT_BITRATES = {'mp3': '192k', 'ogg': '160k', 'opus': '128k'}
+
+# 擴展名到編碼格式的對應
+EXTENSIONS = {info['ext']: codec for codec, info in CODECS.items()}
+EXTENSIONS['oga'] = 'ogg'
+
 
 class AudioConverter:
-    """音頻格式轉換器"""
-    
+    """音頻格式轉換器
+
+    所有操作都交給 ffmpeg 子進程以流的方式處理，不把整個文件解碼到內存，
+    因此內存佔用與文件大小無關。裁剪在輸入端定位（-ss），不解碼裁剪點之前的內容。
+    輸出先寫入臨時文件，成功後原子替換到目標路徑；未指定目標路徑時寫在輸入文件旁邊。
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, timeout: Optional[float] = None):
+        self.max_workers = max_workers or min(os.cpu_count() or 1, 4)
+        self.timeout = timeout
+
     @staticmethod
-    def convert_to_mp3(input_path: str, output_path: Optional[str] = None) -> str:
-        """將音頻文件轉換為MP3格式"""
-        if output_path is None:
-            output_path = os.path.splitext(input_path)[0] + '.mp3'
-            
-        audio = AudioSegment.from_file(input_path)
-        audio.export(output_path, format='mp3')
+    def _codec_for(path: str) -> str:
+        ext = os.path.splitext(path)[1][1:].lower()
+        if ext not in EXTENSIONS:
+            raise ValueError(f"不支持的輸出格式: {path}")
+        return EXTENSIONS[ext]
+
+    def _run(self, input_path: str, output_path: str, input_args: List[str] = (),
+             output_args: List[str] = (), bitrate: Optional[str] = None) -> str:
+        """運行 ffmpeg 把 input_path 轉換到 output_path，按擴展名選擇編碼"""
+        ffmpeg = find_ffmpeg()
+        if ffmpeg is None:
+            raise EncoderError("找不到 ffmpeg，無法轉換音頻")
+        if not os.path.exists(input_path):
+            raise FileNotFoundError(input_path)
+        codec = self._codec_for(output_path)
+        info = CODECS[codec]
+
+        cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y',
+               *input_args, '-i', input_path, '-vn', *output_args, '-c:a', info['encoder']]
+        bitrate = bitrate or DEFAULT_BITRATES.get(codec)
+        if bitrate and codec not in LOSSLESS_CODECS:
+            cmd += ['-b:a', str(bitrate)]
+        cmd += info.get('options', [])
+        tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.part"
+        cmd += ['-f', info['format'], tmp_path]
+
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    timeout=self.timeout)
+            if result.returncode != 0:
+                raise EncoderError(f"ffmpeg 轉換失敗 ({result.returncode}): "
+                                   f"{result.stderr.decode(errors='ignore').strip()}")
+            os.replace(tmp_path, output_path)
+        except subprocess.TimeoutExpired:
+            raise EncoderError(f"ffmpeg 轉換超時: {input_path}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
         return output_path
-    
+
     @staticmethod
-    def convert_to_wav(input_path: str, output_path: Optional[str] = None) -> str:
+    def _derived_path(input_path: str, suffix: str, ext: Optional[str] = None) -> str:
+        """在輸入文件旁生成輸出路徑"""
+        base, original_ext = os.path.splitext(input_path)
+        return f"{base}{suffix}{ext or original_ext}"
+
+    def convert(self, input_path: str, output_path: str, bitrate: Optional[str] = None) -> str:
+        """按輸出文件擴展名轉換格式"""
+        return self._run(input_path, output_path, bitrate=bitrate)
+
+    def convert_to_mp3(self, input_path: str, output_path: Optional[str] = None) -> str:
+        """將音頻文件轉換為MP3格式"""
+        return self.convert(input_path, output_path or self._derived_path(input_path, '', '.mp3'))
+
+    def convert_to_wav(self, input_path: str, output_path: Optional[str] = None) -> str:
         """將音頻文件轉換為WAV格式"""
-        if output_path is None:
-            output_path = os.path.splitext(input_path)[0] + '.wav'
-            
-        audio = AudioSegment.from_file(input_path)
-        audio.export(output_path, format='wav')
-        return output_path
-    
-    @staticmethod
-    def adjust_volume(input_path: str, volume_change: float) -> str:
-        """調整音頻音量"""
-        audio = AudioSegment.from_file(input_path)
-        adjusted_audio = audio + volume_change
-        output_path = f"adjusted_{os.path.basename(input_path)}"
-        adjusted_audio.export(output_path, format=os.path.splitext(input_path)[1][1:])
-        return output_path
-    
-    @staticmethod
-    def trim_audio(input_path: str, start_ms: int, end_ms: int) -> str:
-        """裁剪音頻"""
-        audio = AudioSegment.from_file(input_path)
-        trimmed_audio = audio[start_ms:end_ms]
-        output_path = f"trimmed_{os.path.basename(input_path)}"
-        trimmed_audio.export(output_path, format=os.path.splitext(input_path)[1][1:])
-        return output_path 
\ No newline at end of file
+        return self.convert(input_path, output_path or self._derived_path(input_path, '', '.wav'))
+
+    def adjust_volume(self, input_path: str, volume_change: float, output_path: Optional[str] = None) -> str:
+        """調整音頻音量（單位 dB）"""
+        output_path = output_path or self._derived_path(input_path, '_adjusted')
+        return self._run(input_path, output_path, output_args=['-af', f"volume={volume_change}dB"])
+
+    def trim_audio(self, input_path: str, start_ms: int, end_ms: int, output_path: Optional[str] = None) -> str:
+        """裁剪音頻，只解碼 [start_ms, end_ms) 範圍內的內容"""
+        if end_ms <= start_ms:
+            raise ValueError("裁剪結束時間必須大於開始時間")
+        output_path = output_path or self._derived_path(input_path, '_trimmed')
+        return self._run(input_path, output_path,
+                         input_args=['-ss', f"{start_ms / 1000:.3f}"],
+                         output_args=['-t', f"{(end_ms - start_ms) / 1000:.3f}"])
+
+    def convert_batch(self, jobs: Iterable[Tuple[str, str]]) -> Dict[str, object]:
+        """並行轉換多個文件
+
+        jobs 為 [(輸入路徑, 輸出路徑)]，返回 {輸出路徑: 輸出路徑或失敗時的異常}；
+        轉換在 ffmpeg 子進程中進行，線程只負責等待，並行度由 max_workers 控制
+        """
+        jobs = list(jobs)
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='convert') as executor:
+            futures = {executor.submit(self.convert, source, target): target for source, target in jobs}
+            for future, target in futures.items():
+                try:
+                    results[target] = future.result()
+                except Exception as e:
+                    logger.error(f"轉換 {target} 失敗: {str(e)}")
+                    results[target] = e
+        return results
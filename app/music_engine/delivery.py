@@ -0,0 +1,48 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+# 在线播放用的 Opus 码率档位文件：与主音频同名，形如 audio_xxx.low.opus
+
+OPUS_CODEC = 'opus'
+OPUS_MIMETYPE = 'audio/ogg; codecs=opus'
+OPUS_TYPES = ('audio/ogg', 'audio/opus', 'audio/webm')
+
+
+def tier_path(audio_path: str, tier: str) -> str:
+    """主音频某一码率档位的 Opus 文件路径"""
+    return f"{os.path.splitext(audio_path)[0]}.{tier}.opus"
+
+
+def bitrate_kbps(bitrate: str) -> int:
+    return int(str(bitrate).lower().rstrip('k'))
+
+
+def available_tiers(audio_path: str, tiers: Dict[str, str]) -> List[Tuple[str, str]]:
+    """已生成的档位，按码率从低到高返回 [(档位, 路径)]"""
+    existing = [(tier, tier_path(audio_path, tier)) for tier in tiers]
+    existing = [(tier, path) for tier, path in existing if os.path.exists(path)]
+    return sorted(existing, key=lambda item: bitrate_kbps(tiers[item[0]]))
+
+
+def accepts_opus(accept_mimetypes) -> bool:
+    """客户端明确接受 Ogg/Opus，且不比 MP3 差
+
+    只发送 */* 的客户端（例如普通下载）无法判断是否能播放 Opus，仍返回 MP3
+    """
+    explicit = {value.split(';')[0].strip().lower(): quality for value, quality in accept_mimetypes}
+    opus = max(explicit.get(mimetype, 0) for mimetype in OPUS_TYPES)
+    return opus > 0 and opus >= accept_mimetypes['audio/mpeg']
+
+
+def choose_tier(tiers: List[Tuple[str, str]], requested: Optional[str] = None,
+                save_data: bool = False) -> Optional[Tuple[str, str]]:
+    """在已生成的档位中选择：指定档位优先；省流量模式取最低码率；否则取最高码率
+
+    最高档位也远小于 MP3，因此正常网络下按音质选择
+    """
+    if not tiers:
+        return None
+    for tier in tiers:
+        if tier[0] == requested:
+            return tier
+    return tiers[0] if save_data else tiers[-1]
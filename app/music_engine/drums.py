@@ -0,0 +1,187 @@
+import logging
+import os
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pretty_midi
+
+from .looping import overlay, render_clip, write_midi
+
+logger = logging.getLogger(__name__)
+
+# GM 鼓组音符
+KICK = 36      # 底鼓
+SNARE = 38     # 军鼓
+HIHAT = 42     # 闭合击镲
+CRASH = 49     # 碎音镲
+
+# 每种风格与复杂度组合下的节奏型数量
+DRUM_VARIATIONS = 8
+
+GROOVE_PREFIX = 'groove:'
+
+
+def drum_pattern(complexity: float, style: str, variation: int, duration: float) -> List[Tuple[int, int, float, float]]:
+    """生成一小节鼓点，返回 [(音高, 力度, 起始秒, 结束秒)]，时间相对小节开头
+
+    同一 (风格, 复杂度, 变体) 总是得到同一节奏型，随机性只来自变体编号
+    """
+    rng = np.random.RandomState(zlib.crc32(f"{style}:{complexity:.2f}:{variation}".encode()))
+    notes = []
+    beats = int(duration * 2)  # 每拍分成两个子拍
+    for i in range(beats):
+        t = i * duration / beats
+        # 底鼓（在强拍上）
+        if i % 2 == 0 or (complexity > 0.6 and rng.random_sample() < 0.3):
+            notes.append((KICK, 100, t, t + 0.1))
+        # 军鼓（在弱拍上）
+        if i % 2 == 1 or (complexity > 0.7 and rng.random_sample() < 0.2):
+            notes.append((SNARE, 90, t, t + 0.1))
+        # 击镲（根据复杂度添加）
+        if rng.random_sample() < complexity:
+            notes.append((HIHAT, 80, t, t + 0.1))
+        # 在小节开始添加碎音镲
+        if i == 0 and style == 'rhythmic':
+            notes.append((CRASH, 90, t, t + 0.3))
+    return notes
+
+
+def groove_name(style: str, complexity: float, tempo: float, variation: int) -> str:
+    """鼓组音轨名，渲染时据此找到缓存的鼓点小节"""
+    return f"{GROOVE_PREFIX}{style}:{complexity:.2f}:{tempo:.2f}:{variation}"
+
+
+def parse_groove_name(name: str) -> Optional[Tuple[str, float, float, int]]:
+    """解析鼓组音轨名，返回 (风格, 复杂度, 速度, 变体)；不是节奏型音轨时返回 None"""
+    if not name.startswith(GROOVE_PREFIX):
+        return None
+    try:
+        style, complexity, tempo, variation = name[len(GROOVE_PREFIX):].split(':')
+        return style, float(complexity), float(tempo), int(variation)
+    except ValueError:
+        return None
+
+
+class GrooveCache:
+    """已渲染鼓点小节的内存缓存，按总字节数做 LRU 淘汰，渲染线程之间共享
+
+    同一个键同时只渲染一次，其他线程等待结果。
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[Tuple, np.ndarray]' = OrderedDict()
+        self._bytes = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_or_render(self, key: Tuple, render: Callable[[], np.ndarray]) -> np.ndarray:
+        while True:
+            with self._lock:
+                buffer = self._entries.get(key)
+                if buffer is not None:
+                    self._entries.move_to_end(key)
+                    return buffer
+                event = self._pending.get(key)
+                if event is None:
+                    event = self._pending[key] = threading.Event()
+                    break
+            # 其他线程正在渲染同一小节
+            event.wait()
+
+        try:
+            buffer = render()
+            buffer.setflags(write=False)
+            with self._lock:
+                self._entries[key] = buffer
+                self._bytes += buffer.nbytes
+                while self._bytes > self.max_bytes and len(self._entries) > 1:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= evicted.nbytes
+            return buffer
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            event.set()
+
+
+class GrooveRenderer:
+    """鼓点由缓存的小节拼接而成，其余声部交给 base（默认就是 synth）渲染
+
+    识别名称为 groove:... 的鼓组音轨，每条对应一小节，第一个音符（强拍底鼓）就是小节起点。
+    """
+
+    BLOCK_FRAMES = 4096
+
+    def __init__(self, synth, cache: GrooveCache, identity: Tuple, base=None):
+        self.synth = synth
+        self.sample_rate = synth.sample_rate
+        self.cache = cache
+        self.identity = identity
+        self.base = base or synth
+
+    def render_bar(self, notes: Iterable[Tuple[int, int, float, float]], tempo: float,
+                   check: Optional[Callable[[], None]] = None) -> np.ndarray:
+        """把一小节鼓点渲染为带释音尾巴的 PCM"""
+        pm = pretty_midi.PrettyMIDI(initial_tempo=tempo)
+        drums = pretty_midi.Instrument(program=0, is_drum=True)
+        drums.notes = [pretty_midi.Note(velocity, pitch, start, end) for pitch, velocity, start, end in notes]
+        pm.instruments.append(drums)
+        with tempfile.TemporaryDirectory(prefix='groove_') as work_dir:
+            path = os.path.join(work_dir, 'bar.mid')
+            pm.write(path)
+            return render_clip(self.synth, path, check)
+
+    def warm_up(self, combos: Iterable[Tuple[str, float, float]]) -> int:
+        """预先渲染 (风格, 复杂度, 速度) 组合下的所有变体，返回新渲染的小节数"""
+        rendered = 0
+        for style, complexity, tempo in combos:
+            duration = 240.0 / tempo  # 每小节四拍
+            for variation in range(DRUM_VARIATIONS):
+                key = self.identity + (style, round(complexity, 2), round(tempo, 2), variation)
+                if key in self.cache:
+                    continue
+                notes = drum_pattern(complexity, style, variation, duration)
+                self.cache.get_or_render(key, lambda: self.render_bar(notes, tempo))
+                rendered += 1
+        return rendered
+
+    def iter_blocks(self, midi_path: str, check: Optional[Callable[[], None]] = None):
+        pm = pretty_midi.PrettyMIDI(midi_path)
+        grooves, others = [], []
+        for instrument in pm.instruments:
+            groove = parse_groove_name(instrument.name) if instrument.is_drum else None
+            if groove is not None and instrument.notes:
+                grooves.append((groove, instrument))
+            else:
+                others.append(instrument)
+        if not grooves:
+            yield from self.base.iter_blocks(midi_path, check)
+            return
+
+        buffers = {}
+        placements = []
+        for (style, complexity, tempo, variation), instrument in grooves:
+            key = self.identity + (style, round(complexity, 2), round(tempo, 2), variation)
+            start = min(note.start for note in instrument.notes)
+            if key not in buffers:
+                notes = [(n.pitch, n.velocity, n.start - start, n.end - start) for n in instrument.notes]
+                buffers[key] = self.cache.get_or_render(key, lambda: self.render_bar(notes, tempo, check))
+            placements.append((int(start * self.sample_rate), key))
+        placements.sort(key=lambda p: p[0])
+
+        with tempfile.TemporaryDirectory(prefix='groove_') as work_dir:
+            rest_path = os.path.join(work_dir, 'rest.mid')
+            write_midi(pm, others, rest_path)
+            yield from overlay(self.base.iter_blocks(rest_path, check), buffers, placements, self.BLOCK_FRAMES)
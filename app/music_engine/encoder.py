@@ -0,0 +1,264 @@
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import threading
+import wave
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 支持的编码格式：ffmpeg 编码器、容器格式与文件扩展名，options 为额外的编码参数
+CODECS = {
+    'mp3': {'encoder': 'libmp3lame', 'format': 'mp3', 'ext': 'mp3', 'mimetype': 'audio/mpeg'},
+    # libopus 默认复杂度 10 的编码耗时约为 5 的 1.5 倍，音质差别很小
+    'opus': {'encoder': 'libopus', 'format': 'ogg', 'ext': 'opus', 'mimetype': 'audio/ogg',
+             'options': ['-compression_level', '5']},
+    'ogg': {'encoder': 'libvorbis', 'format': 'ogg', 'ext': 'ogg', 'mimetype': 'audio/ogg'},
+    'flac': {'encoder': 'flac', 'format': 'flac', 'ext': 'flac', 'mimetype': 'audio/flac'},
+    'wav': {'encoder': 'pcm_s16le', 'format': 'wav', 'ext': 'wav', 'mimetype': 'audio/wav'},
+}
+
+# 无损格式不需要码率参数
+LOSSLESS_CODECS = {'flac', 'wav'}
+
+PIPE_CHUNK = 64 * 1024
+
+
+class EncoderError(Exception):
+    """音频编码失败"""
+
+
+def find_ffmpeg() -> Optional[str]:
+    """查找 ffmpeg 可执行文件"""
+    path = os.environ.get('FFMPEG_BINARY') or shutil.which('ffmpeg')
+    if path:
+        return path
+    if platform.system() == 'Windows':
+        candidate = os.path.join('C:', os.sep, 'Program Files', 'ffmpeg', 'bin', 'ffmpeg.exe')
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def to_int16(block: np.ndarray) -> np.ndarray:
+    """把 [-1, 1] 范围的 float32 PCM 转换为 int16"""
+    return (np.clip(block, -1.0, 1.0) * 32767.0).astype('<i2')
+
+
+class StreamEncoder:
+    """通过 ffmpeg 子进程流式编码 PCM
+
+    PCM 块（float32，形状为 (帧数, 声道数)）写入 ffmpeg 的 stdin，
+    编码结果从 stdout 读出写到临时文件，完成后原子替换目标文件。
+    内存占用与音频时长无关。
+    """
+
+    def __init__(self, output_path: str, codec: str = 'mp3', bitrate: Optional[str] = '192k',
+                 sample_rate: int = 44100, channels: int = 2):
+        if codec not in CODECS:
+            raise ValueError(f"不支持的编码格式: {codec}")
+        self.output_path = output_path
+        self.codec = codec
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.part"
+        self._proc = None
+        self._reader = None
+        self._stderr = b''
+
+    def _command(self, ffmpeg: str):
+        info = CODECS[self.codec]
+        cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin',
+               '-f', 'f32le', '-ar', str(self.sample_rate), '-ac', str(self.channels),
+               '-i', 'pipe:0', '-c:a', info['encoder']]
+        if self.bitrate and self.codec not in LOSSLESS_CODECS:
+            cmd += ['-b:a', str(self.bitrate)]
+        cmd += info.get('options', [])
+        cmd += ['-f', info['format'], 'pipe:1']
+        return cmd
+
+    def open(self):
+        ffmpeg = find_ffmpeg()
+        if ffmpeg is None:
+            raise EncoderError("找不到 ffmpeg，无法编码音频")
+        os.makedirs(os.path.dirname(self.output_path) or '.', exist_ok=True)
+        self._proc = subprocess.Popen(self._command(ffmpeg), stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # stdout 与 stderr 必须并行读取，否则管道写满会让 ffmpeg 阻塞
+        self._reader = threading.Thread(target=self._drain_stdout, daemon=True)
+        self._reader.start()
+        self._stderr_reader = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_reader.start()
+        return self
+
+    def _drain_stdout(self):
+        with open(self.tmp_path, 'wb') as f:
+            while True:
+                chunk = self._proc.stdout.read(PIPE_CHUNK)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+    def _drain_stderr(self):
+        self._stderr = self._proc.stderr.read()
+
+    def write(self, block: np.ndarray):
+        try:
+            self._proc.stdin.write(np.ascontiguousarray(block, dtype='<f4').tobytes())
+        except BrokenPipeError:
+            raise EncoderError(f"ffmpeg 提前退出: {self._stderr.decode(errors='ignore')}")
+
+    def finish(self):
+        """结束输入并等待编码完成，结果仍在临时文件中"""
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self._proc.wait()
+        self._reader.join()
+        self._stderr_reader.join()
+        if returncode != 0:
+            self._discard()
+            raise EncoderError(f"ffmpeg 编码失败 ({returncode}): {self._stderr.decode(errors='ignore').strip()}")
+
+    def publish(self):
+        """把编码结果原子替换为目标文件"""
+        os.replace(self.tmp_path, self.output_path)
+
+    def close(self):
+        """结束输入并等待编码完成，成功后发布目标文件"""
+        self.finish()
+        self.publish()
+
+    def abort(self):
+        """中止编码并删除临时文件"""
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        if self._reader is not None:
+            self._reader.join()
+            self._stderr_reader.join()
+        self._discard()
+
+    def _discard(self):
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class WavStreamWriter:
+    """没有 ffmpeg 时的后备方案：直接流式写入 WAV"""
+
+    def __init__(self, output_path: str, sample_rate: int = 44100, channels: int = 2):
+        self.output_path = output_path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.part"
+        self._wav = None
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.output_path) or '.', exist_ok=True)
+        self._wav = wave.open(self.tmp_path, 'wb')
+        self._wav.setnchannels(self.channels)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(self.sample_rate)
+        return self
+
+    def write(self, block: np.ndarray):
+        self._wav.writeframes(to_int16(block).tobytes())
+
+    def finish(self):
+        self._wav.close()
+
+    def publish(self):
+        os.replace(self.tmp_path, self.output_path)
+
+    def close(self):
+        self.finish()
+        self.publish()
+
+    def abort(self):
+        if self._wav is not None:
+            self._wav.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def available_codec(codec: str) -> str:
+    """实际可用的编码格式：没有 ffmpeg 时只能写 WAV
+
+    调用方据此决定文件扩展名（以及缓存键），不会把 WAV 数据写到 .mp3 等文件名下
+    """
+    if codec != 'wav' and find_ffmpeg() is None:
+        logger.warning(f"找不到 ffmpeg，改用 WAV 代替 {codec}")
+        return 'wav'
+    return codec
+
+
+def open_encoder(output_path: str, codec: str = 'mp3', bitrate: Optional[str] = '192k',
+                 sample_rate: int = 44100, channels: int = 2):
+    """创建编码器；WAV 直接写入，其他格式需要 ffmpeg（先用 available_codec() 选择格式）"""
+    if codec == 'wav':
+        return WavStreamWriter(output_path, sample_rate, channels)
+    if find_ffmpeg() is None:
+        raise EncoderError(f"找不到 ffmpeg，无法编码为 {codec}: {output_path}")
+    return StreamEncoder(output_path, codec, bitrate, sample_rate, channels)
+
+
+def encode_blocks(blocks: Iterable[np.ndarray], output_path: str, codec: str = 'mp3',
+                  bitrate: Optional[str] = '192k', sample_rate: int = 44100, channels: int = 2) -> str:
+    """把 PCM 块流式编码到目标文件"""
+    with open_encoder(output_path, codec, bitrate, sample_rate, channels) as encoder:
+        for block in blocks:
+            encoder.write(block)
+    return output_path
+
+
+def encode_blocks_multi(blocks: Iterable[np.ndarray], targets: List[Dict], sample_rate: int = 44100,
+                        channels: int = 2) -> List[str]:
+    """把同一 PCM 流同时编码为多个文件（每个目标一个 ffmpeg 进程，并行编码）
+
+    targets 为 [{'path': ..., 'codec': ..., 'bitrate': ...}]，也可以用 {'path': ..., 'encoder': ...}
+    直接给出未打开的编码器（例如分段编码器）。所有编码器都完成后才按 targets 的顺序发布，
+    任一编码失败时全部放弃，不会只发布其中一部分
+    """
+    encoders = []
+    try:
+        for target in targets:
+            encoder = target.get('encoder') or open_encoder(
+                target['path'], target['codec'], target.get('bitrate'), sample_rate, channels)
+            encoders.append(encoder.open())
+        for block in blocks:
+            for encoder in encoders:
+                encoder.write(block)
+        for encoder in encoders:
+            encoder.finish()
+    except BaseException:
+        for encoder in encoders:
+            encoder.abort()
+        raise
+    for encoder in encoders:
+        encoder.publish()
+    return [target['path'] for target in targets]
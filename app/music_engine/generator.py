@@ -1,23 +1,438 @@
 import numpy as np
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
 import pretty_midi
 from midi2audio import FluidSynth
 import os
+import hashlib
+import json
+import shutil
+import tempfile
 import logging
 import subprocess
 import platform
-from datetime import datetime
+import secrets
+import threading
+from .synth import FluidSynthEngine, FluidSynthCliEngine
+from .wavetable import WavetableSynth
+from .encoder import CODECS, available_codec, encode_blocks_multi, find_ffmpeg
+from .delivery import OPUS_CODEC, tier_path
+from .cache import render_cache_key
+from .pipeline import limit_duration, report_progress, to_mono, decimate
+from .mastering import master
+from .peaks import PeakRecorder, peaks_path_for
+from .segments import SegmentedEncoder, playlist_complete, segments_dir_for
+from .mixdown import DEFAULT_MIX, TrackRenderer, iter_mix
+from .looping import LoopRenderer
+from .drums import DRUM_VARIATIONS, GrooveCache, GrooveRenderer, drum_pattern, groove_name
+from .render_pool import PRIORITY_HIGH, PRIORITY_NORMAL
+from .storage import ArtifactStore
 
 # 设置日志
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# 各风格使用的乐器（GM 音色号）与节奏设置
+STYLE_SETTINGS = {
+    'pop': {
+        'melody': 0,    # Acoustic Grand Piano
+        'chord': 48,    # String Ensemble
+        'bass': 32,     # Acoustic Bass
+        'drums': True,  # 使用鼓点
+        'rhythm_complexity': 0.5
+    },
+    'rock': {
+        'melody': 29,   # Overdriven Guitar
+        'chord': 30,    # Distortion Guitar
+        'bass': 33,     # Electric Bass
+        'drums': True,
+        'rhythm_complexity': 0.8
+    },
+    'classical': {
+        'melody': 0,    # Acoustic Grand Piano
+        'chord': 48,    # String Ensemble
+        'bass': 43,     # Contrabass
+        'drums': False,
+        'rhythm_complexity': 0.3
+    },
+    'electronic': {
+        'melody': 81,   # Synth Lead
+        'chord': 51,    # Synth Strings
+        'bass': 39,     # Synth Bass
+        'drums': True,
+        'rhythm_complexity': 0.7
+    },
+    'jazz': {
+        'melody': 66,   # Alto Sax
+        'chord': 0,     # Acoustic Piano
+        'bass': 32,     # Acoustic Bass
+        'drums': True,
+        'rhythm_complexity': 0.6
+    }
+}
+
+# 各情绪对应的调式、力度、速度与伴奏方式
+MOOD_SETTINGS = {
+    'happy': {
+        'scale': 'major',
+        'velocity_main': 90,
+        'velocity_bass': 100,
+        'velocity_chord': 80,
+        'octave_shift': 0,
+        'note_length': 0.8,
+        'tempo_adjust': 1.0,
+        'chord_style': 'normal',
+        'decoration_prob': 0.3,
+        'melody_pattern': 'active'
+    },
+    'sad': {
+        'scale': 'minor',
+        'velocity_main': 70,
+        'velocity_bass': 85,
+        'velocity_chord': 65,
+        'octave_shift': -1,
+        'note_length': 0.9,
+        'tempo_adjust': 0.8,
+        'chord_style': 'spread',
+        'decoration_prob': 0.15,
+        'melody_pattern': 'flowing'
+    },
+    'energetic': {
+        'scale': 'major',
+        'velocity_main': 100,
+        'velocity_bass': 110,
+        'velocity_chord': 90,
+        'octave_shift': 0,
+        'note_length': 0.7,
+        'tempo_adjust': 1.2,
+        'chord_style': 'rhythmic',
+        'decoration_prob': 0.4,
+        'melody_pattern': 'rhythmic'
+    },
+    'calm': {
+        'scale': 'major',
+        'velocity_main': 65,
+        'velocity_bass': 75,
+        'velocity_chord': 60,
+        'octave_shift': -1,
+        'note_length': 1.0,
+        'tempo_adjust': 0.7,
+        'chord_style': 'arpeggiated',
+        'decoration_prob': 0.1,
+        'melody_pattern': 'smooth'
+    },
+    'romantic': {
+        'scale': 'major',
+        'velocity_main': 80,
+        'velocity_bass': 85,
+        'velocity_chord': 75,
+        'octave_shift': 0,
+        'note_length': 0.9,
+        'tempo_adjust': 0.9,
+        'chord_style': 'arpeggiated',
+        'decoration_prob': 0.25,
+        'melody_pattern': 'flowing'
+    },
+    'mysterious': {
+        'scale': 'minor',
+        'velocity_main': 75,
+        'velocity_bass': 85,
+        'velocity_chord': 70,
+        'octave_shift': -1,
+        'note_length': 0.85,
+        'tempo_adjust': 0.75,
+        'chord_style': 'sparse',
+        'decoration_prob': 0.2,
+        'melody_pattern': 'staccato'
+    },
+    'dramatic': {
+        'scale': 'minor',
+        'velocity_main': 95,
+        'velocity_bass': 105,
+        'velocity_chord': 90,
+        'octave_shift': 0,
+        'note_length': 0.8,
+        'tempo_adjust': 1.0,
+        'chord_style': 'full',
+        'decoration_prob': 0.3,
+        'melody_pattern': 'dramatic'
+    },
+    'peaceful': {
+        'scale': 'major',
+        'velocity_main': 60,
+        'velocity_bass': 70,
+        'velocity_chord': 55,
+        'octave_shift': -1,
+        'note_length': 1.1,
+        'tempo_adjust': 0.6,
+        'chord_style': 'arpeggiated',
+        'decoration_prob': 0.05,
+        'melody_pattern': 'smooth'
+    },
+    'nostalgic': {
+        'scale': 'major',
+        'velocity_main': 70,
+        'velocity_bass': 80,
+        'velocity_chord': 65,
+        'octave_shift': 0,
+        'note_length': 0.85,
+        'tempo_adjust': 0.8,
+        'chord_style': 'normal',
+        'decoration_prob': 0.2,
+        'melody_pattern': 'reflective'
+    },
+    'dreamy': {
+        'scale': 'major',
+        'velocity_main': 65,
+        'velocity_bass': 75,
+        'velocity_chord': 60,
+        'octave_shift': 0,
+        'note_length': 0.95,
+        'tempo_adjust': 0.75,
+        'chord_style': 'arpeggiated',
+        'decoration_prob': 0.15,
+        'melody_pattern': 'floating'
+    },
+    'passionate': {
+        'scale': 'minor',
+        'velocity_main': 100,
+        'velocity_bass': 110,
+        'velocity_chord': 95,
+        'octave_shift': 0,
+        'note_length': 0.8,
+        'tempo_adjust': 1.1,
+        'chord_style': 'rhythmic',
+        'decoration_prob': 0.35,
+        'melody_pattern': 'intense'
+    },
+    'melancholic': {
+        'scale': 'minor',
+        'velocity_main': 65,
+        'velocity_bass': 75,
+        'velocity_chord': 60,
+        'octave_shift': -1,
+        'note_length': 0.9,
+        'tempo_adjust': 0.7,
+        'chord_style': 'sparse',
+        'decoration_prob': 0.1,
+        'melody_pattern': 'flowing'
+    },
+    'epic': {
+        'scale': 'minor',
+        'velocity_main': 110,
+        'velocity_bass': 120,
+        'velocity_chord': 100,
+        'octave_shift': 0,
+        'note_length': 0.85,
+        'tempo_adjust': 1.0,
+        'chord_style': 'full',
+        'decoration_prob': 0.4,
+        'melody_pattern': 'heroic'
+    },
+    'playful': {
+        'scale': 'major',
+        'velocity_main': 85,
+        'velocity_bass': 90,
+        'velocity_chord': 80,
+        'octave_shift': 1,
+        'note_length': 0.7,
+        'tempo_adjust': 1.1,
+        'chord_style': 'staccato',
+        'decoration_prob': 0.45,
+        'melody_pattern': 'bouncy'
+    },
+    'dark': {
+        'scale': 'minor',
+        'velocity_main': 80,
+        'velocity_bass': 90,
+        'velocity_chord': 75,
+        'octave_shift': -2,
+        'note_length': 0.9,
+        'tempo_adjust': 0.85,
+        'chord_style': 'sparse',
+        'decoration_prob': 0.2,
+        'melody_pattern': 'haunting'
+    },
+    'hopeful': {
+        'scale': 'major',
+        'velocity_main': 85,
+        'velocity_bass': 90,
+        'velocity_chord': 80,
+        'octave_shift': 0,
+        'note_length': 0.85,
+        'tempo_adjust': 0.9,
+        'chord_style': 'normal',
+        'decoration_prob': 0.25,
+        'melody_pattern': 'uplifting'
+    },
+    'tense': {
+        'scale': 'minor',
+        'velocity_main': 85,
+        'velocity_bass': 95,
+        'velocity_chord': 80,
+        'octave_shift': -1,
+        'note_length': 0.75,
+        'tempo_adjust': 1.05,
+        'chord_style': 'dissonant',
+        'decoration_prob': 0.3,
+        'melody_pattern': 'suspenseful'
+    },
+    'ethereal': {
+        'scale': 'major',
+        'velocity_main': 60,
+        'velocity_bass': 70,
+        'velocity_chord': 55,
+        'octave_shift': 1,
+        'note_length': 1.2,
+        'tempo_adjust': 0.65,
+        'chord_style': 'arpeggiated',
+        'decoration_prob': 0.15,
+        'melody_pattern': 'floating'
+    },
+    'whimsical': {
+        'scale': 'major',
+        'velocity_main': 80,
+        'velocity_bass': 85,
+        'velocity_chord': 75,
+        'octave_shift': 1,
+        'note_length': 0.75,
+        'tempo_adjust': 1.0,
+        'chord_style': 'playful',
+        'decoration_prob': 0.5,
+        'melody_pattern': 'quirky'
+    },
+    'aggressive': {
+        'scale': 'minor',
+        'velocity_main': 115,
+        'velocity_bass': 125,
+        'velocity_chord': 110,
+        'octave_shift': 0,
+        'note_length': 0.7,
+        'tempo_adjust': 1.3,
+        'chord_style': 'percussive',
+        'decoration_prob': 0.3,
+        'melody_pattern': 'intense'
+    },
+    'triumphant': {
+        'scale': 'major',
+        'velocity_main': 105,
+        'velocity_bass': 115,
+        'velocity_chord': 100,
+        'octave_shift': 0,
+        'note_length': 0.85,
+        'tempo_adjust': 1.1,
+        'chord_style': 'full',
+        'decoration_prob': 0.35,
+        'melody_pattern': 'victorious'
+    },
+    'majestic': {
+        'scale': 'major',
+        'velocity_main': 100,
+        'velocity_bass': 110,
+        'velocity_chord': 95,
+        'octave_shift': 0,
+        'note_length': 0.9,
+        'tempo_adjust': 0.95,
+        'chord_style': 'full',
+        'decoration_prob': 0.25,
+        'melody_pattern': 'regal'
+    }
+}
+
+
+def canonical_params(params: Dict) -> Dict:
+    """只保留影响生成结果的参数，并统一类型与写法
+
+    表单提交的 '120' 与 120、'Pop ' 与 'pop'、和弦之间多余的空白都视为相同；
+    未指定种子时为 None
+    """
+    seed = params.get('seed')
+    return {
+        'style': str(params.get('style', 'pop')).strip().lower(),
+        'mood': str(params.get('mood', 'happy')).strip().lower(),
+        'tempo': round(float(params.get('tempo', 120)), 3),
+        'duration': round(float(params.get('duration', 60)), 3),
+        'chord_progression': ' '.join(str(params.get('chord_progression') or '').split()),
+        'preview': bool(params.get('preview')),
+        'seed': None if seed in (None, '') else int(seed),
+    }
+
+
+# 生成引擎版本：修改会改变相同参数与种子所生成 MIDI 的代码（和声、旋律、节奏、配器）时递增，
+# 按旧版本配方重新生成得不到原来的音乐
+ENGINE_VERSION = 1
+
+# 决定 MIDI 内容的生成参数（再加上种子与引擎版本即为项目的生成配方）
+RECIPE_FIELDS = ('style', 'mood', 'tempo', 'duration', 'chord_progression', 'preview')
+
+
+def generation_recipe(params: Dict, seed: int) -> Dict:
+    """生成配方：原样保存的生成参数、实际使用的种子与引擎版本，据此可以重新生成相同的 MIDI"""
+    recipe = {field: params[field] for field in RECIPE_FIELDS if field in params}
+    recipe.update(seed=int(seed), engine=ENGINE_VERSION)
+    return recipe
+
+
+def generation_key(params: Dict, scope: str = '') -> str:
+    """相同生成请求的合并键：规范化参数（含种子）的哈希，scope 区分不同用途的任务"""
+    payload = json.dumps(canonical_params(params), sort_keys=True)
+    return hashlib.sha256(f"{scope}|{payload}".encode()).hexdigest()
+
+
 class MusicGenerator:
-    def __init__(self):
+    def __init__(self, render_pool=None):
         logger.debug("初始化 MusicGenerator")
         
-        # 创建输出目录
-        self.output_dir = os.path.join('app', 'static', 'generated')
+        # 渲染池：设置后音频渲染交给常驻工作线程，否则在当前线程内渲染
+        self.render_pool = render_pool
+        if render_pool is not None:
+            render_pool.set_synth_factory(self._create_synth, warmup=self._warm_up)
+        self._synth = None
+        
+        # 音频编码设置（可通过 configure 从应用配置覆盖）
+        self.sample_rate = 44100
+        self.synth_gain = 0.5
+        self.synth_backend = 'auto'  # auto：有 FluidSynth 用 FluidSynth，否则用波表合成器
+        self._fluidsynth_failed = False
+        # 已确认可以加载的音色库（FluidSynth 是否可用要实际创建一次合成器才知道）
+        self._fluidsynth_checked = None
+        self._backend_lock = threading.Lock()
+        self.audio_codec = 'mp3'
+        self.audio_bitrate = '192k'
+        
+        # 试听档位：只渲染开头一段，单声道、降采样、低码率
+        self.preview_seconds = 30
+        self.preview_sample_rate = 22050
+        self.preview_codec = 'mp3'
+        self.preview_bitrate = '48k'
+        
+        # 渲染模式：single 一次合成整首；tracks 各音轨分进程合成后混音，并保留分轨
+        self.render_mode = 'single'
+        self.track_mix = {name: dict(settings) for name, settings in DEFAULT_MIX.items()}
+        self.stem_codec = 'flac'
+        self.track_renderer = None
+        
+        # 循环感知渲染：重复的小节只合成一次再叠加（None 表示关闭，否则为判定重复的时间容差，秒）
+        self.loop_tolerance = 0.005
+        
+        # 母带处理：响度归一化到目标 LUFS 并限制真峰值（None 表示关闭）
+        self.mastering = {'target_lufs': -14.0, 'ceiling_db': -1.0, 'lookahead': 3.0}
+        
+        # 在线播放用的 Opus 码率档位 {档位: 码率}，与完整音频一起编码（为空则不生成）
+        self.opus_tiers = {}
+        
+        # 分段输出（HLS）：完整音频同时切成固定时长的段并生成播放列表（None 表示关闭）
+        self.segments = {'seconds': 6.0, 'bitrate': '128k'}
+        
+        # 已渲染鼓点小节的缓存，渲染线程启动时按 drum_warmup 预热常用组合
+        self.groove_cache = GrooveCache()
+        self.drum_warmup = []
+        
+        # 只含生成器所用音色的精简音色库（flask soundfont subset 生成），存在时优先使用
+        self.subset_soundfont = None
+        
+        # 生成文件按内容摘要命名并分目录存放（app/static/generated/ab/cd/...）
+        self.storage = ArtifactStore()
+        self.output_dir = self.storage.root
         os.makedirs(self.output_dir, exist_ok=True)
         
         # 检查 FluidSynth
@@ -102,44 +517,196 @@ class MusicGenerator:
         self._current_soundfont = None
         return None
     
-    def generate_music(self, params: Dict) -> Dict:
+    def configure(self, config):
+        """从应用配置读取音频输出设置"""
+        self.sample_rate = config.get('AUDIO_SAMPLE_RATE', self.sample_rate)
+        self.synth_gain = config.get('SYNTH_GAIN', self.synth_gain)
+        self.synth_backend = config.get('SYNTH_BACKEND', self.synth_backend)
+        self.audio_codec = config.get('AUDIO_CODEC', self.audio_codec)
+        self.audio_bitrate = config.get('AUDIO_BITRATE', self.audio_bitrate)
+        if self.audio_codec not in CODECS:
+            logger.warning(f"不支持的音频编码 {self.audio_codec}，改用 mp3")
+            self.audio_codec = 'mp3'
+        self.preview_seconds = config.get('PREVIEW_SECONDS', self.preview_seconds)
+        self.preview_sample_rate = config.get('PREVIEW_SAMPLE_RATE', self.preview_sample_rate)
+        if self.sample_rate % self.preview_sample_rate:
+            # 降采样只支持整数倍，改用最接近的整数倍采样率
+            factor = max(1, round(self.sample_rate / self.preview_sample_rate))
+            logger.warning(f"试听采样率 {self.preview_sample_rate} 不是 {self.sample_rate} 的整数分之一，"
+                           f"改用 {self.sample_rate // factor}")
+            self.preview_sample_rate = self.sample_rate // factor
+        self.preview_codec = config.get('PREVIEW_CODEC', self.preview_codec)
+        self.preview_bitrate = config.get('PREVIEW_BITRATE', self.preview_bitrate)
+        self.render_mode = config.get('RENDER_MODE', self.render_mode)
+        self.loop_tolerance = config.get('LOOP_RENDER_TOLERANCE', self.loop_tolerance) \
+            if config.get('LOOP_RENDER', True) else None
+        for name, settings in (config.get('TRACK_MIX') or {}).items():
+            self.track_mix.setdefault(name, {}).update(settings)
+        self.stem_codec = config.get('STEM_CODEC', self.stem_codec)
+        self.mastering = {
+            'target_lufs': config.get('TARGET_LUFS', -14.0),
+            'ceiling_db': config.get('TRUE_PEAK_CEILING_DB', -1.0),
+            'lookahead': config.get('MASTERING_LOOKAHEAD', 3.0),
+        } if config.get('MASTERING', True) else None
+        self.opus_tiers = dict(config.get('OPUS_TIERS') or {})
+        self.segments = {
+            'seconds': config.get('SEGMENT_SECONDS', 6.0),
+            'bitrate': config.get('SEGMENT_BITRATE', '128k'),
+        } if config.get('SEGMENTED_OUTPUT', True) else None
+        self.track_renderer = TrackRenderer(config.get('TRACK_RENDER_PROCESSES'))
+        self.groove_cache.max_bytes = config.get('DRUM_CACHE_MAX_BYTES', self.groove_cache.max_bytes)
+        self.drum_warmup = config.get('DRUM_WARMUP', self.drum_warmup)
+        subset = config.get('SOUNDFONT_SUBSET')
+        self.subset_soundfont = subset if subset and os.path.exists(subset) else None
+    
+    def _render_profile(self, preview: bool = False) -> Dict:
+        """返回渲染档位对应的输出参数"""
+        if preview:
+            # 试听只合成开头一段，整体合成更快，不使用分音轨模式
+            return {
+                'sample_rate': self.preview_sample_rate,
+                'channels': 1,
+                'codec': available_codec(self.preview_codec),
+                'bitrate': self.preview_bitrate,
+                'max_seconds': self.preview_seconds,
+                'mode': 'single',
+                'loop_tolerance': self.loop_tolerance,
+                'mastering': json.dumps(self.mastering, sort_keys=True),
+            }
+        has_ffmpeg = find_ffmpeg() is not None
+        profile = {
+            'sample_rate': self.sample_rate,
+            'channels': 2,
+            'codec': available_codec(self.audio_codec),
+            'bitrate': self.audio_bitrate,
+            'max_seconds': None,
+            'mode': self.render_mode,
+            'loop_tolerance': self.loop_tolerance,
+            'mastering': json.dumps(self.mastering, sort_keys=True),
+            # Opus 档位与 HLS 分段都需要 ffmpeg，没有时不生成（也不计入渲染输入的摘要）
+            'opus_tiers': json.dumps(self.opus_tiers if has_ffmpeg else {}, sort_keys=True),
+            'segments': json.dumps(self.segments if has_ffmpeg else None, sort_keys=True),
+        }
+        if self.render_mode == 'tracks':
+            profile['mix'] = json.dumps(self.track_mix, sort_keys=True)
+        return profile
+    
+    def _synth_soundfont(self) -> Optional[str]:
+        """合成器加载的音色库：优先使用精简音色库"""
+        return self.subset_soundfont or getattr(self, '_current_soundfont', None)
+    
+    def _backend(self) -> str:
+        """当前实际使用的合成后端：fluidsynth 或 wavetable
+
+        渲染输入的摘要（音频的存储地址）包含后端，因此第一次用到时就确认 FluidSynth 能否创建，
+        不能等渲染时才回退到波表合成器
+        """
+        if self.synth_backend == 'wavetable' or self._fluidsynth_failed:
+            return 'wavetable'
+        soundfont = self._synth_soundfont()
+        if not soundfont or not soundfont.endswith('.sf2'):
+            return 'wavetable'
+        if self._fluidsynth_checked != soundfont:
+            with self._backend_lock:
+                if self._fluidsynth_checked != soundfont and not self._fluidsynth_failed:
+                    synth = self._create_fluidsynth(soundfont)
+                    if synth is None:
+                        self._fluidsynth_failed = True
+                        return 'wavetable'
+                    if self.render_pool is None and self._synth is None:
+                        self._synth = synth
+                    self._fluidsynth_checked = soundfont
+        return 'wavetable' if self._fluidsynth_failed else 'fluidsynth'
+    
+    def _create_fluidsynth(self, soundfont: str):
+        """优先创建常驻内存的 FluidSynth，其次是命令行 FluidSynth，都不可用时返回 None"""
+        for engine in (FluidSynthEngine, FluidSynthCliEngine):
+            try:
+                return engine(soundfont, self.sample_rate, self.synth_gain)
+            except Exception as e:
+                logger.warning(f"无法创建 {engine.__name__}: {str(e)}")
+        return None
+    
+    def _create_synth(self):
+        """创建合成器，优先使用常驻内存的 FluidSynth，其次是命令行 FluidSynth，
+        都不可用时（或 SoundFont 是 JS 格式）使用纯 NumPy 的波表合成器"""
+        if self._backend() == 'fluidsynth':
+            synth = self._create_fluidsynth(self._synth_soundfont())
+            if synth is not None:
+                return synth
+            self._fluidsynth_failed = True
+        logger.info("使用波表合成器渲染音频")
+        return WavetableSynth(self.sample_rate, self.synth_gain)
+    
+    def _groove_identity(self) -> tuple:
+        """鼓点缓存中区分不同合成设置的键前缀"""
+        return (self._backend(), self._synth_soundfont(), self.sample_rate, self.synth_gain)
+    
+    def _groove_combos(self) -> List[tuple]:
+        """把 drum_warmup 中的 (风格, 情绪, 速度) 换算为鼓点的 (节奏风格, 复杂度, 实际速度)"""
+        combos = []
+        for item in self.drum_warmup:
+            style_config = STYLE_SETTINGS.get(item['style'], STYLE_SETTINGS['pop'])
+            if not style_config['drums']:
+                continue
+            mood = MOOD_SETTINGS.get(item['mood'], MOOD_SETTINGS['happy'])
+            tempo = float(item.get('tempo', 120)) * mood['tempo_adjust']
+            combos.append((mood['chord_style'], style_config['rhythm_complexity'], tempo))
+        return combos
+    
+    def _warm_up(self, synth):
+        """渲染线程启动时预先渲染常用的鼓点小节"""
+        renderer = GrooveRenderer(synth, self.groove_cache, self._groove_identity())
+        rendered = renderer.warm_up(self._groove_combos())
+        if rendered:
+            logger.info(f"鼓点缓存预热完成: 新渲染 {rendered} 个小节，共 {len(self.groove_cache)} 个")
+    
+    def generate_music(self, params: Dict, progress: Optional[Callable] = None) -> Dict:
         """
-        根据输入参数生成音乐
+        根据输入参数生成音乐，progress(阶段, **信息) 接收各阶段的进度
+        （parsing、midi 已生成小节数、rendering 百分比、encoding）
         params: {
             'style': str,
             'mood': str,
             'duration': float,
             'chord_progression': str,
-            'tempo': int
+            'tempo': int,
+            'preview': bool,  # 只渲染快速试听版本，完整音频稍后按需渲染
+            'seed': int       # 随机种子，未指定时随机选择；结果中返回实际使用的种子
         }
         """
         logger.debug(f"开始生成音乐，参数: {params}")
         try:
-            # 生成文件名
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            midi_filename = f"midi_{timestamp}.mid"
-            audio_filename = f"audio_{timestamp}.mp3"
+            if progress is not None:
+                progress('parsing')
+            seed = params.get('seed')
+            params = dict(params, seed=int(seed) if seed not in (None, '') else secrets.randbits(31))
+            preview = bool(params.get('preview'))
+            profile = self._render_profile(preview)
             
-            # 生成相对路径
-            midi_path = os.path.join('generated', midi_filename)
-            audio_path = os.path.join('generated', audio_filename)
-            
-            # 生成绝对路径（用于实际文件操作）
-            abs_midi_path = os.path.join('app', 'static', midi_path)
-            abs_audio_path = os.path.join('app', 'static', audio_path)
-            
-            # 生成 MIDI 数据
-            self._generate_midi(params, abs_midi_path)
+            # 生成 MIDI 数据，按内容摘要保存；音频按 MIDI 内容与渲染设置确定路径
+            midi_path = self.storage.write('midi', 'mid', lambda path: self._generate_midi(params, path, progress))
+            abs_midi_path = self.storage.absolute_path(midi_path)
             logger.debug(f"MIDI 生成成功: {abs_midi_path}")
+            audio_path, abs_audio_path = self.storage.reserve(
+                self._render_key(abs_midi_path, profile), 'preview' if preview else 'audio',
+                CODECS[profile['codec']]['ext'])
+            if progress is not None and json.loads(profile.get('segments') or 'null'):
+                # 分段随编码逐个写出，告知音频地址后客户端可以在渲染期间开始播放
+                progress('output', audio_path=audio_path)
             
-            # 转换为音频文件
-            self._midi_to_audio(abs_midi_path, abs_audio_path)
+            # 转换为音频文件（试听版本优先渲染）
+            self._midi_to_audio(abs_midi_path, abs_audio_path,
+                                priority=PRIORITY_HIGH if preview else PRIORITY_NORMAL,
+                                preview=preview, progress=progress)
             logger.debug(f"音频转换成功: {abs_audio_path}")
             
             return {
                 'status': 'success',
-                'midi_path': midi_path.replace('\\', '/'),
-                'audio_path': audio_path.replace('\\', '/')
+                'midi_path': midi_path,
+                'audio_path': audio_path,
+                'preview': preview,
+                'seed': params['seed']
             }
         except Exception as e:
             logger.error(f"生成音乐时出错: {str(e)}", exc_info=True)
@@ -148,12 +715,13 @@ class MusicGenerator:
                 'message': str(e)
             }
     
-    def _generate_midi(self, params: Dict, output_path: str):
-        """生成 MIDI 文件"""
+    def _generate_midi(self, params: Dict, output_path: str, progress: Optional[Callable] = None):
+        """生成 MIDI 文件，每生成一个小节（一个和弦）调用一次 progress('midi', bars=, total=)
+
+        随机选择全部来自以 params['seed'] 初始化的随机数生成器，相同参数与种子生成相同的 MIDI
+        """
         logger.debug("开始生成 MIDI 文件")
-        
-        # 创建 MIDI 对象
-        pm = pretty_midi.PrettyMIDI(initial_tempo=params.get('tempo', 120))
+        rng = np.random.RandomState(params.get('seed'))
         
         # 获取参数
         duration = float(params.get('duration', 60))  # 总时长（秒）
@@ -161,318 +729,11 @@ class MusicGenerator:
         mood = params.get('mood', 'happy')  # 情绪
         style = params.get('style', 'pop')  # 音乐风格
         
-        # 根据风格调整乐器
-        style_settings = {
-            'pop': {
-                'melody': 0,    # Acoustic Grand Piano
-                'chord': 48,    # String Ensemble
-                'bass': 32,     # Acoustic Bass
-                'drums': True,  # 使用鼓点
-                'rhythm_complexity': 0.5
-            },
-            'rock': {
-                'melody': 29,   # Overdriven Guitar
-                'chord': 30,    # Distortion Guitar
-                'bass': 33,     # Electric Bass
-                'drums': True,
-                'rhythm_complexity': 0.8
-            },
-            'classical': {
-                'melody': 0,    # Acoustic Grand Piano
-                'chord': 48,    # String Ensemble
-                'bass': 43,     # Contrabass
-                'drums': False,
-                'rhythm_complexity': 0.3
-            },
-            'electronic': {
-                'melody': 81,   # Synth Lead
-                'chord': 51,    # Synth Strings
-                'bass': 39,     # Synth Bass
-                'drums': True,
-                'rhythm_complexity': 0.7
-            },
-            'jazz': {
-                'melody': 66,   # Alto Sax
-                'chord': 0,     # Acoustic Piano
-                'bass': 32,     # Acoustic Bass
-                'drums': True,
-                'rhythm_complexity': 0.6
-            }
-        }
-        
         # 获取风格设置
-        style_config = style_settings.get(style, style_settings['pop'])
-        
-        # 根据情绪调整参数
-        mood_settings = {
-            'happy': {
-                'scale': 'major',
-                'velocity_main': 90,
-                'velocity_bass': 100,
-                'velocity_chord': 80,
-                'octave_shift': 0,
-                'note_length': 0.8,
-                'tempo_adjust': 1.0,
-                'chord_style': 'normal',
-                'decoration_prob': 0.3,
-                'melody_pattern': 'active'
-            },
-            'sad': {
-                'scale': 'minor',
-                'velocity_main': 70,
-                'velocity_bass': 85,
-                'velocity_chord': 65,
-                'octave_shift': -1,
-                'note_length': 0.9,
-                'tempo_adjust': 0.8,
-                'chord_style': 'spread',
-                'decoration_prob': 0.15,
-                'melody_pattern': 'flowing'
-            },
-            'energetic': {
-                'scale': 'major',
-                'velocity_main': 100,
-                'velocity_bass': 110,
-                'velocity_chord': 90,
-                'octave_shift': 0,
-                'note_length': 0.7,
-                'tempo_adjust': 1.2,
-                'chord_style': 'rhythmic',
-                'decoration_prob': 0.4,
-                'melody_pattern': 'rhythmic'
-            },
-            'calm': {
-                'scale': 'major',
-                'velocity_main': 65,
-                'velocity_bass': 75,
-                'velocity_chord': 60,
-                'octave_shift': -1,
-                'note_length': 1.0,
-                'tempo_adjust': 0.7,
-                'chord_style': 'arpeggiated',
-                'decoration_prob': 0.1,
-                'melody_pattern': 'smooth'
-            },
-            'romantic': {
-                'scale': 'major',
-                'velocity_main': 80,
-                'velocity_bass': 85,
-                'velocity_chord': 75,
-                'octave_shift': 0,
-                'note_length': 0.9,
-                'tempo_adjust': 0.9,
-                'chord_style': 'arpeggiated',
-                'decoration_prob': 0.25,
-                'melody_pattern': 'flowing'
-            },
-            'mysterious': {
-                'scale': 'minor',
-                'velocity_main': 75,
-                'velocity_bass': 85,
-                'velocity_chord': 70,
-                'octave_shift': -1,
-                'note_length': 0.85,
-                'tempo_adjust': 0.75,
-                'chord_style': 'sparse',
-                'decoration_prob': 0.2,
-                'melody_pattern': 'staccato'
-            },
-            'dramatic': {
-                'scale': 'minor',
-                'velocity_main': 95,
-                'velocity_bass': 105,
-                'velocity_chord': 90,
-                'octave_shift': 0,
-                'note_length': 0.8,
-                'tempo_adjust': 1.0,
-                'chord_style': 'full',
-                'decoration_prob': 0.3,
-                'melody_pattern': 'dramatic'
-            },
-            'peaceful': {
-                'scale': 'major',
-                'velocity_main': 60,
-                'velocity_bass': 70,
-                'velocity_chord': 55,
-                'octave_shift': -1,
-                'note_length': 1.1,
-                'tempo_adjust': 0.6,
-                'chord_style': 'arpeggiated',
-                'decoration_prob': 0.05,
-                'melody_pattern': 'smooth'
-            },
-            'nostalgic': {
-                'scale': 'major',
-                'velocity_main': 70,
-                'velocity_bass': 80,
-                'velocity_chord': 65,
-                'octave_shift': 0,
-                'note_length': 0.85,
-                'tempo_adjust': 0.8,
-                'chord_style': 'normal',
-                'decoration_prob': 0.2,
-                'melody_pattern': 'reflective'
-            },
-            'dreamy': {
-                'scale': 'major',
-                'velocity_main': 65,
-                'velocity_bass': 75,
-                'velocity_chord': 60,
-                'octave_shift': 0,
-                'note_length': 0.95,
-                'tempo_adjust': 0.75,
-                'chord_style': 'arpeggiated',
-                'decoration_prob': 0.15,
-                'melody_pattern': 'floating'
-            },
-            'passionate': {
-                'scale': 'minor',
-                'velocity_main': 100,
-                'velocity_bass': 110,
-                'velocity_chord': 95,
-                'octave_shift': 0,
-                'note_length': 0.8,
-                'tempo_adjust': 1.1,
-                'chord_style': 'rhythmic',
-                'decoration_prob': 0.35,
-                'melody_pattern': 'intense'
-            },
-            'melancholic': {
-                'scale': 'minor',
-                'velocity_main': 65,
-                'velocity_bass': 75,
-                'velocity_chord': 60,
-                'octave_shift': -1,
-                'note_length': 0.9,
-                'tempo_adjust': 0.7,
-                'chord_style': 'sparse',
-                'decoration_prob': 0.1,
-                'melody_pattern': 'flowing'
-            },
-            'epic': {
-                'scale': 'minor',
-                'velocity_main': 110,
-                'velocity_bass': 120,
-                'velocity_chord': 100,
-                'octave_shift': 0,
-                'note_length': 0.85,
-                'tempo_adjust': 1.0,
-                'chord_style': 'full',
-                'decoration_prob': 0.4,
-                'melody_pattern': 'heroic'
-            },
-            'playful': {
-                'scale': 'major',
-                'velocity_main': 85,
-                'velocity_bass': 90,
-                'velocity_chord': 80,
-                'octave_shift': 1,
-                'note_length': 0.7,
-                'tempo_adjust': 1.1,
-                'chord_style': 'staccato',
-                'decoration_prob': 0.45,
-                'melody_pattern': 'bouncy'
-            },
-            'dark': {
-                'scale': 'minor',
-                'velocity_main': 80,
-                'velocity_bass': 90,
-                'velocity_chord': 75,
-                'octave_shift': -2,
-                'note_length': 0.9,
-                'tempo_adjust': 0.85,
-                'chord_style': 'sparse',
-                'decoration_prob': 0.2,
-                'melody_pattern': 'haunting'
-            },
-            'hopeful': {
-                'scale': 'major',
-                'velocity_main': 85,
-                'velocity_bass': 90,
-                'velocity_chord': 80,
-                'octave_shift': 0,
-                'note_length': 0.85,
-                'tempo_adjust': 0.9,
-                'chord_style': 'normal',
-                'decoration_prob': 0.25,
-                'melody_pattern': 'uplifting'
-            },
-            'tense': {
-                'scale': 'minor',
-                'velocity_main': 85,
-                'velocity_bass': 95,
-                'velocity_chord': 80,
-                'octave_shift': -1,
-                'note_length': 0.75,
-                'tempo_adjust': 1.05,
-                'chord_style': 'dissonant',
-                'decoration_prob': 0.3,
-                'melody_pattern': 'suspenseful'
-            },
-            'ethereal': {
-                'scale': 'major',
-                'velocity_main': 60,
-                'velocity_bass': 70,
-                'velocity_chord': 55,
-                'octave_shift': 1,
-                'note_length': 1.2,
-                'tempo_adjust': 0.65,
-                'chord_style': 'arpeggiated',
-                'decoration_prob': 0.15,
-                'melody_pattern': 'floating'
-            },
-            'whimsical': {
-                'scale': 'major',
-                'velocity_main': 80,
-                'velocity_bass': 85,
-                'velocity_chord': 75,
-                'octave_shift': 1,
-                'note_length': 0.75,
-                'tempo_adjust': 1.0,
-                'chord_style': 'playful',
-                'decoration_prob': 0.5,
-                'melody_pattern': 'quirky'
-            },
-            'aggressive': {
-                'scale': 'minor',
-                'velocity_main': 115,
-                'velocity_bass': 125,
-                'velocity_chord': 110,
-                'octave_shift': 0,
-                'note_length': 0.7,
-                'tempo_adjust': 1.3,
-                'chord_style': 'percussive',
-                'decoration_prob': 0.3,
-                'melody_pattern': 'intense'
-            },
-            'triumphant': {
-                'scale': 'major',
-                'velocity_main': 105,
-                'velocity_bass': 115,
-                'velocity_chord': 100,
-                'octave_shift': 0,
-                'note_length': 0.85,
-                'tempo_adjust': 1.1,
-                'chord_style': 'full',
-                'decoration_prob': 0.35,
-                'melody_pattern': 'victorious'
-            },
-            'majestic': {
-                'scale': 'major',
-                'velocity_main': 100,
-                'velocity_bass': 110,
-                'velocity_chord': 95,
-                'octave_shift': 0,
-                'note_length': 0.9,
-                'tempo_adjust': 0.95,
-                'chord_style': 'full',
-                'decoration_prob': 0.25,
-                'melody_pattern': 'regal'
-            }
-        }
+        style_config = STYLE_SETTINGS.get(style, STYLE_SETTINGS['pop'])
         
         # 获取情绪设置
-        settings = mood_settings.get(mood, mood_settings['happy'])
+        settings = MOOD_SETTINGS.get(mood, MOOD_SETTINGS['happy'])
         
         # 调整速度
         tempo *= settings['tempo_adjust']
@@ -481,15 +742,20 @@ class MusicGenerator:
         beats_per_chord = 4
         seconds_per_chord = beats_per_chord / beats_per_second
         
+        # 创建 MIDI 对象（使用调整后的速度，小节线才与和弦切换对齐）
+        pm = pretty_midi.PrettyMIDI(initial_tempo=tempo)
+        
         # 解析和弦进行
         chord_progression = self._parse_chord_progression(params.get('chord_progression', ''), settings['scale'])
         logger.debug(f"和弦进行: {chord_progression}")
         
         # 创建音轨
-        melody = pretty_midi.Instrument(program=style_config['melody'])  # 主旋律
-        chords = pretty_midi.Instrument(program=style_config['chord'])   # 和弦
-        bass = pretty_midi.Instrument(program=style_config['bass'])      # 贝斯
+        melody = pretty_midi.Instrument(program=style_config['melody'], name='melody')  # 主旋律
+        chords = pretty_midi.Instrument(program=style_config['chord'], name='chords')   # 和弦
+        bass = pretty_midi.Instrument(program=style_config['bass'], name='bass')        # 贝斯
         
+        total_bars = int(np.ceil(duration / seconds_per_chord))
+        bars = 0
         current_time = 0.0
         while current_time < duration:
             for chord in chord_progression:
@@ -525,7 +791,8 @@ class MusicGenerator:
                     beats_per_chord,
                     current_time,
                     seconds_per_beat,
-                    settings
+                    settings,
+                    rng
                 )
                 melody.notes.extend(melody_notes)
                 
@@ -552,12 +819,12 @@ class MusicGenerator:
                 
                 # 4. 添加装饰音
                 for i in range(beats_per_chord):
-                    if np.random.random() < settings['decoration_prob']:
+                    if rng.random() < settings['decoration_prob']:
                         beat_time = current_time + i * seconds_per_beat
                         if beat_time >= duration:
                             break
                             
-                        note_number = np.random.choice(chord) + 12
+                        note_number = rng.choice(chord) + 12
                         note = pretty_midi.Note(
                             velocity=int(settings['velocity_main'] * 0.8),
                             pitch=note_number + settings['octave_shift'] * 12,
@@ -569,9 +836,12 @@ class MusicGenerator:
                 # 5. 添加鼓点
                 if style_config['drums']:
                     self._add_drums(pm, current_time, seconds_per_chord, 
-                                  style_config['rhythm_complexity'], settings['chord_style'])
+                                  style_config['rhythm_complexity'], settings['chord_style'], rng)
                 
                 current_time += seconds_per_chord
+                bars += 1
+                if progress is not None:
+                    progress('midi', bars=bars, total=total_bars)
         
         # 添加所有音轨
         pm.instruments.extend([melody, chords, bass])
@@ -581,29 +851,30 @@ class MusicGenerator:
         logger.debug(f"MIDI 文件已保存: {output_path}")
     
     def _generate_melody(self, chord: List[int], pattern: str, num_beats: int,
-                        start_time: float, seconds_per_beat: float, settings: Dict) -> List[pretty_midi.Note]:
+                        start_time: float, seconds_per_beat: float, settings: Dict,
+                        rng: np.random.RandomState) -> List[pretty_midi.Note]:
         """生成旋律"""
         notes = []
         scale = self._get_scale_from_chord(chord)
         
         # 生成变化的音符长度 - 短音、中音、长音的概率分布
         def get_varied_length():
-            length_type = np.random.choice(['short', 'medium', 'long', 'extra_long'], 
+            length_type = rng.choice(['short', 'medium', 'long', 'extra_long'], 
                                            p=[0.3, 0.4, 0.2, 0.1])
             if length_type == 'short':
-                return np.random.uniform(0.2, 0.4)
+                return rng.uniform(0.2, 0.4)
             elif length_type == 'medium':
-                return np.random.uniform(0.5, 0.7)
+                return rng.uniform(0.5, 0.7)
             elif length_type == 'long':
-                return np.random.uniform(0.8, 1.0)
+                return rng.uniform(0.8, 1.0)
             else:  # extra_long
-                return np.random.uniform(1.1, 1.8)
+                return rng.uniform(1.1, 1.8)
         
         if pattern == 'active':
             # 活跃的旋律，使用较短音符但有变化
             for i in range(num_beats * 2):
-                if np.random.random() < 0.8:  # 80% 的概率添加音符
-                    note_number = np.random.choice(scale)
+                if rng.random() < 0.8:  # 80% 的概率添加音符
+                    note_number = rng.choice(scale)
                     # 使用变化的音符长度
                     length = get_varied_length() * 0.5  # 调整基础值
                     note = pretty_midi.Note(
@@ -618,7 +889,7 @@ class MusicGenerator:
             # 流畅的旋律，使用较长音符，有变化
             i = 0
             while i < num_beats:
-                note_number = np.random.choice(scale)
+                note_number = rng.choice(scale)
                 # 不同长度的音符
                 length = get_varied_length()
                 note = pretty_midi.Note(
@@ -635,19 +906,19 @@ class MusicGenerator:
             # 节奏型旋律，有明显的节奏变化
             i = 0
             while i < num_beats * 3:
-                if np.random.random() < 0.7:  # 70% 的概率添加音符
-                    note_number = np.random.choice(scale)
+                if rng.random() < 0.7:  # 70% 的概率添加音符
+                    note_number = rng.choice(scale)
                     # 不同长度的音符，节奏型更注重短音符
                     length_prob = [0.5, 0.3, 0.15, 0.05]  # 更偏向短音符
-                    length_type = np.random.choice(['short', 'medium', 'long', 'extra_long'], p=length_prob)
+                    length_type = rng.choice(['short', 'medium', 'long', 'extra_long'], p=length_prob)
                     if length_type == 'short':
-                        length = np.random.uniform(0.1, 0.3)
+                        length = rng.uniform(0.1, 0.3)
                     elif length_type == 'medium':
-                        length = np.random.uniform(0.4, 0.6)
+                        length = rng.uniform(0.4, 0.6)
                     elif length_type == 'long':
-                        length = np.random.uniform(0.7, 0.9)
+                        length = rng.uniform(0.7, 0.9)
                     else:  # extra_long
-                        length = np.random.uniform(1.0, 1.2)
+                        length = rng.uniform(1.0, 1.2)
                     
                     note = pretty_midi.Note(
                         velocity=settings['velocity_main'],
@@ -656,17 +927,17 @@ class MusicGenerator:
                         end=start_time + (i * seconds_per_beat / 3) + (length * seconds_per_beat / 2)
                     )
                     notes.append(note)
-                i += 0.5 + np.random.random() * 0.5  # 添加随机间隔
+                i += 0.5 + rng.random() * 0.5  # 添加随机间隔
         
         elif pattern == 'staccato':
             # 断奏风格，短促有力的音符
             for i in range(num_beats * 2):
-                if np.random.random() < 0.75:  # 75% 的概率添加音符
-                    note_number = np.random.choice(scale)
+                if rng.random() < 0.75:  # 75% 的概率添加音符
+                    note_number = rng.choice(scale)
                     # 短促音符
-                    length = np.random.uniform(0.1, 0.3)
+                    length = rng.uniform(0.1, 0.3)
                     # 断奏通常会有短暂的间隔
-                    start_offset = np.random.uniform(0, 0.1) * seconds_per_beat
+                    start_offset = rng.uniform(0, 0.1) * seconds_per_beat
                     note = pretty_midi.Note(
                         velocity=int(settings['velocity_main'] * 1.1),  # 稍微增加力度
                         pitch=note_number + settings['octave_shift'] * 12,
@@ -680,10 +951,10 @@ class MusicGenerator:
             i = 0
             accented = True  # 是否强调当前音符
             while i < num_beats:
-                if np.random.random() < 0.85:  # 85% 的概率添加音符
-                    note_number = np.random.choice(scale)
+                if rng.random() < 0.85:  # 85% 的概率添加音符
+                    note_number = rng.choice(scale)
                     # 长度在短到中之间变化
-                    length = np.random.uniform(0.3, 1.0) if accented else np.random.uniform(0.1, 0.4)
+                    length = rng.uniform(0.3, 1.0) if accented else rng.uniform(0.1, 0.4)
                     velocity = int(settings['velocity_main'] * 1.2) if accented else int(settings['velocity_main'] * 0.8)
                     
                     note = pretty_midi.Note(
@@ -694,16 +965,16 @@ class MusicGenerator:
                     )
                     notes.append(note)
                     accented = not accented  # 交替强弱
-                i += np.random.choice([0.5, 0.75, 1.0])  # 不规则的节奏间隔
+                i += rng.choice([0.5, 0.75, 1.0])  # 不规则的节奏间隔
         
         elif pattern == 'smooth':
             # 平滑连接的旋律，相邻音符几乎无间隙
             i = 0
             previous_end = start_time
             while i < num_beats:
-                note_number = np.random.choice(scale)
+                note_number = rng.choice(scale)
                 # 中等到长音符
-                length = np.random.uniform(0.6, 1.2)
+                length = rng.uniform(0.6, 1.2)
                 
                 note = pretty_midi.Note(
                     velocity=settings['velocity_main'],
@@ -719,10 +990,10 @@ class MusicGenerator:
             # 沉思型旋律，中等节奏，有意的停顿
             i = 0
             while i < num_beats:
-                if np.random.random() < 0.7:  # 70% 的概率添加音符
-                    note_number = np.random.choice(scale)
+                if rng.random() < 0.7:  # 70% 的概率添加音符
+                    note_number = rng.choice(scale)
                     # 中长型音符
-                    length = np.random.uniform(0.7, 1.2)
+                    length = rng.uniform(0.7, 1.2)
                     
                     note = pretty_midi.Note(
                         velocity=int(settings['velocity_main'] * 0.9),  # 较柔和音量
@@ -733,8 +1004,8 @@ class MusicGenerator:
                     notes.append(note)
                     
                     # 添加停顿
-                    if np.random.random() < 0.3:  # 30% 概率有较长停顿
-                        i += length + np.random.uniform(0.5, 1.0)
+                    if rng.random() < 0.3:  # 30% 概率有较长停顿
+                        i += length + rng.uniform(0.5, 1.0)
                     else:
                         i += length
                 else:
@@ -743,42 +1014,42 @@ class MusicGenerator:
         elif pattern == 'floating':
             # 飘逸的旋律，音高有较大变化，长度不规则
             i = 0
-            previous_pitch = np.random.choice(scale) + settings['octave_shift'] * 12
+            previous_pitch = rng.choice(scale) + settings['octave_shift'] * 12
             pitch_range = 12  # 允许较大的音高变化范围
             
             while i < num_beats:
                 # 在之前音符的基础上选择新音符，创造平滑的变化
-                pitch_delta = np.random.choice([-4, -3, -2, -1, 1, 2, 3, 4])
+                pitch_delta = rng.choice([-4, -3, -2, -1, 1, 2, 3, 4])
                 new_pitch = previous_pitch + pitch_delta
                 
                 # 确保音高在合理范围内
                 if abs(new_pitch - (np.mean(scale) + settings['octave_shift'] * 12)) > pitch_range:
                     # 如果偏离太远，重新选择
-                    new_pitch = np.random.choice(scale) + settings['octave_shift'] * 12
+                    new_pitch = rng.choice(scale) + settings['octave_shift'] * 12
                 
                 # 使用变化的长度
-                length = np.random.uniform(0.3, 1.5)
+                length = rng.uniform(0.3, 1.5)
                 
                 note = pretty_midi.Note(
-                    velocity=int(settings['velocity_main'] * np.random.uniform(0.8, 1.0)),  # 轻微的音量变化
+                    velocity=int(settings['velocity_main'] * rng.uniform(0.8, 1.0)),  # 轻微的音量变化
                     pitch=new_pitch,
                     start=start_time + i * seconds_per_beat,
                     end=start_time + i * seconds_per_beat + length * seconds_per_beat
                 )
                 notes.append(note)
                 previous_pitch = new_pitch
-                i += length * np.random.uniform(0.6, 1.0)  # 不规则的间隔
+                i += length * rng.uniform(0.6, 1.0)  # 不规则的间隔
         
         elif pattern == 'intense':
             # 强烈、紧张的旋律，快速且有力
             i = 0
             while i < num_beats * 3:
-                if np.random.random() < 0.85:  # 高密度的音符
-                    note_number = np.random.choice(scale)
+                if rng.random() < 0.85:  # 高密度的音符
+                    note_number = rng.choice(scale)
                     # 短促而有力的音符
-                    length = np.random.uniform(0.1, 0.4)
+                    length = rng.uniform(0.1, 0.4)
                     # 变化的力度，创造紧张感
-                    velocity_var = np.random.uniform(0.9, 1.3)
+                    velocity_var = rng.uniform(0.9, 1.3)
                     
                     note = pretty_midi.Note(
                         velocity=int(settings['velocity_main'] * velocity_var),
@@ -789,7 +1060,7 @@ class MusicGenerator:
                     notes.append(note)
                     
                     # 有时添加同音重复，增强紧张感
-                    if np.random.random() < 0.3:
+                    if rng.random() < 0.3:
                         repeat = pretty_midi.Note(
                             velocity=int(note.velocity * 1.1),  # 重复音更强
                             pitch=note.pitch,
@@ -797,20 +1068,20 @@ class MusicGenerator:
                             end=note.end + 0.05 * seconds_per_beat + length * 0.7 * seconds_per_beat
                         )
                         notes.append(repeat)
-                i += np.random.uniform(0.2, 0.5)  # 快速但不规则的节奏
+                i += rng.uniform(0.2, 0.5)  # 快速但不规则的节奏
         
         elif pattern == 'heroic':
             # 英雄式旋律，雄壮有力的长音符与短音符结合
             i = 0
             while i < num_beats:
-                if np.random.random() < 0.75:
-                    note_number = np.random.choice(scale)
+                if rng.random() < 0.75:
+                    note_number = rng.choice(scale)
                     # 切换长短音符
                     if i % 2 == 0:  # 长音符
-                        length = np.random.uniform(0.8, 1.5)
+                        length = rng.uniform(0.8, 1.5)
                         velocity = int(settings['velocity_main'] * 1.2)  # 更强的力度
                     else:  # 短音符
-                        length = np.random.uniform(0.3, 0.5)
+                        length = rng.uniform(0.3, 0.5)
                         velocity = int(settings['velocity_main'] * 0.9)
                     
                     note = pretty_midi.Note(
@@ -826,15 +1097,15 @@ class MusicGenerator:
             # 活泼跳跃的旋律
             i = 0
             while i < num_beats * 2:
-                if np.random.random() < 0.8:
-                    note_number = np.random.choice(scale)
+                if rng.random() < 0.8:
+                    note_number = rng.choice(scale)
                     # 短促而有弹性的音符
-                    length = np.random.uniform(0.2, 0.4)
+                    length = rng.uniform(0.2, 0.4)
                     # 有变化的力度
-                    velocity = int(settings['velocity_main'] * np.random.uniform(0.9, 1.1))
+                    velocity = int(settings['velocity_main'] * rng.uniform(0.9, 1.1))
                     
                     # 添加一点点随机起始偏移，模拟"弹跳"感
-                    start_offset = np.random.uniform(0, 0.05) * seconds_per_beat
+                    start_offset = rng.uniform(0, 0.05) * seconds_per_beat
                     
                     note = pretty_midi.Note(
                         velocity=velocity,
@@ -845,8 +1116,8 @@ class MusicGenerator:
                     notes.append(note)
                     
                     # 有时添加一个短跳音
-                    if np.random.random() < 0.4 and i + 0.25 < num_beats * 2:
-                        jump_pitch = note_number + np.random.choice([-3, -2, 2, 3, 4])
+                    if rng.random() < 0.4 and i + 0.25 < num_beats * 2:
+                        jump_pitch = note_number + rng.choice([-3, -2, 2, 3, 4])
                         if jump_pitch in scale:
                             jump_note = pretty_midi.Note(
                                 velocity=int(velocity * 0.9),
@@ -861,12 +1132,12 @@ class MusicGenerator:
             # 阴森、神秘的旋律
             i = 0
             while i < num_beats:
-                if np.random.random() < 0.65:
-                    note_number = np.random.choice(scale)
+                if rng.random() < 0.65:
+                    note_number = rng.choice(scale)
                     # 较长音符，表现神秘感
-                    length = np.random.uniform(0.8, 1.8)
+                    length = rng.uniform(0.8, 1.8)
                     # 较轻的音量
-                    velocity = int(settings['velocity_main'] * np.random.uniform(0.7, 0.9))
+                    velocity = int(settings['velocity_main'] * rng.uniform(0.7, 0.9))
                     
                     note = pretty_midi.Note(
                         velocity=velocity,
@@ -877,8 +1148,8 @@ class MusicGenerator:
                     notes.append(note)
                     
                     # 偶尔添加不协和的装饰音
-                    if np.random.random() < 0.3:
-                        dissonant_pitch = note_number + np.random.choice([-1, 1, 6, 11])
+                    if rng.random() < 0.3:
+                        dissonant_pitch = note_number + rng.choice([-1, 1, 6, 11])
                         echo = pretty_midi.Note(
                             velocity=int(velocity * 0.6),  # 更轻的回声
                             pitch=dissonant_pitch + settings['octave_shift'] * 12,
@@ -886,7 +1157,7 @@ class MusicGenerator:
                             end=note.start + 0.2 * seconds_per_beat + 0.5 * seconds_per_beat
                         )
                         notes.append(echo)
-                i += np.random.uniform(0.7, 1.3)  # 不规则的间隔
+                i += rng.uniform(0.7, 1.3)  # 不规则的间隔
         
         elif pattern == 'uplifting':
             # 振奋人心的旋律，逐渐上升
@@ -895,7 +1166,7 @@ class MusicGenerator:
             direction = 1  # 1表示上升，-1表示下降
             
             while i < num_beats:
-                if np.random.random() < 0.85:
+                if rng.random() < 0.85:
                     # 按照上升趋势选择音符
                     sorted_scale = sorted(scale)
                     if pitch_idx >= len(sorted_scale):
@@ -909,7 +1180,7 @@ class MusicGenerator:
                     pitch_idx += direction
                     
                     # 适中的音符长度
-                    length = np.random.uniform(0.4, 0.8)
+                    length = rng.uniform(0.4, 0.8)
                     
                     note = pretty_midi.Note(
                         velocity=settings['velocity_main'],
@@ -926,29 +1197,29 @@ class MusicGenerator:
             pitch_center = min(scale) + 2  # 使用低音区
             
             while i < num_beats:
-                if np.random.random() < 0.7:
+                if rng.random() < 0.7:
                     # 选择接近中心音的音符
                     pitch_options = [p for p in scale if abs(p - pitch_center) <= 5]
                     if not pitch_options:
                         pitch_options = scale
-                    note_number = np.random.choice(pitch_options)
+                    note_number = rng.choice(pitch_options)
                     
                     # 变化的音符长度
-                    if np.random.random() < 0.6:  # 60%概率短音符
-                        length = np.random.uniform(0.3, 0.6)
+                    if rng.random() < 0.6:  # 60%概率短音符
+                        length = rng.uniform(0.3, 0.6)
                     else:  # 40%概率长音符
-                        length = np.random.uniform(1.0, 1.8)
+                        length = rng.uniform(1.0, 1.8)
                     
                     # 有时使用颤音效果
-                    tremolo = np.random.random() < 0.2
+                    tremolo = rng.random() < 0.2
                     
                     if tremolo:
                         # 创建颤音效果（多个短音符）
-                        tremolo_count = int(np.random.uniform(3, 6))
+                        tremolo_count = int(rng.uniform(3, 6))
                         tremolo_length = length / tremolo_count
                         for t in range(tremolo_count):
                             tremolo_note = pretty_midi.Note(
-                                velocity=int(settings['velocity_main'] * np.random.uniform(0.9, 1.0)),
+                                velocity=int(settings['velocity_main'] * rng.uniform(0.9, 1.0)),
                                 pitch=note_number + settings['octave_shift'] * 12,
                                 start=start_time + i * seconds_per_beat + t * tremolo_length * seconds_per_beat,
                                 end=start_time + i * seconds_per_beat + (t + 0.8) * tremolo_length * seconds_per_beat
@@ -964,35 +1235,35 @@ class MusicGenerator:
                         notes.append(note)
                 
                 # 不规则的间隔，有时有较长停顿
-                if np.random.random() < 0.3:  # 30%概率有停顿
-                    i += np.random.uniform(1.0, 2.0)
+                if rng.random() < 0.3:  # 30%概率有停顿
+                    i += rng.uniform(1.0, 2.0)
                 else:
-                    i += np.random.uniform(0.5, 0.8)
+                    i += rng.uniform(0.5, 0.8)
         
         elif pattern == 'quirky':
             # 古怪有趣的旋律，跳跃性大，节奏不规则
             i = 0
-            previous_pitch = np.random.choice(scale)
+            previous_pitch = rng.choice(scale)
             
             while i < num_beats:
-                if np.random.random() < 0.8:
+                if rng.random() < 0.8:
                     # 选择与前一个音符相距较远的音符
                     available_pitches = [p for p in scale if abs(p - previous_pitch) > 3]
                     if not available_pitches:
                         available_pitches = scale
-                    note_number = np.random.choice(available_pitches)
+                    note_number = rng.choice(available_pitches)
                     previous_pitch = note_number
                     
                     # 多变的音符长度
-                    if np.random.random() < 0.7:  # 70%概率短促音符
-                        length = np.random.uniform(0.1, 0.3)
+                    if rng.random() < 0.7:  # 70%概率短促音符
+                        length = rng.uniform(0.1, 0.3)
                     else:  # 30%概率较长音符
-                        length = np.random.uniform(0.5, 0.9)
+                        length = rng.uniform(0.5, 0.9)
                     
                     # 有时突然转变音量
-                    if np.random.random() < 0.2:  # 20%概率突然变强
+                    if rng.random() < 0.2:  # 20%概率突然变强
                         velocity = int(settings['velocity_main'] * 1.3)
-                    elif np.random.random() < 0.2:  # 20%概率突然变弱
+                    elif rng.random() < 0.2:  # 20%概率突然变弱
                         velocity = int(settings['velocity_main'] * 0.7)
                     else:  # 60%概率正常音量
                         velocity = settings['velocity_main']
@@ -1006,7 +1277,7 @@ class MusicGenerator:
                     notes.append(note)
                 
                 # 不规则的节奏
-                i += np.random.choice([0.25, 0.5, 0.75, 1.0], p=[0.2, 0.4, 0.3, 0.1])
+                i += rng.choice([0.25, 0.5, 0.75, 1.0], p=[0.2, 0.4, 0.3, 0.1])
         
         elif pattern == 'victorious':
             # 胜利感强烈的旋律，上行进行，气势磅礴
@@ -1016,7 +1287,7 @@ class MusicGenerator:
             pitch_idx = 0
             
             while i < num_beats:
-                if np.random.random() < 0.85:  # 高密度的音符
+                if rng.random() < 0.85:  # 高密度的音符
                     # 使用排序后的音阶，创造上行感
                     if pitch_idx >= len(sorted_scale):
                         pitch_idx = 0  # 重新开始
@@ -1025,11 +1296,11 @@ class MusicGenerator:
                     pitch_idx += 1
                     
                     # 旋律音符长度
-                    if np.random.random() < 0.3:  # 30%概率长音符，表现高潮
-                        length = np.random.uniform(0.8, 1.2)
+                    if rng.random() < 0.3:  # 30%概率长音符，表现高潮
+                        length = rng.uniform(0.8, 1.2)
                         velocity = int(settings['velocity_main'] * 1.2)  # 更强的力度
                     else:  # 70%概率中等长度
-                        length = np.random.uniform(0.4, 0.7)
+                        length = rng.uniform(0.4, 0.7)
                         velocity = settings['velocity_main']
                     
                     note = pretty_midi.Note(
@@ -1041,8 +1312,8 @@ class MusicGenerator:
                     notes.append(note)
                     
                     # 有时添加和声
-                    if np.random.random() < 0.25 and len(scale) > 3:
-                        harmony_pitch = note_number + np.random.choice([3, 4, 5, 7])  # 添加3度、4度、5度或7度音
+                    if rng.random() < 0.25 and len(scale) > 3:
+                        harmony_pitch = note_number + rng.choice([3, 4, 5, 7])  # 添加3度、4度、5度或7度音
                         if harmony_pitch in scale:
                             harmony = pretty_midi.Note(
                                 velocity=int(velocity * 0.8),
@@ -1059,17 +1330,17 @@ class MusicGenerator:
             # 庄严、高贵的旋律，典雅、庄重
             i = 0
             while i < num_beats:
-                if np.random.random() < 0.75:
-                    note_number = np.random.choice(scale)
+                if rng.random() < 0.75:
+                    note_number = rng.choice(scale)
                     
                     # 切换长短音符，创造庄严感
                     if i % 2 == 0:  # 较长音符
-                        length = np.random.uniform(1.0, 1.5)
+                        length = rng.uniform(1.0, 1.5)
                     else:  # 较短音符
-                        length = np.random.uniform(0.5, 0.8)
+                        length = rng.uniform(0.5, 0.8)
                     
                     # 平稳的力度
-                    velocity = int(settings['velocity_main'] * np.random.uniform(0.95, 1.05))
+                    velocity = int(settings['velocity_main'] * rng.uniform(0.95, 1.05))
                     
                     note = pretty_midi.Note(
                         velocity=velocity,
@@ -1080,7 +1351,7 @@ class MusicGenerator:
                     notes.append(note)
                     
                     # 添加装饰音，模拟华丽感
-                    if np.random.random() < 0.3:
+                    if rng.random() < 0.3:
                         # 选择相邻音符作为装饰音
                         for pitch_offset in [2, 4]:  # 添加3度和5度
                             if note_number + pitch_offset in scale:
@@ -1099,19 +1370,19 @@ class MusicGenerator:
             # 温和的旋律，平滑过渡
             i = 0
             while i < num_beats:
-                if np.random.random() < 0.6:  # 60% 的概率添加音符
-                    note_number = np.random.choice(scale)
+                if rng.random() < 0.6:  # 60% 的概率添加音符
+                    note_number = rng.choice(scale)
                     # 温和模式偏好中长音符
                     length_prob = [0.1, 0.4, 0.4, 0.1]
-                    length_type = np.random.choice(['short', 'medium', 'long', 'extra_long'], p=length_prob)
+                    length_type = rng.choice(['short', 'medium', 'long', 'extra_long'], p=length_prob)
                     if length_type == 'short':
-                        length = np.random.uniform(0.3, 0.5)
+                        length = rng.uniform(0.3, 0.5)
                     elif length_type == 'medium':
-                        length = np.random.uniform(0.6, 0.8)
+                        length = rng.uniform(0.6, 0.8)
                     elif length_type == 'long':
-                        length = np.random.uniform(0.9, 1.1)
+                        length = rng.uniform(0.9, 1.1)
                     else:  # extra_long
-                        length = np.random.uniform(1.2, 1.6)
+                        length = rng.uniform(1.2, 1.6)
                     
                     note = pretty_midi.Note(
                         velocity=settings['velocity_main'],
@@ -1120,14 +1391,14 @@ class MusicGenerator:
                         end=start_time + i * seconds_per_beat + length * seconds_per_beat
                     )
                     notes.append(note)
-                i += 0.7 + np.random.random() * 0.6  # 生成相对平滑的间隔
+                i += 0.7 + rng.random() * 0.6  # 生成相对平滑的间隔
         
         # 增加一些装饰音
-        if np.random.random() < settings.get('decoration_prob', 0.2):
+        if rng.random() < settings.get('decoration_prob', 0.2):
             for i in range(min(len(notes) // 3, 5)):  # 添加几个装饰音
                 if len(notes) > 0:
-                    base_note = np.random.choice(notes)
-                    decoration_pitch = base_note.pitch + np.random.choice([-2, -1, 1, 2, 4])
+                    base_note = rng.choice(notes)
+                    decoration_pitch = base_note.pitch + rng.choice([-2, -1, 1, 2, 4])
                     decoration = pretty_midi.Note(
                         velocity=int(base_note.velocity * 0.9),
                         pitch=decoration_pitch,
@@ -1155,131 +1426,255 @@ class MusicGenerator:
         return sorted(list(set(scale)))
     
     def _add_drums(self, pm: pretty_midi.PrettyMIDI, start_time: float, 
-                   duration: float, complexity: float, style: str):
-        """添加鼓点"""
-        drums = pretty_midi.Instrument(program=0, is_drum=True)
-        
-        # 定义鼓点音符
-        kick = 36      # 底鼓
-        snare = 38     # 军鼓
-        hihat = 42     # 闭合击镲
-        crash = 49     # 碎音镲
-        
-        # 根据复杂度和风格添加鼓点
-        beats = int(duration * 2)  # 每拍分成两个子拍
+                   duration: float, complexity: float, style: str, rng: np.random.RandomState):
+        """添加鼓点
+
+        每小节从有限的节奏型中选一种（见 drums.drum_pattern），音轨名记录节奏型，
+        渲染时直接拼接缓存中已渲染好的鼓点小节
+        """
+        variation = rng.randint(DRUM_VARIATIONS)
+        tempo = 240.0 / duration  # 每小节四拍
+        drums = pretty_midi.Instrument(program=0, is_drum=True,
+                                       name=groove_name(style, complexity, tempo, variation))
+        for pitch, velocity, start, end in drum_pattern(complexity, style, variation, duration):
+            drums.notes.append(pretty_midi.Note(
+                velocity=velocity,
+                pitch=pitch,
+                start=start_time + start,
+                end=start_time + end
+            ))
         
-        for i in range(beats):
-            current_time = start_time + i * duration / beats
+        pm.instruments.append(drums)
+    
+    def render_full(self, midi_path: str, progress: Optional[Callable] = None) -> Dict:
+        """为已有的 MIDI（通常是只渲染了试听版的项目）渲染完整品质音频，progress 接收渲染进度"""
+        try:
+            abs_midi_path = self.storage.absolute_path(midi_path)
+            profile = self._render_profile()
+            audio_path, abs_audio_path = self.storage.reserve(
+                self._render_key(abs_midi_path, profile), 'audio', CODECS[profile['codec']]['ext'])
             
-            # 底鼓（在强拍上）
-            if i % 2 == 0 or (complexity > 0.6 and np.random.random() < 0.3):
-                note = pretty_midi.Note(
-                    velocity=100,
-                    pitch=kick,
-                    start=current_time,
-                    end=current_time + 0.1
-                )
-                drums.notes.append(note)
+            self._midi_to_audio(abs_midi_path, abs_audio_path, progress=progress)
             
-            # 军鼓（在弱拍上）
-            if i % 2 == 1 or (complexity > 0.7 and np.random.random() < 0.2):
-                note = pretty_midi.Note(
-                    velocity=90,
-                    pitch=snare,
-                    start=current_time,
-                    end=current_time + 0.1
-                )
-                drums.notes.append(note)
+            return {
+                'status': 'success',
+                'audio_path': audio_path
+            }
+        except Exception as e:
+            logger.error(f"渲染完整音频失败: {str(e)}", exc_info=True)
+            return {
+                'status': 'error',
+                'message': str(e)
+            }
+    
+    def restore(self, recipe: Optional[Dict], midi_path: Optional[str], audio_path: Optional[str],
+                progress: Optional[Callable] = None) -> Dict:
+        """重新生成缺失的文件（被保留策略清理或丢失），progress 接收重新渲染音频的进度
+
+        MIDI 按生成配方重新生成（需要配方，且引擎版本与当前一致）；音频从 MIDI 重新渲染，
+        原来是试听版的仍渲染试听版。文件按内容寻址，设置未变时得到与原来相同的路径，
+        旧版路径或渲染设置改变时路径不同，调用方需要更新记录
+        """
+        try:
+            restored = []
+            if not midi_path or not os.path.exists(self.storage.absolute_path(midi_path)):
+                if not recipe:
+                    raise ValueError('没有生成配方，无法重新生成 MIDI')
+                if recipe.get('engine') != ENGINE_VERSION:
+                    raise ValueError(f"配方的引擎版本 {recipe.get('engine')} 与当前版本 {ENGINE_VERSION} 不同，无法重现")
+                midi_path = self.storage.write('midi', 'mid', lambda path: self._generate_midi(recipe, path))
+                restored.append(midi_path)
             
-            # 击镲（根据复杂度添加）
-            if np.random.random() < complexity:
-                note = pretty_midi.Note(
-                    velocity=80,
-                    pitch=hihat,
-                    start=current_time,
-                    end=current_time + 0.1
-                )
-                drums.notes.append(note)
+            if audio_path and not os.path.exists(self.storage.absolute_path(audio_path)):
+                preview = os.path.basename(audio_path).startswith('preview_')
+                abs_midi_path = self.storage.absolute_path(midi_path)
+                profile = self._render_profile(preview)
+                audio_path, abs_audio_path = self.storage.reserve(
+                    self._render_key(abs_midi_path, profile), 'preview' if preview else 'audio',
+                    CODECS[profile['codec']]['ext'])
+                self._midi_to_audio(abs_midi_path, abs_audio_path,
+                                    priority=PRIORITY_HIGH if preview else PRIORITY_NORMAL,
+                                    preview=preview, progress=progress)
+                restored.append(audio_path)
             
-            # 在小节开始添加碎音镲
-            if i == 0 and style == 'rhythmic':
-                note = pretty_midi.Note(
-                    velocity=90,
-                    pitch=crash,
-                    start=current_time,
-                    end=current_time + 0.3
-                )
-                drums.notes.append(note)
+            if restored:
+                logger.info(f"已重新生成缺失的文件: {', '.join(restored)}")
+            return {
+                'status': 'success',
+                'midi_path': midi_path,
+                'audio_path': audio_path,
+                'restored': restored
+            }
+        except Exception as e:
+            logger.error(f"重新生成文件失败: {str(e)}", exc_info=True)
+            return {
+                'status': 'error',
+                'message': str(e)
+            }
+    
+    def _midi_to_audio(self, midi_path: str, output_path: str, priority: int = PRIORITY_NORMAL,
+                       preview: bool = False, progress: Optional[Callable] = None):
+        """将 MIDI 文件转换为音频文件
+
+        output_path 按渲染输入寻址（见 _render_key），音频与旁路文件都已存在时就是相同输入的渲染结果，
+        直接返回，不再占用合成器；存储本身即是渲染缓存，不另存副本
+        """
+        profile = self._render_profile(preview)
+        if self._rendered(output_path, profile):
+            logger.info(f"已有渲染结果: {output_path}")
+            if progress is not None:
+                progress('rendering', percent=100, cached=True)
+            return
         
-        pm.instruments.append(drums)
+        if self.render_pool is None:
+            if self._synth is None:
+                self._synth = self._create_synth()
+            self._render_audio(self._synth, None, midi_path, output_path, profile, progress)
+        else:
+            # 交给渲染池，由持有常驻合成器的工作线程完成
+            future = self.render_pool.submit(self._render_audio, midi_path, output_path, profile,
+                                             priority=priority, progress=progress)
+            future.result()
+    
+    @staticmethod
+    def _rendered(output_path: str, profile: Dict) -> bool:
+        """音频及其旁路文件（波形峰值、Opus 档位、完整的 HLS 分段）是否都已存在"""
+        paths = [output_path, peaks_path_for(output_path)]
+        paths += [tier_path(output_path, tier) for tier in json.loads(profile.get('opus_tiers') or '{}')]
+        if not all(os.path.exists(path) for path in paths):
+            return False
+        return not json.loads(profile.get('segments') or 'null') or playlist_complete(segments_dir_for(output_path))
+    
+    def _render_key(self, midi_path: str, profile: Dict) -> str:
+        """渲染输入的摘要（MIDI 内容 + 音色库 + 合成与编码设置），用作音频的存储地址"""
+        return render_cache_key(midi_path, self._synth_soundfont(),
+                                gain=self.synth_gain, backend=self._backend(), **profile)
+    
+    def _render_audio(self, synth, job, midi_path: str, output_path: str, profile: Dict,
+                      progress: Optional[Callable] = None):
+        """使用给定的合成器渲染音频（在渲染池工作线程或当前线程中执行）
+
+        编码器写入临时文件，全部编码完成后才替换到 output_path；
+        失败或超时时抛出异常，不在按渲染输入寻址的路径上留下替代文件或半成品
+        """
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        
+        check = job.check_deadline if job is not None else None
+        if profile['mode'] == 'tracks':
+            # 分音轨模式在进程池中合成，不使用工作线程的常驻合成器
+            self._render_tracks(midi_path, output_path, profile, check, progress)
+        elif synth is None:
+            raise RuntimeError('没有可用的合成器，无法将 MIDI 转换为音频')
+        else:
+            # 合成器逐块输出 PCM，直接送入编码器，不经过临时 WAV 文件；
+            # 在块之间检查渲染任务是否超时
+            # 鼓点用缓存的小节拼接，其余声部按循环感知方式渲染
+            base = LoopRenderer(synth, profile['loop_tolerance']) if profile['loop_tolerance'] else synth
+            renderer = GrooveRenderer(synth, self.groove_cache, self._groove_identity(), base)
+            blocks = renderer.iter_blocks(midi_path, check)
+            self._encode(blocks, synth.sample_rate, output_path, profile,
+                         progress, self._progress_seconds(midi_path, profile) if progress else None)
+        
+        # 设置输出文件权限
+        os.chmod(output_path, 0o666)
+        
+        logger.info(f"成功将MIDI转换为音频: {output_path}")
+    
+    @staticmethod
+    def _progress_seconds(midi_path: str, profile: Dict) -> float:
+        """估算渲染输出的时长（用于计算进度百分比）"""
+        seconds = pretty_midi.PrettyMIDI(midi_path).get_end_time()
+        return min(seconds, profile['max_seconds']) if profile['max_seconds'] else seconds
+    
+    def _encode(self, blocks, sample_rate: int, output_path: str, profile: Dict,
+                progress: Optional[Callable] = None, seconds: Optional[float] = None):
+        """按渲染档位截断、母带处理、混为单声道、降采样并编码 PCM 块
+
+        同时在音频旁写出波形峰值文件，以及配置的 Opus 码率档位和 HLS 分段（同一 PCM 流并行编码）；
+        指定 progress 时按 seconds 报告 rendering 与 encoding 进度
+        """
+        if profile['max_seconds']:
+            # 截断后不再从合成器取数据，合成只进行到这里
+            blocks = limit_duration(blocks, sample_rate, profile['max_seconds'])
+        mastering = json.loads(profile.get('mastering') or 'null')
+        if progress is not None and seconds:
+            # 合成、母带处理与编码同步进行，合成结束后只剩前视延迟线与编码器收尾
+            blocks = report_progress(blocks, sample_rate, seconds, progress, 'rendering', finished='encoding')
+        if mastering:
+            blocks = master(blocks, sample_rate, mastering['target_lufs'], mastering['ceiling_db'],
+                            lookahead=mastering['lookahead'])
+        peaks = PeakRecorder(sample_rate)
+        blocks = peaks.tap(blocks)
+        if profile['channels'] == 1:
+            blocks = to_mono(blocks)
+        factor, remainder = divmod(sample_rate, profile['sample_rate'])
+        if remainder:
+            raise ValueError(f"输出采样率 {profile['sample_rate']} 不是合成采样率 {sample_rate} 的整数分之一")
+        if factor > 1:
+            blocks = decimate(blocks, factor)
+            sample_rate //= factor
+        targets = [{'path': output_path, 'codec': profile['codec'], 'bitrate': profile['bitrate']}]
+        for tier, bitrate in json.loads(profile.get('opus_tiers') or '{}').items():
+            targets.append({'path': tier_path(output_path, tier), 'codec': OPUS_CODEC, 'bitrate': bitrate})
+        segments = json.loads(profile.get('segments') or 'null')
+        if segments:
+            # 段随编码进度逐个写出，渲染尚未结束时即可开始播放
+            segments_dir = segments_dir_for(output_path)
+            targets.append({'path': segments_dir, 'encoder': SegmentedEncoder(
+                segments_dir, segments['bitrate'], sample_rate, profile['channels'], segments['seconds'])})
+        encode_blocks_multi(blocks, targets, sample_rate=sample_rate, channels=profile['channels'])
+        peaks.save(peaks_path_for(output_path))
+    
+    def _render_track_buffers(self, midi_path: str, work_dir: str, stems_dir: str, check=None) -> Dict:
+        """分音轨并行合成并写出分轨文件，返回 {音轨名: float32 立体声数组}"""
+        if self.track_renderer is None:
+            self.track_renderer = TrackRenderer()
+        return self.track_renderer.render(midi_path, work_dir, self._backend(), self._synth_soundfont(),
+                                          self.sample_rate, self.synth_gain, check,
+                                          stems_dir=stems_dir, stem_codec=available_codec(self.stem_codec),
+                                          loop_tolerance=self.loop_tolerance)
     
-    def _midi_to_audio(self, midi_path: str, output_path: str):
-        """将 MIDI 文件转换为音频文件"""
+    @staticmethod
+    def stems_dir_for(audio_path: str) -> str:
+        """音频文件对应的分轨目录"""
+        return os.path.splitext(audio_path)[0] + '_stems'
+    
+    def _render_tracks(self, midi_path: str, output_path: str, profile: Dict, check=None,
+                       progress: Optional[Callable] = None):
+        """分音轨合成后在 NumPy 中混音；分轨随完整音频一起保存，导出时无需重新渲染"""
+        work_dir = tempfile.mkdtemp(prefix='tracks_')
         try:
-            # 确保输出目录存在
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            
-            # 检查文件权限
-            if os.path.exists(output_path):
-                os.chmod(output_path, 0o666)
-            
-            # 转换MIDI到音频
-            if self.fs is None:
-                logger.warning("FluidSynth 未初始化，跳过音频转换")
-                # 直接复制一个示例音频文件作为应急方案
-                try:
-                    import shutil
-                    default_audio = os.path.join('app', 'static', 'generated', 'default_audio.mp3')
-                    if os.path.exists(default_audio):
-                        shutil.copy(default_audio, output_path)
-                        logger.info(f"已使用默认音频文件作为替代: {output_path}")
-                except Exception as copy_error:
-                    logger.error(f"无法使用默认音频文件: {str(copy_error)}")
-                return
-            
-            # 如果soundfont是JS格式，不能直接使用FluidSynth转换
-            if hasattr(self, '_current_soundfont') and self._current_soundfont.endswith('.js'):
-                logger.warning("使用JS格式的SoundFont，无法直接转换MIDI，将使用替代方案")
-                # 此处可以实现从JS SoundFont提取音频数据的逻辑，或者使用其他方式生成音频
-                # 作为临时解决方案，我们可以直接复制一个示例音频文件
+            if progress is not None:
+                progress('rendering', percent=0)
+            tracks = self._render_track_buffers(midi_path, work_dir, self.stems_dir_for(output_path), check)
+            self._encode(iter_mix(tracks, self.track_mix), self.sample_rate, output_path, profile,
+                         progress, self._progress_seconds(midi_path, profile) if progress else None)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def render_stems(self, midi_path: str, audio_path: str) -> Dict:
+        """返回项目的分轨文件（相对路径），没有时分音轨渲染一次"""
+        try:
+            stems_dir = self.stems_dir_for(os.path.join('app', 'static', audio_path))
+            # 分轨目录在全部音轨编码完成后才出现（见 TrackRenderer.render），存在即是完整的
+            if not os.path.isdir(stems_dir):
+                work_dir = tempfile.mkdtemp(prefix='tracks_')
                 try:
-                    import shutil
-                    default_audio = os.path.join('app', 'static', 'generated', 'default_audio.mp3')
-                    if os.path.exists(default_audio):
-                        shutil.copy(default_audio, output_path)
-                        logger.info(f"已使用默认音频文件作为替代: {output_path}")
-                    else:
-                        # 如果没有默认音频，尝试使用系统命令生成一个短音频
-                        try:
-                            self.fs.midi_to_audio(midi_path, output_path)
-                            logger.info(f"成功将MIDI转换为音频: {output_path}")
-                        except:
-                            logger.error("无法转换MIDI，生成空音频文件")
-                            with open(output_path, 'wb') as f:
-                                # 创建一个空的MP3文件
-                                f.write(b'')
-                except Exception as copy_error:
-                    logger.error(f"无法创建替代音频文件: {str(copy_error)}")
-                return
-            
-            # 使用FluidSynth转换
-            self.fs.midi_to_audio(midi_path, output_path)
-            
-            # 设置输出文件权限
-            os.chmod(output_path, 0o666)
-            
-            logger.info(f"成功将MIDI转换为音频: {output_path}")
+                    self._render_track_buffers(os.path.join('app', 'static', midi_path), work_dir, stems_dir)
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+            paths = [os.path.join(stems_dir, name) for name in sorted(os.listdir(stems_dir))]
+            static_dir = os.path.join('app', 'static')
+            return {
+                'status': 'success',
+                'stems': [os.path.relpath(path, static_dir).replace('\\', '/') for path in paths]
+            }
         except Exception as e:
-            logger.error(f"MIDI转换失败: {str(e)}", exc_info=True)
-            # 不要直接抛出异常，而是创建一个空文件作为替代
-            try:
-                with open(output_path, 'wb') as f:
-                    f.write(b'')
-                logger.warning(f"创建了空音频文件作为替代: {output_path}")
-            except:
-                pass
-            # 不严重中断整个程序
-            # raise RuntimeError(f"MIDI转换失败: {str(e)}")
+            logger.error(f"渲染分轨失败: {str(e)}", exc_info=True)
+            return {
+                'status': 'error',
+                'message': str(e)
+            }
     
     def _parse_chord_progression(self, chord_string: str, scale: str = 'major') -> List[List[int]]:
         """解析和弦进行并转换为 MIDI 音符数字"""
@@ -1373,29 +1768,20 @@ class MusicGenerator:
             # 生成補充內容
             # TODO: 實現音樂補全邏輯
             
-            # 保存結果
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            midi_filename = f"completed_{timestamp}.mid"
-            audio_filename = f"completed_audio_{timestamp}.mp3"
-            
-            # 生成相对路径
-            midi_path = os.path.join('generated', midi_filename)
-            audio_path = os.path.join('generated', audio_filename)
-            
-            # 生成绝对路径（用于实际文件操作）
-            abs_midi_path = os.path.join('app', 'static', midi_path)
-            abs_audio_path = os.path.join('app', 'static', audio_path)
-            
-            # 保存MIDI文件
-            pm.write(abs_midi_path)
+            # 保存結果（按內容摘要命名）
+            midi_path = self.storage.write('completed', 'mid', pm.write)
+            abs_midi_path = self.storage.absolute_path(midi_path)
+            profile = self._render_profile()
+            audio_path, abs_audio_path = self.storage.reserve(
+                self._render_key(abs_midi_path, profile), 'completed_audio', CODECS[profile['codec']]['ext'])
             
             # 轉換為音頻
             self._midi_to_audio(abs_midi_path, abs_audio_path)
             
             return {
                 'status': 'success',
-                'midi_path': midi_path.replace('\\', '/'),
-                'audio_path': audio_path.replace('\\', '/')
+                'midi_path': midi_path,
+                'audio_path': audio_path
             }
         except Exception as e:
             logger.error(f"音轨补全失败: {str(e)}", exc_info=True)
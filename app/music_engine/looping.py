@@ -0,0 +1,169 @@
+import logging
+import os
+import tempfile
+from collections import Counter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pretty_midi
+
+logger = logging.getLogger(__name__)
+
+SILENCE = 1e-6  # 低于此幅度的尾部样本视为静音，不参与叠加
+
+
+def render_clip(synth, midi_path: str, check: Optional[Callable[[], None]] = None) -> np.ndarray:
+    """把一小段 MIDI 完整渲染到内存（包括释音尾巴），去掉尾部静音"""
+    blocks = list(synth.iter_blocks(midi_path, check))
+    audio = np.concatenate(blocks) if blocks else np.zeros((0, 2), dtype=np.float32)
+    loud = np.flatnonzero(np.abs(audio).max(axis=1) > SILENCE)
+    return np.ascontiguousarray(audio[:loud[-1] + 1] if len(loud) else audio[:0], dtype=np.float32)
+
+
+def write_midi(pm: pretty_midi.PrettyMIDI, instruments: List[pretty_midi.Instrument], path: str):
+    """借用已有的 PrettyMIDI 对象写出指定声部，保留速度表与分辨率"""
+    original = pm.instruments
+    try:
+        pm.instruments = instruments
+        pm.write(path)
+    finally:
+        pm.instruments = original
+
+
+def overlay(base: Iterator[np.ndarray], buffers: Dict, placements: List,
+            block_frames: int = 4096) -> Iterator[np.ndarray]:
+    """在基础 PCM 流上按位置叠加缓存的片段
+
+    placements 为按起始帧排序的 [(起始帧, 片段键)]，基础流结束后继续输出到最后一个片段结束
+    """
+    end = max((start + len(buffers[key]) for start, key in placements), default=0)
+    position = 0
+    active = []
+    following = 0
+    while True:
+        block = next(base, None)
+        if block is None:
+            if position >= end:
+                break
+            block = np.zeros((min(block_frames, end - position), 2), dtype=np.float32)
+        else:
+            block = np.array(block, dtype=np.float32)
+        stop = position + len(block)
+        while following < len(placements) and placements[following][0] < stop:
+            active.append(placements[following])
+            following += 1
+        remaining = []
+        for start, key in active:
+            buffer = buffers[key]
+            a, b = max(position, start), min(stop, start + len(buffer))
+            if a < b:
+                block[a - position:b - position] += buffer[a - start:b - start]
+            if start + len(buffer) > stop:
+                remaining.append((start, key))
+        active = remaining
+        position = stop
+        yield block
+
+
+def _part_key(instrument: pretty_midi.Instrument) -> Tuple:
+    """声部标识：鼓组合并为一个声部，其余按音色和名称区分"""
+    if instrument.is_drum:
+        return (instrument.program, True, '')
+    return (instrument.program, False, instrument.name)
+
+
+class LoopRenderer:
+    """循环感知渲染
+
+    生成的曲子会反复演奏同一组和弦，许多声部在不同小节中音符完全相同。
+    按声部和小节计算音符签名（时间按 tolerance 量化），出现两次以上的小节只合成一次
+    （包括释音尾巴），再按出现位置叠加到输出中；只出现一次的音符合在一起整体渲染一遍。
+    包装任意提供 iter_blocks 的合成器，输出接口与其相同。
+    """
+
+    BLOCK_FRAMES = 4096
+
+    def __init__(self, synth, tolerance: float = 0.005, min_repeats: int = 2):
+        self.synth = synth
+        self.sample_rate = synth.sample_rate
+        self.tolerance = tolerance
+        self.min_repeats = min_repeats
+
+    def _signature(self, notes: List[pretty_midi.Note], bar_start: float) -> Tuple:
+        q = self.tolerance
+        return tuple(sorted((n.pitch, n.velocity, round((n.start - bar_start) / q), round((n.end - n.start) / q))
+                            for n in notes))
+
+    def plan(self, pm: pretty_midi.PrettyMIDI):
+        """划分循环片段
+
+        返回 (剩余音符的声部列表, {片段键: (声部模板, 相对时间的音符)}, [(起始帧, 片段键)])
+        """
+        downbeats = pm.get_downbeats()
+        bars: Dict[Tuple, Dict[int, List[pretty_midi.Note]]] = {}
+        templates: Dict[Tuple, pretty_midi.Instrument] = {}
+        residual: Dict[Tuple, List[pretty_midi.Note]] = {}
+        for instrument in pm.instruments:
+            key = _part_key(instrument)
+            templates.setdefault(key, instrument)
+            part_bars = bars.setdefault(key, {})
+            for note in instrument.notes:
+                index = int(np.searchsorted(downbeats, note.start + self.tolerance / 2, side='right')) - 1
+                if index < 0:
+                    residual.setdefault(key, []).append(note)
+                else:
+                    part_bars.setdefault(index, []).append(note)
+
+        # 统计每个声部中各小节签名的出现次数
+        signatures = {}
+        counts = Counter()
+        for key, part_bars in bars.items():
+            for index, notes in part_bars.items():
+                signature = (key, self._signature(notes, downbeats[index]))
+                signatures[key, index] = signature
+                counts[signature] += 1
+
+        spans = {}
+        placements = []
+        for (key, index), signature in signatures.items():
+            notes = bars[key][index]
+            if counts[signature] < self.min_repeats:
+                residual.setdefault(key, []).extend(notes)
+                continue
+            bar_start = downbeats[index]
+            if signature not in spans:
+                relative = [pretty_midi.Note(n.velocity, n.pitch, n.start - bar_start, n.end - bar_start)
+                            for n in notes]
+                spans[signature] = (templates[key], relative)
+            placements.append((int(bar_start * self.sample_rate), signature))
+
+        parts = []
+        for key, notes in residual.items():
+            template = templates[key]
+            part = pretty_midi.Instrument(template.program, template.is_drum, template.name)
+            part.notes = sorted(notes, key=lambda n: n.start)
+            parts.append(part)
+        placements.sort(key=lambda p: p[0])
+        return parts, spans, placements
+
+    def iter_blocks(self, midi_path: str, check: Optional[Callable[[], None]] = None) -> Iterator[np.ndarray]:
+        pm = pretty_midi.PrettyMIDI(midi_path)
+        parts, spans, placements = self.plan(pm)
+        if not spans:
+            yield from self.synth.iter_blocks(midi_path, check)
+            return
+
+        with tempfile.TemporaryDirectory(prefix='loops_') as work_dir:
+            buffers = {}
+            for i, (signature, (template, notes)) in enumerate(spans.items()):
+                part = pretty_midi.Instrument(template.program, template.is_drum, template.name)
+                part.notes = notes
+                path = os.path.join(work_dir, f"span_{i}.mid")
+                write_midi(pm, [part], path)
+                buffers[signature] = render_clip(self.synth, path, check)
+            logger.debug(f"循环渲染: {len(spans)} 个片段覆盖 {len(placements)} 个小节")
+
+            residual_path = os.path.join(work_dir, 'residual.mid')
+            write_midi(pm, parts, residual_path)
+            yield from overlay(self.synth.iter_blocks(residual_path, check), buffers, placements,
+                               self.BLOCK_FRAMES)
@@ -0,0 +1,301 @@
+import logging
+from collections import deque
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+from scipy import signal
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import minimum_filter1d
+
+logger = logging.getLogger(__name__)
+
+# 母带处理：按 ITU-R BS.1770 测量响度，增益到目标 LUFS，再经过真峰值限制器。
+# 单遍流式处理：信号经过 lookahead 秒的延迟线，增益按目前为止（含前视部分）的门限整体响度确定，
+# 并以有限的速度变化，避免随段落起伏“抽吸”；合成器输出的块延迟 lookahead 秒后即可编码，
+# 不在磁盘上保存中间音频，内存占用只与前视长度有关。
+#
+# 开销：逐采样的只有 K 加权滤波、每块一次增益乘法与削波；响度按 100ms 段统计，
+# 限制器的峰值检测、保持与平滑按 GRAIN 个采样的颗粒计算，过采样插值只用于可能超过上限的颗粒。
+# 合成器的小块先合并为 CHUNK_SECONDS 秒再处理，减少每次调用的固定开销。
+
+ABSOLUTE_GATE = -70.0     # 绝对门限（LUFS）
+RELATIVE_GATE = -10.0     # 相对门限（LU）
+BLOCK_SECONDS = 0.4       # 门限块长度
+STEP_SECONDS = 0.1        # 门限块步长（75% 重叠）
+OVERSAMPLE = 4            # 真峰值检测的过采样倍数
+LOOKAHEAD_SECONDS = 3.0   # 前视长度：开始输出前先测量的时长
+GAIN_RATE_DB = 3.0        # 增益每秒最多变化的分贝数
+GRAIN = 32                # 限制器计算增益的颗粒（采样数）
+CHUNK_SECONDS = 0.25      # 合并输入块的最小时长
+
+
+def k_weighting(sample_rate: int) -> np.ndarray:
+    """K 加权滤波器（高频搁架 + 高通），返回二阶节系数"""
+    # 第一级：高频搁架
+    f0, gain_db, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = np.tan(np.pi * f0 / sample_rate)
+    vh = 10 ** (gain_db / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0,
+             1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    # 第二级：高通
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = np.tan(np.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    highpass = [1.0, -2.0, 1.0, 1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    return np.array([shelf, highpass])
+
+
+class LoudnessMeter:
+    """逐块累计的整体响度（LUFS）测量"""
+
+    def __init__(self, sample_rate: int, channels: int):
+        self.sos = k_weighting(sample_rate)
+        self.zi = np.zeros((len(self.sos), 2, channels))
+        self.step = int(STEP_SECONDS * sample_rate)
+        self.steps_per_block = int(round(BLOCK_SECONDS / STEP_SECONDS))
+        self._partial = 0.0
+        self._partial_frames = 0
+        self._recent = []  # 最近 steps_per_block - 1 个 100ms 段的平方和
+        self._blocks = np.zeros(1024)  # 每个 400ms 门限块的均方（按需扩容）
+        self._count = 0
+        self._integrated = None
+        self._stale = False
+
+    def feed(self, block: np.ndarray):
+        weighted, self.zi = signal.sosfilt(self.sos, block, axis=0, zi=self.zi)
+        energy = np.einsum('ij,ij->i', weighted, weighted)  # 每帧各声道平方和（左右声道权重均为 1）
+        head = self.step - self._partial_frames
+        if len(energy) < head:
+            self._partial += energy.sum()
+            self._partial_frames += len(energy)
+            return
+        full = (len(energy) - head) // self.step
+        end = head + full * self.step
+        steps = np.concatenate([[self._partial + energy[:head].sum()],
+                                energy[head:end].reshape(full, self.step).sum(axis=1)])
+        self._partial = energy[end:].sum()
+        self._partial_frames = len(energy) - end
+        self._add_steps(steps)
+
+    def _add_steps(self, steps: np.ndarray):
+        # 400ms 块的均方 = 4 个连续 100ms 段的平方和 / 帧数
+        n = self.steps_per_block
+        energies = np.concatenate([self._recent, steps])
+        self._recent = energies[-(n - 1):]
+        if len(energies) < n:
+            return
+        cumulative = np.concatenate([[0.0], np.cumsum(energies)])
+        blocks = (cumulative[n:] - cumulative[:-n]) / (n * self.step)
+        if self._count + len(blocks) > len(self._blocks):
+            self._blocks = np.resize(self._blocks, 2 * (self._count + len(blocks)))
+        self._blocks[self._count:self._count + len(blocks)] = blocks
+        self._count += len(blocks)
+        self._stale = True
+
+    def integrated(self) -> Optional[float]:
+        """整体响度；有效内容不足一个门限块时返回 None（结果缓存到下一个门限块）"""
+        if self._stale:
+            self._stale = False
+            blocks = self._blocks[:self._count]
+            with np.errstate(divide='ignore'):
+                loudness = -0.691 + 10 * np.log10(blocks)
+            gated = blocks[loudness > ABSOLUTE_GATE]
+            if len(gated):
+                relative = -0.691 + 10 * np.log10(gated.mean()) + RELATIVE_GATE
+                gated = blocks[(loudness > ABSOLUTE_GATE) & (loudness > relative)]
+                self._integrated = float(-0.691 + 10 * np.log10(gated.mean()))
+        return self._integrated
+
+
+class TruePeakLimiter:
+    """前视真峰值限制器
+
+    按 GRAIN 个采样的颗粒计算增益：每个颗粒的采样峰值乘以插值滤波器系数绝对值之和不超过上限时，
+    过采样后也不会超过，增益为 1；否则用 4 倍过采样的多相滤波器求出颗粒内的真峰值。
+    颗粒增益在“前视 + 保持”窗口上取最小值后再做等长滑动平均，保证增益平滑且在峰值到达之前已经降到位，
+    信号相应延迟；颗粒内的增益线性过渡，且不超过该颗粒的增益。状态跨块保留。
+    """
+
+    def __init__(self, sample_rate: int, channels: int, ceiling_db: float = -1.0,
+                 lookahead: float = 0.005, release: float = 0.05):
+        self.ceiling = 10 ** (ceiling_db / 20)
+        self.channels = channels
+        taps = signal.firwin(OVERSAMPLE * 12, 1.0 / OVERSAMPLE) * OVERSAMPLE
+        # 每列是一个相位的插值滤波器（按卷积方向反转），一次矩阵乘法得到 4 个插值点
+        self.phases = np.stack([taps[p::OVERSAMPLE][::-1] for p in range(OVERSAMPLE)], axis=1).astype(np.float32)
+        self.width = len(self.phases)
+        # 插值点的幅度不超过邻近采样峰值乘以滤波器系数绝对值之和，据此跳过明显低于上限的颗粒
+        self.threshold = self.ceiling / np.abs(self.phases).sum(axis=0).max()
+        self.peak_delay = int(round((len(taps) - 1) / 2 / OVERSAMPLE))
+        self.attack = max(int(np.ceil(lookahead * sample_rate / GRAIN)), 1)  # 颗粒数
+        self.hold = self.attack + int(np.ceil(release * sample_rate / GRAIN))
+        self.delay = self.attack * GRAIN + self.peak_delay
+        self._pending = np.zeros((0, channels), dtype=np.float32)  # 不足一个颗粒的输入
+        self._history = np.zeros((self.width - 1, channels), dtype=np.float32)
+        self._last_peak = 0.0  # 上一个颗粒的采样峰值（插值窗口跨入本颗粒）
+        self._target_tail = np.ones(self.hold - 1)
+        self._hold_tail = np.ones(self.attack - 1)
+        self._last_gain = 1.0
+        self._signal_tail = np.zeros((self.delay, channels), dtype=np.float32)
+        self._skip = self.delay  # 延迟线开头的空白不输出，输出与输入等长且对齐
+
+    def _grain_targets(self, grains: np.ndarray) -> np.ndarray:
+        """每个颗粒的目标增益（ceiling / 真峰值，不超过 1）"""
+        count = len(grains) // GRAIN
+        peaks = np.abs(grains).reshape(count, -1).max(axis=1)
+        bound = np.maximum(peaks, np.concatenate([[self._last_peak], peaks[:-1]]))
+        self._last_peak = peaks[-1]
+        targets = np.ones(count)
+        history = self._history
+        self._history = grains[-(self.width - 1):].copy()
+        for index in np.flatnonzero(bound >= self.threshold):
+            # 插值点以颗粒内每个采样结束的窗口计算（(GRAIN, 声道, width) @ (width, 相位)）
+            start = index * GRAIN - (self.width - 1)
+            span = grains[max(start, 0):(index + 1) * GRAIN]
+            if start < 0:
+                span = np.concatenate([history[start:], span])
+            peak = float(np.abs(sliding_window_view(span, self.width, axis=0) @ self.phases).max())
+            if peak > self.ceiling:
+                targets[index] = self.ceiling / peak
+        return targets
+
+    def _gains(self, targets: np.ndarray) -> np.ndarray:
+        """颗粒增益：保持（取此前 hold 个目标的最小值）后做 attack 长度的滑动平均"""
+        count = len(targets)
+        extended = np.concatenate([self._target_tail, targets])
+        held = minimum_filter1d(extended, self.hold, origin=(self.hold - 1) // 2)[-count:]
+        self._target_tail = extended[-(self.hold - 1):] if self.hold > 1 else self._target_tail
+        extended = np.concatenate([self._hold_tail, held])
+        cumulative = np.concatenate([[0.0], np.cumsum(extended)])
+        gains = (cumulative[self.attack:] - cumulative[:-self.attack]) / self.attack
+        self._hold_tail = extended[-(self.attack - 1):] if self.attack > 1 else self._hold_tail
+        return gains
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if len(block) == 0:
+            return block
+        pending = np.concatenate([self._pending, block])
+        usable = len(pending) // GRAIN * GRAIN
+        grains, self._pending = pending[:usable], pending[usable:]
+        if usable == 0:
+            return grains
+
+        gains = self._gains(self._grain_targets(grains))
+        # 信号延迟，使增益在峰值到达前生效
+        delayed = np.concatenate([self._signal_tail, grains])
+        out, self._signal_tail = delayed[:usable], delayed[usable:]
+        previous = np.concatenate([[self._last_gain], gains[:-1]])
+        self._last_gain = gains[-1]
+        if gains.min() < 1.0 or previous.min() < 1.0:
+            # 颗粒内从 min(上一颗粒, 本颗粒) 线性过渡到本颗粒的增益，任何采样都不超过本颗粒的增益
+            start = np.minimum(previous, gains)
+            ramp = start[:, None] + (gains - start)[:, None] * (np.arange(1, GRAIN + 1) / GRAIN)
+            out = out * ramp.reshape(-1, 1).astype(np.float32)
+            np.clip(out, -self.ceiling, self.ceiling, out=out)
+        if self._skip:
+            skipped = min(self._skip, len(out))
+            out = out[skipped:]
+            self._skip -= skipped
+        return out
+
+    def flush(self) -> np.ndarray:
+        """输出延迟线与未满颗粒中剩余的信号"""
+        remaining = len(self._pending) + self.delay - self._skip
+        padding = -(len(self._pending) + self.delay) % GRAIN + self.delay
+        return self.process(np.zeros((padding, self.channels), dtype=np.float32))[:remaining]
+
+
+class LoudnessNormalizer:
+    """流式响度归一化：前视延迟线 + 按目前为止的门限整体响度缓慢调整增益
+
+    增益目标为 target_lufs 减去已测量部分（比输出超前 lookahead 秒）的整体响度，最多 max_gain_db；
+    开始输出时直接采用第一个估计值，之后每秒最多变化 rate_db 分贝，块内按幅度线性过渡
+    （每块的变化不到 1 分贝，与按分贝过渡的差别可以忽略）。
+    """
+
+    def __init__(self, sample_rate: int, channels: int, target_lufs: float = -14.0,
+                 max_gain_db: float = 20.0, lookahead: float = LOOKAHEAD_SECONDS, rate_db: float = GAIN_RATE_DB):
+        self.meter = LoudnessMeter(sample_rate, channels)
+        self.sample_rate = sample_rate
+        self.target_lufs = target_lufs
+        self.max_gain_db = max_gain_db
+        self.lookahead = int(lookahead * sample_rate)
+        self.rate_db = rate_db
+        self.gain_db = None
+        self._pending = deque()
+        self._pending_frames = 0
+
+    def _target_db(self) -> float:
+        loudness = self.meter.integrated()
+        return 0.0 if loudness is None else min(self.target_lufs - loudness, self.max_gain_db)
+
+    def _emit(self, frames: int) -> np.ndarray:
+        parts = []
+        while frames > 0:
+            block = self._pending[0]
+            if len(block) <= frames:
+                parts.append(self._pending.popleft())
+            else:
+                parts.append(block[:frames])
+                self._pending[0] = block[frames:]
+            frames -= len(parts[-1])
+            self._pending_frames -= len(parts[-1])
+        out = np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+        target = self._target_db()
+        start = target if self.gain_db is None else self.gain_db
+        step = self.rate_db * len(out) / self.sample_rate
+        end = start + max(-step, min(step, target - start))
+        self.gain_db = end
+        if end == start:
+            return out * np.float32(10 ** (end / 20))
+        ramp = np.linspace(10 ** (start / 20), 10 ** (end / 20), len(out), endpoint=False, dtype=np.float32)
+        return out * ramp[:, None]
+
+    def process(self, block: np.ndarray) -> Optional[np.ndarray]:
+        """送入一块，返回延迟线中可以输出的部分（前视未满时为 None）"""
+        self.meter.feed(block)
+        self._pending.append(block)
+        self._pending_frames += len(block)
+        excess = self._pending_frames - self.lookahead
+        return self._emit(excess) if excess > 0 else None
+
+    def flush(self) -> Optional[np.ndarray]:
+        return self._emit(self._pending_frames) if self._pending_frames else None
+
+
+def chunked(blocks: Iterable[np.ndarray], frames: int) -> Iterator[np.ndarray]:
+    """把连续的小块合并为至少 frames 帧的 float32 块"""
+    parts, count = [], 0
+    for block in blocks:
+        parts.append(np.asarray(block, dtype=np.float32))
+        count += len(block)
+        if count >= frames:
+            yield np.concatenate(parts) if len(parts) > 1 else np.ascontiguousarray(parts[0])
+            parts, count = [], 0
+    if count:
+        yield np.concatenate(parts) if len(parts) > 1 else np.ascontiguousarray(parts[0])
+
+
+def master(blocks: Iterable[np.ndarray], sample_rate: int, target_lufs: float = -14.0,
+           ceiling_db: float = -1.0, max_gain_db: float = 20.0,
+           lookahead: float = LOOKAHEAD_SECONDS) -> Iterator[np.ndarray]:
+    """母带处理流水线步骤：流式响度归一化 + 真峰值限制"""
+    normalizer = limiter = None
+    for block in chunked(blocks, int(CHUNK_SECONDS * sample_rate)):
+        if normalizer is None:
+            normalizer = LoudnessNormalizer(sample_rate, block.shape[1], target_lufs, max_gain_db, lookahead)
+            limiter = TruePeakLimiter(sample_rate, block.shape[1], ceiling_db)
+        out = normalizer.process(block)
+        if out is not None:
+            yield limiter.process(out)
+    if normalizer is None:
+        return
+    out = normalizer.flush()
+    if out is not None:
+        yield limiter.process(out)
+    logger.debug(f"整体响度 {normalizer.meter.integrated()} LUFS，最终增益 {normalizer.gain_db:+.2f} dB"
+                 if normalizer.gain_db is not None else "没有可归一化的内容")
+    yield limiter.flush()
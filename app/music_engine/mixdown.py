@@ -0,0 +1,219 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+import pretty_midi
+
+from .encoder import CODECS, encode_blocks
+from .looping import LoopRenderer
+from .synth import FluidSynthEngine, FluidSynthCliEngine
+from .wavetable import WavetableSynth
+
+logger = logging.getLogger(__name__)
+
+# 各音轨默认的增益与声像（-1 为最左，1 为最右），可通过 TRACK_MIX 配置覆盖
+DEFAULT_MIX = {
+    'melody': {'gain': 1.0, 'pan': 0.0},
+    'chords': {'gain': 0.8, 'pan': -0.25},
+    'bass': {'gain': 1.0, 'pan': 0.0},
+    'drums': {'gain': 0.9, 'pan': 0.15},
+}
+
+BLOCK_FRAMES = 4096
+
+# 工作进程内按合成参数缓存的合成器，音色库只在每个进程中加载一次
+_worker_synths = {}
+
+
+def track_name(instrument: pretty_midi.Instrument, index: int) -> str:
+    """音轨名：鼓组统一归为 drums，其余使用乐器名或序号"""
+    if instrument.is_drum:
+        return 'drums'
+    name = ''.join(c for c in instrument.name.strip().lower() if c.isalnum() or c in '-_')
+    return name or f"track{index}"
+
+
+def split_tracks(midi_path: str, output_dir: str) -> Dict[str, str]:
+    """把 MIDI 按音轨拆成多个文件，同名音轨（例如每小节一个的鼓组）合并到一起
+
+    返回 {音轨名: MIDI 路径}
+    """
+    pm = pretty_midi.PrettyMIDI(midi_path)
+    groups: Dict[str, List[pretty_midi.Instrument]] = {}
+    for index, instrument in enumerate(pm.instruments):
+        if instrument.notes:
+            groups.setdefault(track_name(instrument, index), []).append(instrument)
+
+    # 复用原对象写出，保留速度变化与分辨率
+    instruments = pm.instruments
+    paths = {}
+    try:
+        for name, group in groups.items():
+            pm.instruments = group
+            paths[name] = os.path.join(output_dir, f"{name}.mid")
+            pm.write(paths[name])
+    finally:
+        pm.instruments = instruments
+    return paths
+
+
+def _worker_synth(backend: str, soundfont: Optional[str], sample_rate: int, gain: float):
+    key = (backend, soundfont, sample_rate, gain)
+    synth = _worker_synths.get(key)
+    if synth is None:
+        if backend == 'fluidsynth':
+            for engine in (FluidSynthEngine, FluidSynthCliEngine):
+                try:
+                    synth = engine(soundfont, sample_rate, gain)
+                    break
+                except Exception as e:
+                    logger.warning(f"无法创建 {engine.__name__}: {str(e)}")
+        if synth is None:
+            synth = WavetableSynth(sample_rate, gain)
+        _worker_synths[key] = synth
+    return synth
+
+
+def render_track(midi_path: str, output_path: str, backend: str, soundfont: Optional[str],
+                 sample_rate: int, gain: float, stem_path: Optional[str] = None,
+                 stem_codec: str = 'flac', loop_tolerance: Optional[float] = None) -> int:
+    """在工作进程中把一个音轨渲染为 float32 立体声 .npy，返回帧数
+
+    指定 stem_path 时同时编码分轨文件，各音轨的编码也因此并行进行
+    """
+    synth = _worker_synth(backend, soundfont, sample_rate, gain)
+    if loop_tolerance:
+        synth = LoopRenderer(synth, loop_tolerance)
+    blocks = list(synth.iter_blocks(midi_path))
+    audio = np.concatenate(blocks) if blocks else np.zeros((0, 2), dtype=np.float32)
+    audio = audio.astype(np.float32, copy=False)
+    np.save(output_path, audio)
+    if stem_path:
+        encode_blocks(iter_track(audio), stem_path, codec=stem_codec, bitrate=None,
+                      sample_rate=sample_rate, channels=2)
+    return len(audio)
+
+
+def publish_dir(tmp_dir: str, output_dir: str):
+    """把写完的临时目录改名为目标目录（目录不能原子覆盖，先移走已有的旧目录）"""
+    if os.path.exists(output_dir):
+        stale = f"{tmp_dir}.old"
+        try:
+            os.replace(output_dir, stale)
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(stale, ignore_errors=True)
+    try:
+        os.replace(tmp_dir, output_dir)
+    except OSError:
+        # 另一次渲染刚好先发布了同一目录
+        if not os.path.isdir(output_dir):
+            raise
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def pan_gains(pan: float):
+    """平衡声像：居中时左右声道都是 1，与整体渲染的电平一致"""
+    pan = max(-1.0, min(1.0, pan))
+    return min(1.0, 1.0 - pan), min(1.0, 1.0 + pan)
+
+
+def iter_mix(tracks: Dict[str, np.ndarray], mix: Dict[str, Dict]) -> Iterator[np.ndarray]:
+    """逐块混合各音轨（通常是内存映射的数组），产出 (帧数, 2) 的 float32 PCM"""
+    length = max((len(audio) for audio in tracks.values()), default=0)
+    weights = {}
+    for name in tracks:
+        settings = mix.get(name, {})
+        left, right = pan_gains(settings.get('pan', 0.0))
+        gain = settings.get('gain', 1.0)
+        weights[name] = np.array([left * gain, right * gain], dtype=np.float32)
+    for start in range(0, length, BLOCK_FRAMES):
+        end = min(start + BLOCK_FRAMES, length)
+        block = np.zeros((end - start, 2), dtype=np.float32)
+        for name, audio in tracks.items():
+            part = audio[start:end]
+            if len(part):
+                block[:len(part)] += part * weights[name]
+        yield block
+
+
+def iter_track(audio: np.ndarray) -> Iterator[np.ndarray]:
+    """把单个音轨切成块"""
+    for start in range(0, len(audio), BLOCK_FRAMES):
+        yield np.asarray(audio[start:start + BLOCK_FRAMES])
+
+
+class TrackRenderer:
+    """分音轨渲染：每个乐器音轨在独立进程中合成，再在 NumPy 中按增益和声像混合
+
+    进程池在首次使用时创建并常驻，工作进程各自保留合成器，音色库不会重复加载。
+    """
+
+    def __init__(self, processes: Optional[int] = None):
+        self.processes = processes or min(os.cpu_count() or 1, 4)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # 使用 spawn，避免在带有线程和合成器的进程中 fork
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def render(self, midi_path: str, work_dir: str, backend: str, soundfont: Optional[str],
+               sample_rate: int, gain: float, check: Optional[Callable[[], None]] = None,
+               stems_dir: Optional[str] = None, stem_codec: str = 'flac',
+               loop_tolerance: Optional[float] = None) -> Dict[str, np.ndarray]:
+        """并行渲染所有音轨，返回 {音轨名: 内存映射的 float32 立体声数组}
+
+        指定 stems_dir 时各音轨同时编码为分轨文件，先写到旁边的 .part 临时目录，
+        全部音轨完成后才改名为 stems_dir，中途失败不会留下不完整的分轨目录
+        """
+        paths = split_tracks(midi_path, work_dir)
+        tmp_dir = None
+        if stems_dir:
+            tmp_dir = f"{stems_dir}.{os.getpid()}.{threading.get_ident()}.part"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+        pool = self._pool()
+        futures = {}
+        for name, track_midi in paths.items():
+            npy_path = os.path.join(work_dir, f"{name}.npy")
+            stem_path = os.path.join(tmp_dir, f"{name}.{CODECS[stem_codec]['ext']}") if tmp_dir else None
+            future = pool.submit(render_track, track_midi, npy_path, backend, soundfont, sample_rate, gain,
+                                 stem_path, stem_codec, loop_tolerance)
+            futures[future] = (name, npy_path)
+
+        pending = set(futures)
+        try:
+            while pending:
+                # 等待期间定期检查渲染任务是否超时
+                done, pending = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                if check is not None:
+                    check()
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            if tmp_dir:
+                wait(pending)
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        if tmp_dir:
+            publish_dir(tmp_dir, stems_dir)
+        return {name: np.load(npy_path, mmap_mode='r') for name, npy_path in futures.values()}
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
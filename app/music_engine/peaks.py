@@ -0,0 +1,155 @@
+import logging
+import os
+import struct
+import subprocess
+import threading
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .encoder import find_ffmpeg
+
+logger = logging.getLogger(__name__)
+
+# 波形峰值旁路文件（与音频同名，扩展名 .peaks）
+#
+#   文件头  '<4sHHII'  魔数 PEAK、版本、级数、采样率、最细一级每点帧数
+#   每一级  '<I'       点数，随后是 点数 x 2 个 int8（最小值、最大值交替，满幅为 127）
+#
+# 每往上一级，每点覆盖的帧数乘以 LEVEL_FACTOR，直到点数少于 MIN_BINS。
+# 播放器按画布宽度取一级即可绘制，通常只需几 KB。
+
+MAGIC = b'PEAK'
+VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+LEVEL_HEADER = struct.Struct('<I')
+BASE_FRAMES = 256
+LEVEL_FACTOR = 4
+MIN_BINS = 512
+
+PEAKS_EXT = '.peaks'
+
+
+def peaks_path_for(audio_path: str) -> str:
+    """音频文件对应的峰值文件"""
+    return os.path.splitext(audio_path)[0] + PEAKS_EXT
+
+
+def _quantize(values: np.ndarray, round_up: bool) -> np.ndarray:
+    scaled = np.clip(values, -1.0, 1.0) * 127.0
+    scaled = np.ceil(scaled) if round_up else np.floor(scaled)
+    return scaled.astype(np.int8)
+
+
+def reduce_level(level: np.ndarray, factor: int = LEVEL_FACTOR) -> np.ndarray:
+    """把 (点数, 2) 的 min/max 数组按 factor 合并为更粗的一级"""
+    bins = -(-len(level) // factor)
+    padded = np.zeros((bins * factor, 2), dtype=np.int8)
+    padded[:len(level)] = level
+    grouped = padded.reshape(bins, factor, 2)
+    return np.stack([grouped[:, :, 0].min(axis=1), grouped[:, :, 1].max(axis=1)], axis=1)
+
+
+class PeakRecorder:
+    """在 PCM 流经过时记录每 BASE_FRAMES 帧的最小值与最大值（各声道合并）"""
+
+    def __init__(self, sample_rate: int, base_frames: int = BASE_FRAMES):
+        self.sample_rate = sample_rate
+        self.base_frames = base_frames
+        self._chunks: List[np.ndarray] = []
+        self._carry = np.zeros(0, dtype=np.float32)
+        self._carry_max = np.zeros(0, dtype=np.float32)
+
+    def feed(self, block: np.ndarray):
+        lows = np.concatenate([self._carry, block.min(axis=1)])
+        highs = np.concatenate([self._carry_max, block.max(axis=1)])
+        whole = len(lows) // self.base_frames * self.base_frames
+        if whole:
+            shape = (-1, self.base_frames)
+            self._chunks.append(np.stack([
+                _quantize(lows[:whole].reshape(shape).min(axis=1), round_up=False),
+                _quantize(highs[:whole].reshape(shape).max(axis=1), round_up=True),
+            ], axis=1))
+        self._carry, self._carry_max = lows[whole:], highs[whole:]
+
+    def tap(self, blocks: Iterable[np.ndarray]) -> Iterator[np.ndarray]:
+        """流水线步骤：原样输出 PCM 块，同时记录峰值"""
+        for block in blocks:
+            self.feed(block)
+            yield block
+
+    def levels(self) -> List[np.ndarray]:
+        chunks = list(self._chunks)
+        if len(self._carry):
+            chunks.append(np.array([[_quantize(self._carry.min(), False), _quantize(self._carry_max.max(), True)]],
+                                   dtype=np.int8))
+        level = np.concatenate(chunks) if chunks else np.zeros((0, 2), dtype=np.int8)
+        levels = [level]
+        while len(levels[-1]) >= MIN_BINS * LEVEL_FACTOR:
+            levels.append(reduce_level(levels[-1]))
+        return levels
+
+    def save(self, path: str) -> str:
+        """原子写出峰值文件"""
+        levels = self.levels()
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, len(levels), self.sample_rate, self.base_frames))
+                for level in levels:
+                    f.write(LEVEL_HEADER.pack(len(level)))
+                    f.write(level.tobytes())
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+
+def read_peaks(path: str) -> Tuple[int, int, List[np.ndarray]]:
+    """读取峰值文件，返回 (采样率, 最细一级每点帧数, [各级 (点数, 2) int8 数组])"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, count, sample_rate, base_frames = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"无效的峰值文件: {path}")
+    offset = HEADER.size
+    levels = []
+    for _ in range(count):
+        (bins,) = LEVEL_HEADER.unpack_from(data, offset)
+        offset += LEVEL_HEADER.size
+        levels.append(np.frombuffer(data, dtype=np.int8, count=bins * 2, offset=offset).reshape(bins, 2))
+        offset += bins * 2
+    return sample_rate, base_frames, levels
+
+
+def select_level(path: str, width: int) -> Tuple[float, np.ndarray]:
+    """选取点数不少于 width 的最粗一级，返回 (每点秒数, 峰值数组)"""
+    sample_rate, base_frames, levels = read_peaks(path)
+    index = 0
+    for i, level in enumerate(levels):
+        if len(level) >= width:
+            index = i
+    return base_frames * LEVEL_FACTOR ** index / sample_rate, levels[index]
+
+
+def compute_peaks(audio_path: str, path: Optional[str] = None, sample_rate: int = 44100) -> str:
+    """为已有的音频文件生成峰值文件（用 ffmpeg 流式解码，不整体读入内存）"""
+    ffmpeg = find_ffmpeg()
+    if ffmpeg is None:
+        raise RuntimeError("找不到 ffmpeg，无法解码音频")
+    path = path or peaks_path_for(audio_path)
+    cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin', '-i', audio_path,
+           '-f', 'f32le', '-ac', '2', '-ar', str(sample_rate), 'pipe:1']
+    recorder = PeakRecorder(sample_rate)
+    frame_bytes = 8
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+        while True:
+            data = proc.stdout.read(65536 * frame_bytes)
+            if not data:
+                break
+            usable = len(data) // frame_bytes * frame_bytes
+            recorder.feed(np.frombuffer(data[:usable], dtype='<f4').reshape(-1, 2))
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg 解码失败 ({proc.returncode}): {audio_path}")
+    return recorder.save(path)
@@ -0,0 +1,80 @@
+import logging
+from typing import Callable, Iterable, Iterator, Optional
+
+import numpy as np
+from scipy import signal
+
+logger = logging.getLogger(__name__)
+
+# 渲染流水线中的逐块处理步骤
+# 每个步骤接收 PCM 块迭代器（float32，形状为 (帧数, 声道数)），返回新的迭代器，
+# 因此整条流水线的内存占用只与块大小有关。
+
+
+def limit_duration(blocks: Iterable[np.ndarray], sample_rate: int, seconds: float,
+                   fade_seconds: float = 0.5) -> Iterator[np.ndarray]:
+    """只保留前 seconds 秒，并在结尾淡出以避免截断时的爆音"""
+    total = int(seconds * sample_rate)
+    fade = min(int(fade_seconds * sample_rate), total)
+    fade_start = total - fade
+    position = 0
+    for block in blocks:
+        if position >= total:
+            break
+        block = block[:total - position]
+        end = position + len(block)
+        if end > fade_start:
+            # 当前块与淡出区间重叠的部分乘以线性衰减
+            offset = max(fade_start - position, 0)
+            ramp = (total - np.arange(position + offset, end)) / max(fade, 1)
+            block = block.copy()
+            block[offset:] *= ramp[:, None].astype(np.float32)
+        position = end
+        yield block
+
+
+def report_progress(blocks: Iterable[np.ndarray], sample_rate: int, total_seconds: float,
+                    callback: Callable, stage: str, finished: Optional[str] = None) -> Iterator[np.ndarray]:
+    """原样输出 PCM 块，按已输出的时长向 callback(stage, percent=...) 报告进度
+
+    百分比只在整数变化时报告，流结束前最多报告 99；流结束时报告 100，
+    指定 finished 时再报告下一个阶段（此时剩余的只是编码器收尾）
+    """
+    total = max(int(total_seconds * sample_rate), 1)
+    position = 0
+    reported = -1
+    for block in blocks:
+        position += len(block)
+        percent = min(position * 100 // total, 99)
+        if percent != reported:
+            callback(stage, percent=int(percent))
+            reported = percent
+        yield block
+    callback(stage, percent=100)
+    if finished:
+        callback(finished)
+
+
+def to_mono(blocks: Iterable[np.ndarray]) -> Iterator[np.ndarray]:
+    """把多声道混为单声道"""
+    for block in blocks:
+        yield block.mean(axis=1, keepdims=True, dtype=np.float32)
+
+
+def decimate(blocks: Iterable[np.ndarray], factor: int) -> Iterator[np.ndarray]:
+    """整数倍降采样：先用带状态的低通滤波器抗混叠，再按相位连续地抽取样本"""
+    if factor <= 1:
+        yield from blocks
+        return
+    taps = signal.firwin(63, 0.9 / factor).astype(np.float32)
+    zi = None
+    phase = 0
+    for block in blocks:
+        if zi is None:
+            zi = np.zeros((len(taps) - 1, block.shape[1]), dtype=np.float32)
+        filtered, zi = signal.lfilter(taps, [1.0], block, axis=0, zi=zi)
+        # phase 记录下一个应保留样本在当前块中的位置，保证跨块抽取间隔一致
+        out = filtered[phase::factor]
+        phase = (phase - len(block)) % factor
+        if len(out):
+            yield out.astype(np.float32)
@@ -0,0 +1,166 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 任务优先级，数值越小越先执行
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+
+class RenderQueueFull(Exception):
+    """渲染队列已满"""
+
+
+class RenderTimeout(Exception):
+    """渲染任务超时"""
+
+
+class RenderJob:
+    """提交到渲染池的单个任务"""
+
+    def __init__(self, fn: Callable, args: tuple, kwargs: dict,
+                 priority: int, timeout: Optional[float]):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.submitted_at = time.monotonic()
+        self.deadline = self.submitted_at + timeout if timeout else None
+        self.future = Future()
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def check_deadline(self):
+        """由渲染代码周期性调用，超时则中止当前任务"""
+        if self.expired():
+            raise RenderTimeout(f"渲染任务超时（{self.deadline - self.submitted_at:.0f} 秒）")
+
+
+class RenderPool:
+    """固定数量的常驻渲染线程，每个线程持有自己的合成器
+
+    任务通过有界优先队列进入，调用方拿到 Future。
+    """
+
+    def __init__(self, synth_factory: Optional[Callable] = None, workers: int = 2,
+                 queue_size: int = 32, default_timeout: Optional[float] = 300,
+                 warmup: Optional[Callable] = None):
+        self.synth_factory = synth_factory
+        self.warmup = warmup
+        self.workers = workers
+        self.queue_size = queue_size
+        self.default_timeout = default_timeout
+        self._queue = None
+        self._threads = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """从应用配置读取渲染池参数"""
+        self.workers = app.config.get('RENDER_WORKERS', self.workers)
+        self.queue_size = app.config.get('RENDER_QUEUE_SIZE', self.queue_size)
+        self.default_timeout = app.config.get('RENDER_TIMEOUT', self.default_timeout)
+        app.extensions['render_pool'] = self
+
+    def set_synth_factory(self, factory: Callable, warmup: Optional[Callable] = None):
+        """设置工作线程创建合成器的方法（必须在启动前调用）
+
+        warmup(synth) 在每个工作线程创建合成器后、开始接任务前调用，用于预热缓存
+        """
+        self.synth_factory = factory
+        self.warmup = warmup
+
+    @property
+    def started(self) -> bool:
+        return bool(self._threads)
+
+    def start(self):
+        """启动工作线程（首次提交任务时自动调用）"""
+        with self._lock:
+            if self._threads:
+                return
+            self._queue = queue.PriorityQueue(maxsize=self.queue_size)
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, args=(index,),
+                                          name=f"render-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            logger.info(f"渲染池已启动: {self.workers} 个工作线程，队列上限 {self.queue_size}")
+
+    def submit(self, fn: Callable, *args, priority: int = PRIORITY_NORMAL,
+               timeout: Optional[float] = None, **kwargs) -> Future:
+        """提交渲染任务
+
+        fn 在工作线程中以 fn(synth, job, *args, **kwargs) 的形式调用。
+        队列已满时立即抛出 RenderQueueFull，而不是阻塞调用方。
+        """
+        if not self._threads:
+            self.start()
+        if timeout is None:
+            timeout = self.default_timeout
+        job = RenderJob(fn, args, kwargs, priority, timeout)
+        try:
+            self._queue.put_nowait((priority, next(self._counter), job))
+        except queue.Full:
+            raise RenderQueueFull("渲染队列已满，请稍后再试")
+        return job.future
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _create_synth(self, index: int):
+        if self.synth_factory is None:
+            return None
+        try:
+            return self.synth_factory()
+        except Exception as e:
+            logger.error(f"渲染线程 {index} 创建合成器失败: {str(e)}", exc_info=True)
+            return None
+
+    def _worker_loop(self, index: int):
+        synth = self._create_synth(index)
+        if self.warmup is not None and synth is not None:
+            try:
+                self.warmup(synth)
+            except Exception as e:
+                logger.error(f"渲染线程 {index} 预热失败: {str(e)}", exc_info=True)
+        while True:
+            _, _, job = self._queue.get()
+            try:
+                if job is None:
+                    break
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                if job.expired():
+                    job.future.set_exception(RenderTimeout("渲染任务在队列中等待超时"))
+                    continue
+                try:
+                    result = job.fn(synth, job, *job.args, **job.kwargs)
+                except BaseException as e:
+                    job.future.set_exception(e)
+                else:
+                    job.future.set_result(result)
+            finally:
+                self._queue.task_done()
+
+        if synth is not None and hasattr(synth, 'close'):
+            synth.close()
+
+    def shutdown(self, wait: bool = True):
+        """停止所有工作线程"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+            for _ in threads:
+                # 哨兵排在所有任务之后
+                self._queue.put((float('inf'), next(self._counter), None))
+        if wait:
+            for thread in threads:
+                thread.join()
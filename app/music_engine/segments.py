@@ -0,0 +1,222 @@
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .encoder import EncoderError, find_ffmpeg
+
+logger = logging.getLogger(__name__)
+
+# 分段输出（HLS）：音频切成固定时长的 MP3 段（MPEG-TS 封装），另有 index.m3u8 播放列表。
+# 段在编码过程中逐个写出，播放列表随之更新（EVENT 类型，结束时追加 #EXT-X-ENDLIST），
+# 播放器拿到第一段即可开始播放，拖动进度时只请求需要的段。
+
+PLAYLIST = 'index.m3u8'
+SEGMENT_PATTERN = 'seg_%05d.ts'
+SEGMENT_CODEC = 'libmp3lame'  # ffmpeg 自带的 AAC 编码器耗时约为 LAME 的 3 倍
+PLAYLIST_MIMETYPE = 'application/vnd.apple.mpegurl'
+SEGMENT_MIMETYPE = 'video/mp2t'
+
+
+def segments_dir_for(audio_path: str) -> str:
+    """音频文件对应的分段目录"""
+    return os.path.splitext(audio_path)[0] + '_hls'
+
+
+def playlist_complete(output_dir: str) -> bool:
+    """播放列表是否已经写完（包含结束标记）"""
+    try:
+        with open(os.path.join(output_dir, PLAYLIST), 'r') as f:
+            return '#EXT-X-ENDLIST' in f.read()
+    except FileNotFoundError:
+        return False
+
+
+def hls_command(ffmpeg: str, input_args: List[str], output_dir: str, bitrate: Optional[str],
+                segment_seconds: float, codec: str = SEGMENT_CODEC) -> List[str]:
+    cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', *input_args,
+           '-vn', '-c:a', codec]
+    if bitrate and codec != 'copy':
+        cmd += ['-b:a', str(bitrate)]
+    # temp_file：段与播放列表先写临时文件再改名，服务端不会读到写了一半的文件
+    cmd += ['-f', 'hls', '-hls_time', str(segment_seconds), '-hls_list_size', '0',
+            '-hls_playlist_type', 'event', '-hls_flags', 'temp_file+independent_segments',
+            '-hls_segment_filename', os.path.join(output_dir, SEGMENT_PATTERN),
+            os.path.join(output_dir, PLAYLIST)]
+    return cmd
+
+
+class SegmentedEncoder:
+    """把 PCM 块流式编码为 HLS 分段，接口与 StreamEncoder 相同；指定 source 时改为切分已有的音频文件
+
+    写入目录旁的临时目录，全部完成后替换目标目录；编码过程中播放列表位于临时目录，
+    可由 in_progress_dir() 找到，供边渲染边播放使用。
+    """
+
+    def __init__(self, output_dir: str, bitrate: Optional[str] = '128k', sample_rate: int = 44100,
+                 channels: int = 2, segment_seconds: float = 6.0, source: Optional[str] = None):
+        self.output_dir = output_dir
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.segment_seconds = segment_seconds
+        self.source = source
+        self.tmp_dir = f"{output_dir}.{os.getpid()}.{threading.get_ident()}.part"
+        self._proc = None
+        self._stderr = b''
+        self._stderr_reader = None
+
+    def open(self):
+        ffmpeg = find_ffmpeg()
+        if ffmpeg is None:
+            raise EncoderError("找不到 ffmpeg，无法生成分段音频")
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+        codec = SEGMENT_CODEC
+        if self.source:
+            input_args, stdin = ['-i', self.source], subprocess.DEVNULL
+            if self.source.lower().endswith('.mp3'):
+                # MP3 源文件直接按帧切分，不重新编码
+                codec = 'copy'
+        else:
+            input_args = ['-f', 'f32le', '-ar', str(self.sample_rate), '-ac', str(self.channels), '-i', 'pipe:0']
+            stdin = subprocess.PIPE
+        self._proc = subprocess.Popen(hls_command(ffmpeg, input_args, self.tmp_dir, self.bitrate,
+                                                  self.segment_seconds, codec),
+                                      stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self._stderr_reader = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_reader.start()
+        return self
+
+    def _drain_stderr(self):
+        self._stderr = self._proc.stderr.read()
+
+    def write(self, block: np.ndarray):
+        try:
+            self._proc.stdin.write(np.ascontiguousarray(block, dtype='<f4').tobytes())
+        except BrokenPipeError:
+            raise EncoderError(f"ffmpeg 提前退出: {self._stderr.decode(errors='ignore')}")
+
+    def close(self):
+        """结束输入并等待分段完成，成功后发布目标目录"""
+        self.finish()
+        self.publish()
+
+    def finish(self):
+        """结束输入并等待分段完成，结果仍在临时目录中"""
+        if self._proc.stdin is not None:
+            try:
+                self._proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        returncode = self._proc.wait()
+        self._stderr_reader.join()
+        if returncode != 0:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            raise EncoderError(f"ffmpeg 分段失败 ({returncode}): {self._stderr.decode(errors='ignore').strip()}")
+
+    def publish(self):
+        """把临时目录改名为目标目录"""
+        # 目录不能原子地覆盖已存在的目录，先移走旧目录
+        if os.path.exists(self.output_dir):
+            stale = f"{self.tmp_dir}.old"
+            try:
+                os.replace(self.output_dir, stale)
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(stale, ignore_errors=True)
+        try:
+            os.replace(self.tmp_dir, self.output_dir)
+        except OSError:
+            # 同一地址的另一次渲染（内容相同）刚好先发布了完整的目录
+            if not playlist_complete(self.output_dir):
+                raise
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def abort(self):
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        if self._stderr_reader is not None:
+            self._stderr_reader.join()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def playlist_dir(self) -> Optional[str]:
+        """当前可以读取播放列表的目录：已完成时为目标目录，编码中为临时目录"""
+        for path in (self.output_dir, self.tmp_dir):
+            if os.path.exists(os.path.join(path, PLAYLIST)):
+                return path
+        return None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def in_progress_dir(output_dir: str) -> Optional[str]:
+    """正在编码中的分段临时目录（已有播放列表时），没有则返回 None"""
+    parent, name = os.path.split(output_dir)
+    try:
+        entries = os.listdir(parent or '.')
+    except FileNotFoundError:
+        return None
+    for entry in entries:
+        path = os.path.join(parent, entry)
+        if entry.startswith(f"{name}.") and entry.endswith('.part') \
+                and os.path.exists(os.path.join(path, PLAYLIST)):
+            return path
+    return None
+
+
+# 为已有音频文件补做分段的后台任务（每个目录只启动一个）
+_segmenting: Dict[str, SegmentedEncoder] = {}
+_segmenting_lock = threading.Lock()
+
+
+def segment_audio_file(audio_path: str, output_dir: Optional[str] = None, bitrate: Optional[str] = '128k',
+                       segment_seconds: float = 6.0, wait: float = 10.0) -> Optional[str]:
+    """在后台把已有的音频文件切成分段，等到播放列表出现后返回可读取它的目录
+
+    同一目录重复调用不会启动新的进程；等待超时或失败时返回 None
+    """
+    output_dir = output_dir or segments_dir_for(audio_path)
+    if os.path.exists(os.path.join(output_dir, PLAYLIST)):
+        return output_dir
+
+    with _segmenting_lock:
+        encoder = _segmenting.get(output_dir)
+        if encoder is None:
+            encoder = SegmentedEncoder(output_dir, bitrate, segment_seconds=segment_seconds,
+                                       source=audio_path).open()
+            _segmenting[output_dir] = encoder
+            threading.Thread(target=_finish_segmenting, args=(output_dir, encoder), daemon=True).start()
+
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        path = encoder.playlist_dir()
+        if path is not None:
+            return path
+        if encoder._proc.poll() not in (None, 0):
+            break
+        time.sleep(0.1)
+    return encoder.playlist_dir()
+
+
+def _finish_segmenting(output_dir: str, encoder: SegmentedEncoder):
+    try:
+        encoder.close()
+    except Exception as e:
+        logger.error(f"分段失败 {output_dir}: {str(e)}")
+    finally:
+        with _segmenting_lock:
+            _segmenting.pop(output_dir, None)
@@ -0,0 +1,314 @@
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# SF2 生成器编号：预设分区引用乐器、乐器分区引用采样
+GEN_INSTRUMENT = 41
+GEN_SAMPLE_ID = 53
+
+# 规范要求每个采样之后至少跟 46 个零采样点
+SAMPLE_PADDING = 46
+ROM_SAMPLE = 0x8000
+LINKED_SAMPLE_TYPES = 0x2 | 0x4 | 0x8  # 右声道、左声道、链接采样
+
+# pdta 中各子块的记录格式，顺序即文件中的顺序
+RECORDS = {
+    'phdr': struct.Struct('<20sHHHIII'),
+    'pbag': struct.Struct('<HH'),
+    'pmod': struct.Struct('<HHhHH'),
+    'pgen': struct.Struct('<HH'),
+    'inst': struct.Struct('<20sH'),
+    'ibag': struct.Struct('<HH'),
+    'imod': struct.Struct('<HHhHH'),
+    'igen': struct.Struct('<HH'),
+    'shdr': struct.Struct('<20sIIIIIBbHH'),
+}
+
+
+class SoundFontError(Exception):
+    """SoundFont 文件无法解析"""
+
+
+def _chunks(buf, start: int, end: int):
+    """遍历 [start, end) 内的 RIFF 子块，产出 (块标识, 数据起点, 数据长度)"""
+    pos = start
+    while pos + 8 <= end:
+        cid = bytes(buf[pos:pos + 4])
+        size = struct.unpack_from('<I', buf, pos + 4)[0]
+        yield cid, pos + 8, size
+        pos += 8 + size + (size & 1)
+
+
+def _chunk(cid: bytes, data: bytes) -> bytes:
+    return cid + struct.pack('<I', len(data)) + data + (b'\0' if len(data) & 1 else b'')
+
+
+class SoundFont:
+    """只读打开的 SF2 文件
+
+    文件通过 mmap 映射，预设与乐器表解析为元组列表，采样数据不会读入内存，
+    提取子集时按采样逐个从映射中复制。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise SoundFontError(f"SoundFont 文件为空: {path}")
+        self.info: List[Tuple[bytes, bytes]] = []
+        self.records: Dict[str, list] = {}
+        self.smpl: Optional[Tuple[int, int]] = None
+        self.sm24: Optional[Tuple[int, int]] = None
+        try:
+            self._parse()
+        except (SoundFontError, struct.error) as e:
+            self.close()
+            raise SoundFontError(f"无法解析 SoundFont {path}: {str(e)}")
+
+    def _parse(self):
+        buf = self._map
+        if len(buf) < 12 or buf[0:4] != b'RIFF' or buf[8:12] != b'sfbk':
+            raise SoundFontError("不是 RIFF sfbk 文件")
+        end = min(8 + struct.unpack_from('<I', buf, 4)[0], len(buf))
+        for cid, start, size in _chunks(buf, 12, end):
+            if cid != b'LIST':
+                continue
+            kind = bytes(buf[start:start + 4])
+            for sub, sub_start, sub_size in _chunks(buf, start + 4, start + size):
+                if kind == b'INFO':
+                    self.info.append((sub, bytes(buf[sub_start:sub_start + sub_size])))
+                elif kind == b'sdta' and sub == b'smpl':
+                    self.smpl = (sub_start, sub_size)
+                elif kind == b'sdta' and sub == b'sm24':
+                    self.sm24 = (sub_start, sub_size)
+                elif kind == b'pdta' and sub.decode('ascii', 'replace') in RECORDS:
+                    record = RECORDS[sub.decode()]
+                    self.records[sub.decode()] = [record.unpack_from(buf, sub_start + i * record.size)
+                                                  for i in range(sub_size // record.size)]
+        missing = [name for name in RECORDS if name not in self.records]
+        if missing:
+            raise SoundFontError(f"缺少 pdta 子块: {', '.join(missing)}")
+        if self.smpl is None:
+            raise SoundFontError("缺少采样数据")
+
+    def presets(self) -> List[Tuple[int, int, str]]:
+        """列出 (音色库, 音色号, 名称)，不含结尾的 EOP 记录"""
+        return [(bank, preset, name.split(b'\0')[0].decode('latin-1'))
+                for name, preset, bank, *_ in self.records['phdr'][:-1]]
+
+    def _copy_zones(self, out: Dict[str, list], kind: str, first: int, last: int,
+                    ref_gen: int, remap) -> int:
+        """复制 [first, last) 的分区及其生成器、调制器，引用生成器的值经 remap 换成新索引
+
+        kind 为 'p'（预设）或 'i'（乐器），返回新的起始分区索引
+        """
+        bags, gens, mods = (self.records[kind + name] for name in ('bag', 'gen', 'mod'))
+        new_bags, new_gens, new_mods = (out[kind + name] for name in ('bag', 'gen', 'mod'))
+        new_first = len(new_bags)
+        for j in range(first, last):
+            new_bags.append((len(new_gens), len(new_mods)))
+            for oper, amount in gens[bags[j][0]:bags[j + 1][0]]:
+                if oper == ref_gen:
+                    amount = remap(amount)
+                new_gens.append((oper, amount))
+            new_mods.extend(mods[bags[j][1]:bags[j + 1][1]])
+        return new_first
+
+    def subset(self, output_path: str, presets: Iterable[Tuple[int, int]]) -> Dict:
+        """只保留指定的 (音色库, 音色号) 及其引用的乐器和采样，写出新的 SF2 文件"""
+        wanted = set(presets)
+        phdr, inst, shdr = self.records['phdr'], self.records['inst'], self.records['shdr']
+        out: Dict[str, list] = {name: [] for name in RECORDS}
+        inst_map: Dict[int, int] = {}
+        sample_map: Dict[int, int] = {}
+
+        def remap_sample(old: int) -> int:
+            if old not in sample_map:
+                sample_map[old] = len(sample_map)
+            return sample_map[old]
+
+        def remap_instrument(old: int) -> int:
+            if old not in inst_map:
+                inst_map[old] = len(out['inst'])
+                name, first = inst[old]
+                new_first = self._copy_zones(out, 'i', first, inst[old + 1][1], GEN_SAMPLE_ID, remap_sample)
+                out['inst'].append((name, new_first))
+            return inst_map[old]
+
+        found = set()
+        for i, (name, preset, bank, first, library, genre, morphology) in enumerate(phdr[:-1]):
+            if (bank, preset) not in wanted:
+                continue
+            found.add((bank, preset))
+            new_first = self._copy_zones(out, 'p', first, phdr[i + 1][3], GEN_INSTRUMENT, remap_instrument)
+            out['phdr'].append((name, preset, bank, new_first, library, genre, morphology))
+        for bank, preset in sorted(wanted - found):
+            logger.warning(f"SoundFont 中没有音色 {bank}:{preset}")
+
+        # 立体声采样的另一半也要保留
+        order = list(sample_map)
+        for old in order:
+            link, sample_type = shdr[old][8], shdr[old][9]
+            if sample_type & LINKED_SAMPLE_TYPES and link < len(shdr) - 1 and link not in sample_map:
+                remap_sample(link)
+                order.append(link)
+
+        # 重新排布采样数据，计算新的起止位置
+        layout = []
+        offset = 0
+        for old in order:
+            name, start, end, loop_start, loop_end, rate, pitch, correction, link, sample_type = shdr[old]
+            if sample_type & ROM_SAMPLE:
+                start = end = loop_start = loop_end = 0
+            length = max(end - start, 0)
+            delta = offset - start
+            layout.append((start, length))
+            out['shdr'].append((name, offset, offset + length, loop_start + delta, loop_end + delta,
+                                rate, pitch, correction, sample_map.get(link, 0), sample_type))
+            offset += length + SAMPLE_PADDING
+        frames = offset
+
+        # 结尾记录
+        out['phdr'].append((b'EOP', 0, 0, len(out['pbag']), 0, 0, 0))
+        out['pbag'].append((len(out['pgen']), len(out['pmod'])))
+        out['pmod'].append((0, 0, 0, 0, 0))
+        out['pgen'].append((0, 0))
+        out['inst'].append((b'EOI', len(out['ibag'])))
+        out['ibag'].append((len(out['igen']), len(out['imod'])))
+        out['imod'].append((0, 0, 0, 0, 0))
+        out['igen'].append((0, 0))
+        out['shdr'].append((b'EOS', 0, 0, 0, 0, 0, 0, 0, 0, 0))
+
+        self._write(output_path, out, layout, frames)
+        return {
+            'presets': len(out['phdr']) - 1,
+            'instruments': len(out['inst']) - 1,
+            'samples': len(out['shdr']) - 1,
+            'missing': sorted(wanted - found),
+            'source_bytes': os.path.getsize(self.path),
+            'output_bytes': os.path.getsize(output_path),
+        }
+
+    def _write(self, output_path: str, out: Dict[str, list], layout: List[Tuple[int, int]], frames: int):
+        """流式写出 SF2：表结构在内存中拼好，采样数据逐个从源文件映射复制"""
+        info = _chunk(b'LIST', b'INFO' + b''.join(_chunk(cid, data) for cid, data in self.info))
+        pdta = _chunk(b'LIST', b'pdta' + b''.join(
+            _chunk(name.encode(), b''.join(RECORDS[name].pack(*r) for r in out[name]))
+            for name in RECORDS))
+        smpl_size = frames * 2
+        sm24_size = frames if self.sm24 is not None else 0
+        sdta_size = 4 + 8 + smpl_size
+        if self.sm24 is not None:
+            sdta_size += 8 + sm24_size + (sm24_size & 1)
+        riff_size = 4 + len(info) + 8 + sdta_size + len(pdta)
+
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(b'RIFF' + struct.pack('<I', riff_size) + b'sfbk')
+                f.write(info)
+                f.write(b'LIST' + struct.pack('<I', sdta_size) + b'sdta')
+                f.write(b'smpl' + struct.pack('<I', smpl_size))
+                base = self.smpl[0]
+                for start, length in layout:
+                    f.write(self._map[base + start * 2:base + (start + length) * 2])
+                    f.write(b'\0' * (SAMPLE_PADDING * 2))
+                if self.sm24 is not None:
+                    f.write(b'sm24' + struct.pack('<I', sm24_size))
+                    base = self.sm24[0]
+                    for start, length in layout:
+                        f.write(self._map[base + start:base + start + length])
+                        f.write(b'\0' * SAMPLE_PADDING)
+                    if sm24_size & 1:
+                        f.write(b'\0')
+                f.write(pdta)
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def style_presets(style_settings: Dict[str, Dict]) -> Set[Tuple[int, int]]:
+    """生成器各风格用到的 (音色库, 音色号)，使用鼓点的风格额外需要标准鼓组"""
+    from .synth import DRUM_BANK
+
+    presets = set()
+    for settings in style_settings.values():
+        for part in ('melody', 'chord', 'bass'):
+            presets.add((0, settings[part]))
+        if settings.get('drums'):
+            presets.add((DRUM_BANK, 0))
+    # 子集音色库缺少的音色会退回到 0 号音色，所以它必须存在
+    presets.add((0, 0))
+    return presets
+
+
+def _rss_kb() -> int:
+    """当前进程的常驻内存（KB）"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure_worker(soundfont_path: str, sample_rate: int, workers: int, queue):
+    from .synth import FluidSynthEngine
+
+    results = []
+    engines = []
+    try:
+        for _ in range(workers):
+            before = _rss_kb()
+            started = time.perf_counter()
+            engines.append(FluidSynthEngine(soundfont_path, sample_rate))
+            results.append({'seconds': time.perf_counter() - started, 'rss_kb': _rss_kb() - before})
+        queue.put({'engines': results})
+    except Exception as e:
+        queue.put({'error': str(e)})
+    finally:
+        for engine in engines:
+            engine.close()
+
+
+def measure_load(soundfont_path: str, sample_rate: int = 44100, workers: int = 2) -> Dict:
+    """在独立进程中依次创建 workers 个常驻合成器，记录每个的加载耗时与新增常驻内存
+
+    同一进程中的合成器共享 FluidSynth 的采样缓存，所以第二个起的内存增量反映的是
+    每个渲染线程的额外开销。
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_measure_worker, args=(soundfont_path, sample_rate, workers, queue))
+    proc.start()
+    try:
+        result = queue.get(timeout=300)
+    finally:
+        proc.join()
+    result['file_bytes'] = os.path.getsize(soundfont_path)
+    return result
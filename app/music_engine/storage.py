@@ -0,0 +1,105 @@
+import hashlib
+import os
+import threading
+import uuid
+from typing import Callable, Tuple
+
+# 生成文件的内容寻址存储
+#
+#   generated/ab/cd/<类别>_<摘要>.<扩展名>
+#
+# 摘要取内容的 SHA-256（前 DIGEST_CHARS 位），按前两级各两位分目录，避免单个目录堆积大量文件。
+# 类别（midi / audio / preview 等）只是便于辨认的前缀。内容相同的文件得到相同的路径，
+# 不同的内容不会互相覆盖；文件先写到存储内的临时目录，再原子改名到最终路径。
+#
+# 渲染出的音频在编码过程中就要对外提供（HLS 分段边渲染边播放），此时内容尚未确定，
+# 因此用决定其内容的输入（MIDI 内容 + 合成与编码设置）的摘要作为地址，见 reserve()。
+
+DIGEST_CHARS = 32
+SHARD_DEPTH = 2
+TMP_DIR = '.tmp'
+
+
+def file_digest(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()[:DIGEST_CHARS]
+
+
+def content_addressed(relative_path: str, prefix: str = 'generated') -> bool:
+    """相对静态目录的路径是否位于存储的分片目录中（含同名派生文件，如 Opus 档位）
+
+    只按路径形状判断：分片目录中既有按内容摘要发布的文件，也有按渲染输入预留的文件，
+    后者的内容可能改变（例如重新渲染），是否可以长期缓存见 digest_named()
+    """
+    parts = relative_path.replace('\\', '/').split('/')
+    return (len(parts) == SHARD_DEPTH + 2 and parts[0] == prefix
+            and all(len(shard) == 2 for shard in parts[1:-1]) and not parts[-1].startswith('.'))
+
+
+def digest_named(path: str, digest: str) -> bool:
+    """文件名中的摘要是否就是其内容的摘要（put() 发布的文件）
+
+    这样的路径与内容一一对应，可以标记为 immutable；reserve() 预留的音频及其派生文件不是
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return stem.rpartition('_')[2] == digest
+
+
+class ArtifactStore:
+    """按内容摘要命名并分目录存放生成文件
+
+    返回的路径均相对于静态目录（例如 generated/ab/cd/midi_abcd....mid），
+    可直接保存到 Project.midi_path / audio_path，并用 url_for('static', filename=...) 访问
+    """
+
+    def __init__(self, static_dir: str = os.path.join('app', 'static'), prefix: str = 'generated'):
+        self.static_dir = static_dir
+        self.prefix = prefix
+
+    @property
+    def root(self) -> str:
+        return os.path.join(self.static_dir, self.prefix)
+
+    def relative_path(self, digest: str, kind: str, ext: str) -> str:
+        shards = [digest[i * 2:i * 2 + 2] for i in range(SHARD_DEPTH)]
+        return '/'.join([self.prefix, *shards, f"{kind}_{digest}.{ext}"])
+
+    def absolute_path(self, relative_path: str) -> str:
+        return os.path.join(self.static_dir, *relative_path.split('/'))
+
+    def temp_path(self, ext: str) -> str:
+        """存储内的临时文件路径（与最终路径在同一文件系统，改名是原子的）"""
+        tmp_dir = os.path.join(self.root, TMP_DIR)
+        os.makedirs(tmp_dir, exist_ok=True)
+        return os.path.join(tmp_dir, f"{uuid.uuid4().hex}.{os.getpid()}.{threading.get_ident()}.{ext}.part")
+
+    def put(self, tmp_path: str, kind: str, ext: str) -> str:
+        """把写好的临时文件按内容摘要发布到最终路径，返回相对路径
+
+        已有相同内容的文件时直接替换（内容一致），临时文件随之消失
+        """
+        relative_path = self.relative_path(file_digest(tmp_path), kind, ext)
+        path = self.absolute_path(relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return relative_path
+
+    def write(self, kind: str, ext: str, writer: Callable[[str], None]) -> str:
+        """调用 writer(临时路径) 写出文件后按内容发布，返回相对路径"""
+        tmp_path = self.temp_path(ext)
+        try:
+            writer(tmp_path)
+            return self.put(tmp_path, kind, ext)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def reserve(self, key: str, kind: str, ext: str) -> Tuple[str, str]:
+        """按输入摘要 key 预先确定路径（调用方负责原子写入），返回 (相对路径, 绝对路径)"""
+        relative_path = self.relative_path(key[:DIGEST_CHARS], kind, ext)
+        path = self.absolute_path(relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return relative_path, path
@@ -0,0 +1,143 @@
+import logging
+import os
+import platform
+import shutil
+import subprocess
+from typing import Callable, Iterator, Optional
+
+import mido
+import numpy as np
+
+try:
+    import fluidsynth
+except ImportError:  # pyfluidsynth 或 libfluidsynth 不可用
+    fluidsynth = None
+
+logger = logging.getLogger(__name__)
+
+# 鼓组固定在第 10 通道（索引 9），使用打击乐音色库
+DRUM_CHANNEL = 9
+DRUM_BANK = 128
+
+
+class FluidSynthEngine:
+    """常驻内存的 FluidSynth 合成器，SoundFont 只在创建时加载一次"""
+
+    BLOCK_FRAMES = 4096   # 每次从合成器取出的帧数
+    TAIL_SECONDS = 2.0    # 最后一个事件之后保留的释音时间
+
+    def __init__(self, soundfont_path: str, sample_rate: int = 44100, gain: float = 0.5):
+        if fluidsynth is None:
+            raise RuntimeError("pyfluidsynth 不可用，无法创建常驻合成器")
+
+        self.soundfont_path = soundfont_path
+        self.sample_rate = sample_rate
+        self.synth = fluidsynth.Synth(gain=gain, samplerate=float(sample_rate))
+        self.sfid = self.synth.sfload(soundfont_path)
+        if self.sfid == -1:
+            self.synth.delete()
+            raise RuntimeError(f"无法加载 SoundFont: {soundfont_path}")
+        logger.info(f"常驻合成器已加载 {soundfont_path} ({sample_rate} Hz)")
+
+    def _select(self, channel: int, program: int):
+        bank = DRUM_BANK if channel == DRUM_CHANNEL else 0
+        if self.synth.program_select(channel, self.sfid, bank, program) != 0 and program != 0:
+            # 精简音色库里没有的音色退回到 0 号音色，而不是静音
+            logger.debug(f"音色库中没有 {bank}:{program}，改用 {bank}:0")
+            self.synth.program_select(channel, self.sfid, bank, 0)
+
+    def _reset(self):
+        """清除上一个任务遗留的发声和控制器状态"""
+        self.synth.system_reset()
+        for channel in range(16):
+            self._select(channel, 0)
+
+    def _dispatch(self, msg: mido.Message):
+        """把一条 MIDI 消息送入合成器"""
+        if msg.type == 'note_on':
+            self.synth.noteon(msg.channel, msg.note, msg.velocity)
+        elif msg.type == 'note_off':
+            self.synth.noteoff(msg.channel, msg.note)
+        elif msg.type == 'program_change':
+            self._select(msg.channel, msg.program)
+        elif msg.type == 'control_change':
+            self.synth.cc(msg.channel, msg.control, msg.value)
+        elif msg.type == 'pitchwheel':
+            self.synth.pitch_bend(msg.channel, msg.pitch)
+
+    def _pull(self, frames: int, check: Optional[Callable[[], None]]) -> Iterator[np.ndarray]:
+        """从合成器中按块取出指定帧数的 PCM"""
+        while frames > 0:
+            if check is not None:
+                check()
+            count = min(frames, self.BLOCK_FRAMES)
+            samples = np.asarray(self.synth.get_samples(count), dtype=np.int16)
+            yield samples.reshape(-1, 2).astype(np.float32) / 32768.0
+            frames -= count
+
+    def iter_blocks(self, midi_path: str, check: Optional[Callable[[], None]] = None) -> Iterator[np.ndarray]:
+        """逐块渲染 MIDI 文件，产出形状为 (帧数, 2) 的 float32 PCM"""
+        self._reset()
+        pending = 0.0
+        for msg in mido.MidiFile(midi_path):
+            # mido 迭代时 msg.time 已换算为距上一事件的秒数
+            pending += msg.time
+            frames = int(pending * self.sample_rate)
+            pending -= frames / self.sample_rate
+            yield from self._pull(frames, check)
+            if not msg.is_meta:
+                self._dispatch(msg)
+        yield from self._pull(int(self.TAIL_SECONDS * self.sample_rate), check)
+
+    def close(self):
+        """释放合成器"""
+        try:
+            self.synth.delete()
+        except Exception:
+            pass
+
+
+def find_fluidsynth() -> Optional[str]:
+    """查找 fluidsynth 命令行程序"""
+    if platform.system() == 'Windows':
+        path = os.path.join('C:', os.sep, 'Program Files', 'FluidSynth', 'bin', 'fluidsynth.exe')
+        return path if os.path.exists(path) else None
+    return shutil.which('fluidsynth')
+
+
+class FluidSynthCliEngine:
+    """pyfluidsynth 不可用时的后备方案：让 fluidsynth 命令行把原始 PCM 写到 stdout"""
+
+    BLOCK_FRAMES = 4096
+
+    def __init__(self, soundfont_path: str, sample_rate: int = 44100, gain: float = 0.5):
+        self.executable = find_fluidsynth()
+        if self.executable is None:
+            raise RuntimeError("找不到 fluidsynth 可执行文件")
+        self.soundfont_path = soundfont_path
+        self.sample_rate = sample_rate
+        self.gain = gain
+
+    def iter_blocks(self, midi_path: str, check: Optional[Callable[[], None]] = None) -> Iterator[np.ndarray]:
+        """逐块读取 fluidsynth 输出，产出形状为 (帧数, 2) 的 float32 PCM"""
+        cmd = [self.executable, '-ni', '-q', '-g', str(self.gain), '-r', str(self.sample_rate),
+               '-T', 'raw', '-O', 'float', '-E', 'little', '-F', '-',
+               self.soundfont_path, midi_path]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        block_bytes = self.BLOCK_FRAMES * 2 * 4
+        try:
+            while True:
+                if check is not None:
+                    check()
+                data = proc.stdout.read(block_bytes)
+                if not data:
+                    break
+                usable = len(data) - len(data) % 8
+                yield np.frombuffer(data[:usable], dtype='<f4').reshape(-1, 2)
+            if proc.wait() != 0:
+                raise RuntimeError(f"fluidsynth 渲染失败，退出码 {proc.returncode}")
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
@@ -0,0 +1,173 @@
+import logging
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+import pretty_midi
+
+logger = logging.getLogger(__name__)
+
+TABLE_BITS = 11
+TABLE_SIZE = 1 << TABLE_BITS
+PHASE_BITS = 20  # 相位累加器的小数位数
+
+# GM 音色族（program // 8）对应的谐波振幅与 ADSR（起音、衰减、持续电平、释音，单位秒）
+VOICES = {
+    0: ([1.0, 0.55, 0.3, 0.2, 0.12, 0.08, 0.05], (0.004, 0.6, 0.35, 0.35)),     # 钢琴
+    1: ([1.0, 0.1, 0.45, 0.05, 0.2], (0.002, 0.5, 0.0, 0.4)),                   # 敲击乐器
+    2: ([1.0, 0.8, 0.6, 0.45, 0.3, 0.2, 0.15, 0.1], (0.01, 0.05, 0.9, 0.08)),   # 风琴
+    3: ([1.0, 0.65, 0.45, 0.3, 0.2, 0.14, 0.1, 0.07], (0.003, 0.5, 0.3, 0.25)), # 吉他
+    4: ([1.0, 0.45, 0.15, 0.06], (0.005, 0.25, 0.7, 0.12)),                     # 贝斯
+    5: ([1.0, 0.5, 0.36, 0.27, 0.2, 0.16, 0.12, 0.1, 0.08], (0.08, 0.2, 0.85, 0.4)),  # 弦乐
+    6: ([1.0, 0.5, 0.36, 0.27, 0.2, 0.16, 0.12, 0.1, 0.08], (0.12, 0.2, 0.85, 0.5)),  # 合奏
+    7: ([1.0, 0.8, 0.7, 0.55, 0.4, 0.3, 0.2, 0.12], (0.04, 0.15, 0.8, 0.15)),   # 铜管
+    8: ([1.0, 0.2, 0.6, 0.15, 0.35, 0.1, 0.2], (0.03, 0.1, 0.8, 0.12)),         # 簧管（萨克斯等）
+    9: ([1.0, 0.12, 0.06, 0.03], (0.05, 0.1, 0.85, 0.15)),                      # 吹管（长笛等）
+    10: ([1.0 / k for k in range(1, 13)], (0.005, 0.1, 0.75, 0.1)),             # 合成主音（锯齿波）
+    11: ([1.0, 0.4, 0.25, 0.15, 0.1, 0.06], (0.3, 0.3, 0.8, 0.8)),              # 合成铺底
+}
+DEFAULT_VOICE = VOICES[0]
+
+# 打击乐：GM 鼓组音高 → (类型, 长度秒)
+DRUM_KINDS = {
+    35: ('kick', 0.35), 36: ('kick', 0.35),
+    37: ('snare', 0.12), 38: ('snare', 0.22), 40: ('snare', 0.22),
+    42: ('hihat', 0.06), 44: ('hihat', 0.08), 46: ('hihat', 0.35),
+    49: ('cymbal', 1.4), 51: ('cymbal', 1.0), 52: ('cymbal', 1.2), 55: ('cymbal', 0.9), 57: ('cymbal', 1.4),
+}
+
+
+class WavetableSynth:
+    """纯 NumPy 的后备合成器，在没有 FluidSynth 的主机上也能渲染出真实音频
+
+    每个音色族预先生成按八度限带的单周期波表，音符用整数相位累加器查表、
+    乘以 ADSR 包络后叠加到预先分配好的缓冲区里。
+    """
+
+    BLOCK_FRAMES = 4096
+    TAIL_SECONDS = 1.0
+    OUTPUT_SCALE = 0.4
+
+    def __init__(self, sample_rate: int = 44100, gain: float = 0.5):
+        self.sample_rate = sample_rate
+        self.gain = gain
+        self._tables: Dict[Tuple[int, int], np.ndarray] = {}
+        self._drums: Dict[str, np.ndarray] = {}
+        self._ramp = np.arange(0, dtype=np.int64)
+
+    def _table(self, family: int, pitch: int) -> np.ndarray:
+        """取得音色族在该音高所属八度的限带波表（谐波不超过奈奎斯特频率）"""
+        band = pitch // 12
+        key = (family, band)
+        table = self._tables.get(key)
+        if table is None:
+            harmonics, _ = VOICES.get(family, DEFAULT_VOICE)
+            top_freq = pretty_midi.note_number_to_hz(band * 12 + 11)
+            max_harmonic = max(1, int(self.sample_rate / 2 / top_freq))
+            phase = 2 * np.pi * np.arange(TABLE_SIZE) / TABLE_SIZE
+            table = np.zeros(TABLE_SIZE)
+            for k, amp in enumerate(harmonics[:max_harmonic], start=1):
+                table += amp * np.sin(k * phase)
+            table = (table / np.abs(table).max()).astype(np.float32)
+            self._tables[key] = table
+        return table
+
+    def _drum(self, kind: str, length: float) -> np.ndarray:
+        """生成并缓存一个打击乐采样"""
+        key = f"{kind}:{length}"
+        sample = self._drums.get(key)
+        if sample is None:
+            sr = self.sample_rate
+            t = np.arange(int(length * sr)) / sr
+            rng = np.random.RandomState(len(key))
+            noise = rng.uniform(-1, 1, len(t))
+            if kind == 'kick':
+                freq = 50 + 100 * np.exp(-t * 30)
+                sample = np.sin(2 * np.pi * np.cumsum(freq) / sr) * np.exp(-t * 9)
+            elif kind == 'snare':
+                sample = 0.6 * noise * np.exp(-t * 22) + 0.4 * np.sin(2 * np.pi * 185 * t) * np.exp(-t * 30)
+            elif kind == 'hihat':
+                sample = 0.5 * np.diff(noise, prepend=0) * np.exp(-t * (12 / length))
+            else:  # cymbal 及其他
+                sample = 0.4 * np.diff(noise, prepend=0) * np.exp(-t * (4 / length))
+            sample = sample.astype(np.float32)
+            self._drums[key] = sample
+        return sample
+
+    def _frames(self, count: int) -> np.ndarray:
+        """复用同一个递增序列，避免每个音符重新分配"""
+        if len(self._ramp) < count:
+            self._ramp = np.arange(max(count, 2 * len(self._ramp)), dtype=np.int64)
+        return self._ramp[:count]
+
+    def _envelope(self, attack: float, decay: float, sustain: float, release: float,
+                  held: int, total: int) -> np.ndarray:
+        """ADSR 包络，只计算前 total 帧（音符可能被缓冲区末尾截断）"""
+        sr = self.sample_rate
+        a = max(int(attack * sr), 1)
+        d = max(int(decay * sr), 1)
+        end = held + max(int(release * sr), 1)
+        # 音符可能在起音或衰减阶段就松开，此时从松开时刻的电平开始释音
+        if held <= a:
+            xs, ys = [0, held, end], [0.0, held / a, 0.0]
+        elif held <= a + d:
+            level = 1.0 - (1.0 - sustain) * (held - a) / d
+            xs, ys = [0, a, held, end], [0.0, 1.0, level, 0.0]
+        else:
+            xs, ys = [0, a, a + d, held, end], [0.0, 1.0, sustain, sustain, 0.0]
+        return np.interp(self._frames(total), xs, ys).astype(np.float32)
+
+    def _add_note(self, buffer: np.ndarray, note: pretty_midi.Note, family: int):
+        sr = self.sample_rate
+        _, (attack, decay, sustain, release) = VOICES.get(family, DEFAULT_VOICE)
+        start = int(note.start * sr)
+        if start >= len(buffer):
+            return
+        held = max(int((note.end - note.start) * sr), 1)
+        total = min(held + int(release * sr), len(buffer) - start)
+        if total <= 0:
+            return
+
+        # 定点相位累加：索引 = (n * 步长) >> 小数位，再按波表长度取模
+        freq = pretty_midi.note_number_to_hz(note.pitch)
+        step = int(freq * TABLE_SIZE / sr * (1 << PHASE_BITS))
+        index = (self._frames(total) * step >> PHASE_BITS) & (TABLE_SIZE - 1)
+        wave = self._table(family, note.pitch)[index]
+
+        amplitude = (note.velocity / 127.0) ** 2
+        wave *= self._envelope(attack, decay, sustain, release, held, total)
+        buffer[start:start + total] += amplitude * wave
+
+    def _add_drum(self, buffer: np.ndarray, note: pretty_midi.Note):
+        kind, length = DRUM_KINDS.get(note.pitch, ('hihat', 0.1))
+        sample = self._drum(kind, length)
+        start = int(note.start * self.sample_rate)
+        if start >= len(buffer):
+            return
+        end = min(start + len(sample), len(buffer))
+        buffer[start:end] += (note.velocity / 127.0) ** 2 * sample[:end - start]
+
+    def render(self, midi_path: str, check: Optional[Callable[[], None]] = None) -> np.ndarray:
+        """把整首 MIDI 渲染到单声道缓冲区"""
+        pm = pretty_midi.PrettyMIDI(midi_path)
+        length = int((pm.get_end_time() + self.TAIL_SECONDS) * self.sample_rate) + 1
+        buffer = np.zeros(length, dtype=np.float32)
+        for instrument in pm.instruments:
+            if check is not None:
+                check()
+            family = instrument.program // 8
+            for note in instrument.notes:
+                if instrument.is_drum:
+                    self._add_drum(buffer, note)
+                else:
+                    self._add_note(buffer, note, family)
+
+        # 与 FluidSynth 一样保持线性（分段渲染后叠加的结果与整体渲染一致），削波留给编码器
+        buffer *= self.gain * self.OUTPUT_SCALE
+        return buffer
+
+    def iter_blocks(self, midi_path: str, check: Optional[Callable[[], None]] = None) -> Iterator[np.ndarray]:
+        """以与 FluidSynth 引擎相同的接口输出 (帧数, 2) 的 float32 PCM"""
+        buffer = self.render(midi_path, check)
+        for start in range(0, len(buffer), self.BLOCK_FRAMES):
+            block = buffer[start:start + self.BLOCK_FRAMES]
+            yield np.repeat(block[:, None], 2, axis=1)
@@ -0,0 +1,266 @@
+import logging
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import and_, func, or_, select
+
+from app.music_engine.encoder import CODECS
+from app.music_engine.storage import TMP_DIR
+
+logger = logging.getLogger(__name__)
+
+# 產物的主文件擴展名：MIDI 與各種音頻格式
+PRIMARY_EXTS = sorted({'mid'} | {info['ext'] for info in CODECS.values()})
+
+# 與主文件同名的旁路目錄與文件（波形峰值、Opus 檔位另行處理）
+SIDECAR_DIRS = ('_hls', '_stems')
+SIDECAR_FILES = ('.peaks', '_stems.zip')
+
+
+def _size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(dirpath, name))
+                   for dirpath, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+
+def _remove(path: str) -> int:
+    """刪除文件或目錄，返回釋放的字節數（已不存在時為 0）"""
+    try:
+        size = _size(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def artifact_files(path: str, tiers: Iterable[str] = ()) -> List[str]:
+    """主文件及其旁路文件（峰值、Opus 檔位、HLS 分段、分軌與分軌壓縮包）"""
+    base = os.path.splitext(path)[0]
+    return ([path] + [base + suffix for suffix in SIDECAR_FILES + SIDECAR_DIRS]
+            + [f"{base}.{tier}.opus" for tier in tiers])
+
+
+def remove_artifact(path: str, tiers: Iterable[str] = ()) -> int:
+    """刪除主文件及其旁路文件，返回釋放的字節數"""
+    return sum(_remove(member) for member in artifact_files(path, tiers))
+
+
+def file_in_use(path: Optional[str], project_id: Optional[int] = None, music_id: Optional[int] = None) -> bool:
+    """除指定的項目與音樂外是否還有記錄引用 path（內容尋址的文件可能被多個項目共用）"""
+    from app import db
+    from app.models import MusicFile, Project
+
+    if not path:
+        return False
+    projects = select(Project.id).where(or_(Project.midi_path == path, Project.audio_path == path))
+    if project_id is not None:
+        projects = projects.where(Project.id != project_id)
+    music_files = select(MusicFile.id).where(MusicFile.file_path == path)
+    if music_id is not None:
+        music_files = music_files.where(MusicFile.id != music_id)
+    return db.session.execute(select(projects.exists())).scalar() \
+        or db.session.execute(select(music_files.exists())).scalar()
+
+
+def _temporary(name: str) -> bool:
+    """寫入中途留下的臨時文件或目錄（.part / .tmp，以及替換目錄時移走的 .old）；存儲的臨時目錄本身除外"""
+    return name != TMP_DIR and ('.part' in name or name.endswith(('.tmp', '.old')))
+
+
+def _group_key(name: str, is_dir: bool, tiers: Iterable[str]) -> str:
+    """文件所屬產物的主文件名（不含擴展名）"""
+    if is_dir:
+        for suffix in SIDECAR_DIRS:
+            if name.endswith(suffix):
+                return name[:-len(suffix)]
+        return name
+    if name.endswith('_stems.zip'):
+        return name[:-len('_stems.zip')]
+    base, ext = os.path.splitext(name)
+    if ext == '.opus':
+        stem, tier = os.path.splitext(base)
+        if tier[1:] in tiers:
+            return stem
+    return base
+
+
+class StorageCollector:
+    """清理生成目錄（static/generated）中不再需要的文件
+
+    - 孤兒：主文件（MIDI / 音頻）沒有被任何 Project 或 MusicFile 引用的產物，連同旁路文件刪除
+    - 臨時文件：寫入中斷留下的 .part / .tmp
+    - 保留策略：長期不活躍的項目（創建超過 retention_days 天，用戶也這麼久沒有登錄，且未公開）
+      刪除渲染出的音頻及其派生文件，保留 MIDI 與生成參數，需要時可以重新渲染
+
+    只刪除最後修改時間早於寬限期（grace_hours）的文件，正在生成、尚未寫入數據庫的產物不受影響；
+    內容尋址的文件被重新寫入時修改時間也會更新。按目錄分批處理，每批重新查詢引用並結束讀事務，
+    批次之間暫停 pause 秒，不長時間佔用數據庫或磁盤。
+    """
+
+    def __init__(self, static_dir: str, grace_hours: float = 24, retention_days: Optional[float] = None,
+                 batch_size: int = 100, pause: float = 0.0, keep: Iterable[str] = (),
+                 tiers: Iterable[str] = (), export_dir: Optional[str] = None, prefix: str = 'generated'):
+        self.static_dir = static_dir
+        self.prefix = prefix
+        self.grace_hours = grace_hours
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.pause = pause
+        self.keep = set(keep)
+        self.tiers = list(tiers)
+        self.export_dir = export_dir
+
+    @classmethod
+    def from_app(cls, app) -> 'StorageCollector':
+        return cls(app.static_folder,
+                   grace_hours=app.config.get('GC_GRACE_HOURS', 24),
+                   retention_days=app.config.get('GC_RETENTION_DAYS'),
+                   batch_size=app.config.get('GC_BATCH_SIZE', 100),
+                   pause=app.config.get('GC_BATCH_PAUSE', 0.0),
+                   keep=app.config.get('GC_KEEP', ()),
+                   tiers=app.config.get('OPUS_TIERS') or {},
+                   export_dir=app.config.get('EXPORT_CACHE_DIR'))
+
+    def run(self, dry_run: bool = False, retention: bool = True) -> Dict[str, Dict[str, int]]:
+        """執行一輪清理，返回 {類別: {'files': 文件數, 'bytes': 字節數}}；dry_run 只統計不刪除"""
+        report = {category: {'files': 0, 'bytes': 0} for category in ('orphans', 'temporary', 'retention')}
+        cutoff = time.time() - self.grace_hours * 3600
+        for directory in self._directories():
+            self._collect_directory(directory, cutoff, dry_run, report)
+        if retention and self.retention_days:
+            self._expire(dry_run, report)
+        return report
+
+    # ---- 孤兒與臨時文件 ----
+
+    def _directories(self):
+        """生成目錄及其分片子目錄（不進入旁路目錄與臨時目錄）"""
+        root = os.path.join(self.static_dir, self.prefix)
+        pending = [root]
+        while pending:
+            directory = pending.pop()
+            yield directory
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_dir() and not entry.name.endswith(SIDECAR_DIRS) and not _temporary(entry.name):
+                    pending.append(entry.path)
+
+    def _collect_directory(self, directory: str, cutoff: float, dry_run: bool, report: Dict):
+        from app import db
+
+        relative_dir = os.path.relpath(directory, self.static_dir).replace(os.sep, '/')
+        in_tmp = os.path.basename(directory) == TMP_DIR
+        groups: Dict[str, list] = {}
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if in_tmp or _temporary(entry.name):
+                if mtime < cutoff:
+                    self._delete(entry.path, 'temporary', dry_run, report)
+                continue
+            if entry.is_dir() and not entry.name.endswith(SIDECAR_DIRS):
+                continue  # 分片子目錄與臨時目錄，單獨處理
+            if entry.name in self.keep and relative_dir == self.prefix:
+                continue
+            key = f"{relative_dir}/{_group_key(entry.name, entry.is_dir(), self.tiers)}"
+            groups.setdefault(key, []).append((entry.path, mtime))
+
+        keys = sorted(groups)
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            referenced = self._referenced(batch)
+            db.session.rollback()  # 結束讀事務，不在刪除文件期間持有
+            for key in batch:
+                members = groups[key]
+                if key in referenced or max(mtime for _, mtime in members) >= cutoff:
+                    continue
+                for path, _ in members:
+                    self._delete(path, 'orphans', dry_run, report)
+            if self.pause:
+                time.sleep(self.pause)
+
+    def _referenced(self, keys: List[str]) -> Set[str]:
+        """keys 中被項目或音樂記錄引用的產物（按可能的主文件路徑查詢）"""
+        from app import db
+        from app.models import MusicFile, Project
+
+        candidates = [f"{key}.{ext}" for key in keys for ext in PRIMARY_EXTS]
+        paths = set()
+        for column in (Project.midi_path, Project.audio_path, MusicFile.file_path):
+            paths.update(db.session.execute(select(column).where(column.in_(candidates))).scalars())
+        return {os.path.splitext(path)[0] for path in paths}
+
+    def _delete(self, path: str, category: str, dry_run: bool, report: Dict):
+        try:
+            size = _size(path) if dry_run else _remove(path)
+        except FileNotFoundError:
+            return
+        report[category]['files'] += 1
+        report[category]['bytes'] += size
+        logger.debug(f"{'將刪除' if dry_run else '已刪除'} {path}（{category}）")
+
+    # ---- 保留策略 ----
+
+    def _stale(self, cutoff: datetime):
+        from app.models import Project, User
+
+        return and_(Project.created_at < cutoff, Project.is_public.isnot(True),
+                    or_(User.last_login < cutoff, and_(User.last_login.is_(None), User.created_at < cutoff)))
+
+    def _expire(self, dry_run: bool, report: Dict):
+        """刪除不活躍項目的渲染音頻（保留 MIDI 與參數），其他活躍記錄仍在使用的文件不刪除"""
+        from app import db
+        from app.models import MusicFile, Project, User
+
+        cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+        stale = self._stale(cutoff)
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                select(Project.id, Project.audio_path).join(User, User.id == Project.user_id)
+                .where(stale, Project.id > last_id, Project.audio_path.isnot(None))
+                .order_by(Project.id).limit(self.batch_size)).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            expired = []
+            for project_id, audio_path in rows:
+                audio_file = os.path.join(self.static_dir, *audio_path.split('/'))
+                if not os.path.exists(audio_file):
+                    continue
+                references = select(func.count()).select_from(Project).join(User, User.id == Project.user_id) \
+                    .where(Project.audio_path == audio_path)
+                total = db.session.execute(references).scalar()
+                inactive = db.session.execute(references.where(stale)).scalar()
+                music_files = db.session.execute(
+                    select(func.count()).where(MusicFile.file_path == audio_path)).scalar()
+                if total == inactive and not music_files:
+                    expired.append((project_id, audio_file))
+            db.session.rollback()
+
+            for project_id, audio_file in expired:
+                for member in artifact_files(audio_file, self.tiers):
+                    if os.path.exists(member):
+                        self._delete(member, 'retention', dry_run, report)
+                if self.export_dir:
+                    export_dir = os.path.join(self.export_dir, str(project_id))
+                    if os.path.exists(export_dir):
+                        self._delete(export_dir, 'retention', dry_run, report)
+            if self.pause:
+                time.sleep(self.pause)
@@ -0,0 +1,121 @@
+import heapq
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 任務通道，排在前面的通道在得分相同時優先
+LANES = ('preview', 'premium', 'standard', 'batch')
+
+
+class Scheduler:
+    """決定工作者下一個從哪個通道領取任務
+
+    通道：preview（交互式試聽）、premium（付費用戶）、standard（免費用戶）、batch（系統與批量任務）。
+    各通道按權重分享處理能力（加權公平分享）：統計最近 window 秒內各通道開始執行的任務成本，
+    加上下一個任務的成本（按通道內等待任務的平均成本估計）後除以權重，越小越優先，
+    相當於加權公平隊列的虛擬完成時間；最早的任務每等待一秒，得分再減去 aging（老化），
+    低權重通道的任務等待足夠久後總會被領取，不會餓死。通道內按先進先出。
+
+    任務成本按時長與風格估算，單位為「標準渲染秒數」（一秒 pop 風格的完整音頻）；
+    試聽只渲染前 preview_seconds 秒，且採樣率和碼率較低。
+
+    本類只包含策略，不訪問數據庫：JobRunner 領取任務時用它排序通道，
+    `flask jobs simulate` 用它做離散事件模擬。
+    """
+
+    def __init__(self):
+        self.weights: Dict[str, float] = {'preview': 8, 'premium': 4, 'standard': 2, 'batch': 1}
+        self.window = 600.0
+        self.aging = 1.0
+        self.style_costs: Dict[str, float] = {}
+        self.preview_cost = 0.5
+        self.preview_seconds = 30.0
+
+    def init_app(self, app):
+        self.weights = app.config.get('JOB_LANE_WEIGHTS', self.weights)
+        self.window = app.config.get('JOB_LANE_WINDOW', self.window)
+        self.aging = app.config.get('JOB_AGING', self.aging)
+        self.style_costs = app.config.get('JOB_STYLE_COST', self.style_costs)
+        self.preview_cost = app.config.get('JOB_PREVIEW_COST', self.preview_cost)
+        self.preview_seconds = app.config.get('PREVIEW_SECONDS', self.preview_seconds)
+
+    def estimate_cost(self, params: Dict) -> float:
+        """按請求的時長與風格估算任務成本"""
+        seconds = float(params.get('duration') or 0)
+        if params.get('preview'):
+            seconds = min(seconds, self.preview_seconds) * self.preview_cost
+        style = str(params.get('style', 'pop')).strip().lower()
+        return seconds * self.style_costs.get(style, 1.0)
+
+    @staticmethod
+    def lane_for(params: Dict, has_user: bool = False, role: Optional[str] = None) -> str:
+        """任務所屬的通道：試聽 > 付費用戶 > 普通用戶；沒有用戶的任務歸入 batch
+
+        role 為空的用戶（舊賬號未設置角色）按普通用戶處理
+        """
+        if params.get('preview'):
+            return 'preview'
+        if not has_user:
+            return 'batch'
+        if role in ('premium', 'admin'):
+            return 'premium'
+        return 'standard'
+
+    def score(self, lane: str, waited: float, usage: float, next_cost: float) -> float:
+        return (usage + next_cost) / self.weights.get(lane, 1) - self.aging * waited
+
+    def rank(self, waiting: Dict[str, float], usage: Dict[str, float],
+             next_cost: Dict[str, float]) -> List[str]:
+        """按得分排序有任務等待的通道
+
+        waiting 為 {通道: 最早的任務已等待的秒數}，usage 為 {通道: 時間窗口內開始的任務成本}，
+        next_cost 為 {通道: 等待任務的平均成本}
+        """
+        lanes = [lane for lane in LANES if lane in waiting] + sorted(set(waiting) - set(LANES))
+        return sorted(lanes, key=lambda lane: self.score(lane, waiting[lane], usage.get(lane, 0.0),
+                                                          next_cost.get(lane, 0.0)))
+
+
+def simulate(scheduler: Optional[Scheduler], jobs: Iterable[Tuple[float, str, float]], workers: int,
+             speed: float = 1.0) -> Dict[str, List[float]]:
+    """離散事件模擬：jobs 為 [(到達時間, 通道, 成本)]，每個工作者每秒處理 speed 個成本單位
+
+    scheduler 為 None 時按到達順序處理（單一先進先出隊列），用作對照。
+    返回 {通道: [各任務的等待秒數]}
+    """
+    jobs = sorted(jobs)
+    pending: Dict[str, deque] = {}
+    pending_cost: Dict[str, float] = {}
+    started = deque()  # 時間窗口內開始的任務 (開始時間, 通道, 成本)
+    usage: Dict[str, float] = {}
+    waits: Dict[str, List[float]] = {}
+    free = [0.0] * workers
+    index = 0
+
+    while index < len(jobs) or any(pending.values()):
+        now = heapq.heappop(free)
+        if not any(pending.values()):
+            now = max(now, jobs[index][0])
+        while index < len(jobs) and jobs[index][0] <= now:
+            arrival, lane, cost = jobs[index]
+            pending.setdefault(lane, deque()).append((arrival, cost))
+            pending_cost[lane] = pending_cost.get(lane, 0.0) + cost
+            index += 1
+
+        if scheduler is None:
+            lane = min((queue[0][0], lane) for lane, queue in pending.items() if queue)[1]
+        else:
+            while started and started[0][0] < now - scheduler.window:
+                _, old_lane, old_cost = started.popleft()
+                usage[old_lane] -= old_cost
+            waiting = {lane: now - queue[0][0] for lane, queue in pending.items() if queue}
+            next_cost = {lane: pending_cost[lane] / len(pending[lane]) for lane in waiting}
+            lane = scheduler.rank(waiting, usage, next_cost)[0]
+
+        arrival, cost = pending[lane].popleft()
+        pending_cost[lane] -= cost
+        waits.setdefault(lane, []).append(now - arrival)
+        if scheduler is not None:
+            started.append((now, lane, cost))
+            usage[lane] = usage.get(lane, 0.0) + cost
+        heapq.heappush(free, now + cost / speed)
+    return waits
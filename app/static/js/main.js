@@ -75,6 +75,146 @@ function createMusic(mode) {
         form.insertBefore(alertDiv, form.firstChild);
     }
 
+    // 轮询生成任务状态，完成后跳转到项目页面
+    function pollJob(statusUrl) {
+        fetch(statusUrl, {
+            headers: {
+                'Accept': 'application/json',
+                'X-Requested-With': 'XMLHttpRequest'
+            }
+        })
+        .then(response => response.json())
+        .then(data => {
+            const job = data.job;
+            if (!job) {
+                throw new Error(data.message || '无法获取任务状态');
+            }
+            if (job.stream_url) {
+                attachStream(job.stream_url);
+            }
+            if (job.status === 'done') {
+                openProject(job);
+            } else if (job.status === 'dead') {
+                submitBtn.innerHTML = originalText;
+                submitBtn.disabled = false;
+                showError(job.error || '生成音乐时发生错误');
+            } else {
+                setTimeout(() => pollJob(statusUrl), 1500);
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            submitBtn.innerHTML = originalText;
+            submitBtn.disabled = false;
+            showError(error.message || '生成音乐时发生错误');
+        });
+    }
+
+    // 进度阶段在按钮上的显示文字
+    function progressLabel(event) {
+        const labels = {
+            parsing: 'Preparing...',
+            midi: 'Composing',
+            rendering: 'Rendering',
+            encoding: 'Encoding...'
+        };
+        let label = labels[event.stage] || 'Generating...';
+        if (event.stage === 'midi' && event.total) {
+            label += ` ${event.bars}/${event.total}`;
+        } else if (event.percent !== undefined && event.stage !== 'encoding') {
+            label += ` ${event.percent}%`;
+        }
+        return '<i class="fas fa-spinner fa-spin"></i> ' + label;
+    }
+
+    // 渲染期间边生成边播放：收到分段播放列表地址后在表单下方插入播放器
+    // （Safari 原生支持 HLS，其他浏览器按需加载 hls.js）
+    function attachStream(url) {
+        if (document.getElementById('streamPlayer')) {
+            return;
+        }
+        const audio = document.createElement('audio');
+        audio.id = 'streamPlayer';
+        audio.className = 'w-100 mt-3';
+        audio.controls = true;
+        form.appendChild(audio);
+        if (audio.canPlayType('application/vnd.apple.mpegurl')) {
+            audio.src = url;
+            return;
+        }
+        const start = () => {
+            if (window.Hls && Hls.isSupported()) {
+                const hls = new Hls();
+                hls.loadSource(url);
+                hls.attachMedia(audio);
+            } else {
+                audio.remove();
+            }
+        };
+        if (window.Hls) {
+            start();
+        } else {
+            const script = document.createElement('script');
+            script.src = 'https://cdn.jsdelivr.net/npm/hls.js@1';
+            script.onload = start;
+            script.onerror = () => audio.remove();
+            document.head.appendChild(script);
+        }
+    }
+
+    // 任务完成：正在试听渲染中的音频时不打断播放，改为显示项目链接
+    function openProject(job) {
+        const url = job.project_url || `/project/${job.project_id}`;
+        const player = document.getElementById('streamPlayer');
+        if (player && !player.paused) {
+            submitBtn.innerHTML = originalText;
+            submitBtn.disabled = false;
+            const link = document.createElement('a');
+            link.href = url;
+            link.className = 'btn btn-sm btn-outline-primary mt-2';
+            link.textContent = 'Open project';
+            form.appendChild(link);
+            return;
+        }
+        window.location.href = url;
+    }
+
+    // 通过 SSE 接收任务进度；浏览器不支持或连接失败时改为轮询
+    function followJob(eventsUrl, statusUrl) {
+        if (!window.EventSource || !eventsUrl) {
+            pollJob(statusUrl);
+            return;
+        }
+        const source = new EventSource(eventsUrl);
+        source.addEventListener('progress', event => {
+            const progress = JSON.parse(event.data);
+            if (progress.stage === 'output') {
+                if (progress.stream_url) {
+                    attachStream(progress.stream_url);
+                }
+                return;
+            }
+            submitBtn.innerHTML = progressLabel(progress);
+        });
+        source.addEventListener('done', event => {
+            source.close();
+            openProject(JSON.parse(event.data));
+        });
+        source.addEventListener('dead', event => {
+            source.close();
+            const job = JSON.parse(event.data);
+            submitBtn.innerHTML = originalText;
+            submitBtn.disabled = false;
+            showError(job.error || '生成音乐时发生错误');
+        });
+        source.onerror = () => {
+            // 连接无法建立时（而非正常重连中）改用轮询
+            if (source.readyState === EventSource.CLOSED) {
+                pollJob(statusUrl);
+            }
+        };
+    }
+
     // 发送请求
     fetch('/create_music', {
         method: 'POST',
@@ -100,6 +240,13 @@ function createMusic(mode) {
     .then(data => {
         if (!data) return; // 如果是重定向，data 将是 undefined
         
+        // 任务已排队：保持按钮禁用，轮询任务状态直到完成
+        if (data.status === 'queued') {
+            submitBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Generating...';
+            followJob(data.events_url, data.status_url);
+            return;
+        }
+        
         // 恢复按钮状态
         submitBtn.innerHTML = originalText;
         submitBtn.disabled = false;
@@ -42,6 +42,108 @@ class Config:
     MIN_TEMPO = 60      # 最小速度（BPM）
     MAX_TEMPO = 240     # 最大速度（BPM）
     
+    # 渲染池配置
+    RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 2))        # 常駐渲染線程數
+    RENDER_QUEUE_SIZE = int(os.environ.get('RENDER_QUEUE_SIZE', 32)) # 等待隊列上限
+    RENDER_TIMEOUT = 300                                             # 單個渲染任務超時（秒）
+    
+    # 後台任務隊列（持久化在數據庫中，/create_music 與 /generate_music 只登記任務）
+    # Web 進程內的工作線程數；另用 `flask jobs work` 啟動工作進程時可設為 0
+    GENERATION_WORKERS = int(os.environ.get('GENERATION_WORKERS', 2))
+    JOB_VISIBILITY_TIMEOUT = 120  # 任務租約（秒），執行中每三分之一租約續約一次
+    JOB_MAX_ATTEMPTS = 3          # 超過次數後轉為死信
+    JOB_RETRY_BACKOFF = 5         # 重試退避基數（秒），每次翻倍
+    JOB_RETRY_BACKOFF_MAX = 300
+    JOB_POLL_INTERVAL = 0.5       # 隊列為空時的輪詢間隔（秒）
+    JOB_EVENTS_POLL_INTERVAL = 1.0  # 進度推送（SSE）讀取其他進程任務狀態的間隔（秒）
+    JOB_EVENTS_KEEPALIVE = 15       # SSE 連接空閒時發送保活註釋的間隔（秒）
+    # 合併相同的生成請求：參數與種子相同、且已有同樣的任務在排隊或執行時，只生成一次，
+    # 其餘請求等它完成後直接使用其輸出文件（按內容尋址的同一路徑，不複製）
+    COALESCE_GENERATIONS = True
+    # 調度通道：preview（試聽）、premium（付費用戶）、standard（免費用戶）、batch（系統任務）。
+    # 各通道按權重分享處理能力，用量按最近 JOB_LANE_WINDOW 秒內開始的任務成本統計；
+    # 最早的任務每等待一秒抵消 JOB_AGING 的用量，低權重通道不會一直等待
+    JOB_LANE_WEIGHTS = {'preview': 8, 'premium': 4, 'standard': 2, 'batch': 1}
+    JOB_LANE_WINDOW = 600
+    JOB_AGING = 1.0
+    # 任務成本估算（標準渲染秒數）= 時長 x 風格係數；試聽只計前 PREVIEW_SECONDS 秒，再乘 JOB_PREVIEW_COST
+    JOB_STYLE_COST = {'classical': 0.8, 'pop': 1.0, 'jazz': 1.1, 'electronic': 1.2, 'rock': 1.3}
+    JOB_PREVIEW_COST = 0.5
+    
+    # 生成文件清理（flask storage gc）：刪除沒有項目引用的文件與寫入中斷留下的臨時文件，
+    # 只處理修改時間早於寬限期的文件；創建超過 GC_RETENTION_DAYS 天、用戶也這麼久沒有登錄的
+    # 非公開項目刪除渲染音頻，保留 MIDI 與參數（None 表示不啟用保留策略）
+    GC_GRACE_HOURS = 24
+    GC_RETENTION_DAYS = 180
+    GC_BATCH_SIZE = 100
+    GC_BATCH_PAUSE = 0.05  # 批次之間的暫停（秒）
+    GC_KEEP = ['default_audio.mp3']  # 生成目錄中始終保留的文件
+    # 被清理的文件在訪問時登記 restore 任務（batch 通道）重新生成，完成前文件地址返回 202 或 503，
+    # 並以 Retry-After（秒）提示客戶端稍後重試
+    RESTORE_RETRY_AFTER = 5
+    
+    # 音頻編碼配置（mp3 / opus / ogg / flac / wav，需要 ffmpeg）
+    AUDIO_SAMPLE_RATE = 44100
+    SYNTH_GAIN = 0.5
+    # 合成後端：auto 在 FluidSynth 不可用時自動改用波表合成器，wavetable 強制使用波表合成器
+    SYNTH_BACKEND = os.environ.get('SYNTH_BACKEND', 'auto')
+    AUDIO_CODEC = os.environ.get('AUDIO_CODEC', 'mp3')
+    AUDIO_BITRATE = os.environ.get('AUDIO_BITRATE', '192k')
+    
+    # 渲染模式：single 一次合成整首；tracks 各音軌在獨立進程中合成後混音，並保留分軌
+    RENDER_MODE = os.environ.get('RENDER_MODE', 'single')
+    TRACK_RENDER_PROCESSES = int(os.environ.get('TRACK_RENDER_PROCESSES', 0)) or None  # 默認按 CPU 數（最多 4）
+    TRACK_MIX = {}        # 覆蓋各音軌的增益與聲像，例如 {'chords': {'gain': 0.7, 'pan': -0.3}}
+    STEM_CODEC = 'flac'   # 分軌文件格式
+    
+    # 循環感知渲染：重複的小節只合成一次再疊加
+    LOOP_RENDER = True
+    LOOP_RENDER_TOLERANCE = 0.005  # 判定音符相同的時間容差（秒）
+    
+    # 母帶處理：按 BS.1770 響度流式歸一化（前視延遲線），並用前視限制器控制真峰值
+    MASTERING = True
+    TARGET_LUFS = -14.0            # 目標整體響度
+    TRUE_PEAK_CEILING_DB = -1.0    # 真峰值上限（dBTP）
+    MASTERING_LOOKAHEAD = 3.0      # 響度歸一化的前視長度（秒），輸出比合成延遲這麼久
+    
+    # 鼓點小節緩存：渲染線程啟動時預熱常用的（風格、情緒、速度）組合
+    DRUM_CACHE_MAX_BYTES = 256 * 1024 ** 2
+    DRUM_WARMUP = [
+        {'style': 'pop', 'mood': 'happy', 'tempo': 120},
+        {'style': 'rock', 'mood': 'energetic', 'tempo': 120},
+        {'style': 'electronic', 'mood': 'energetic', 'tempo': 120},
+        {'style': 'jazz', 'mood': 'romantic', 'tempo': 120},
+    ]
+    
+    # 在線播放用的 Opus 碼率檔位（與完整音頻一起編碼，按客戶端選擇），例如 {'low': '48k', 'high': '96k'}
+    # 每個檔位都要多編碼一遍，單核上每檔約增加 8 秒 / 5 分鐘音頻，默認不生成；
+    # 未生成檔位時 Opus 導出按需轉碼並緩存（見 EXPORT_CACHE_DIR）
+    OPUS_TIERS = {}
+    
+    # 分段輸出（HLS）：完整音頻同時切成固定時長的 MP3 段並生成播放列表，邊渲染邊播放、拖動時只下載需要的段
+    SEGMENTED_OUTPUT = True
+    SEGMENT_SECONDS = 6
+    SEGMENT_BITRATE = '128k'
+    SEGMENT_MIN_DURATION = 60     # 短於此時長（秒）的音頻仍直接播放整個文件
+    
+    # 快速試聽配置（只渲染開頭一段，單聲道、低採樣率、低碼率）
+    PREVIEW_SECONDS = 30
+    PREVIEW_SAMPLE_RATE = 22050  # 須為 AUDIO_SAMPLE_RATE 的整數分之一（整數倍降採樣）
+    PREVIEW_CODEC = 'mp3'
+    PREVIEW_BITRATE = '48k'
+    
+    # 精簡音色庫（flask soundfont subset 生成，只含生成器用到的音色），存在時合成器優先加載
+    SOUNDFONT_SUBSET = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'app', 'static', 'soundfonts', 'generator_subset.sf2')
+    
+    # 導出緩存（導出 WAV/OGG/FLAC 等格式時轉碼的結果，按項目存放，LRU 淘汰）
+    EXPORT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'exports')
+    EXPORT_CACHE_MAX_BYTES = 2 * 1024 ** 3  # 2GB
+    
+    # 文件名即內容摘要的生成文件（static/generated/xx/yy/midi_<摘要>.mid 等）的瀏覽器緩存時間，
+    # 路徑隨內容改變，標記為 immutable；按渲染輸入尋址的音頻及其派生文件不長期緩存，每次按 ETag 重新驗證
+    IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+    
     # 和弦配置
     CHORD_TYPES = {
         'maj': '大三和弦',
@@ -125,6 +227,22 @@ class Config:
     RATELIMIT_DEFAULT = "100/hour"
     RATELIMIT_STORAGE_URL = "memory://"
     
+    # 生成準入控制：按角色限制生成消耗，權重為任務的估計成本（標準渲染秒數，見 JOB_STYLE_COST）
+    #   rate / burst：令牌桶每秒補充的秒數與桶容量
+    #   concurrent_jobs / concurrent_seconds：排隊和執行中的任務數與總成本上限
+    # ADMISSION_LIMITS 對每個用戶單獨計算（超出返回 429），ADMISSION_ROLE_LIMITS 由
+    # 同一角色的所有用戶共用（超出返回 503）；未列出的角色（admin）不受限制
+    ADMISSION_CONTROL = True
+    ADMISSION_LIMITS = {
+        'user': {'rate': 0.5, 'burst': 600, 'concurrent_jobs': 2, 'concurrent_seconds': 600},
+        'premium': {'rate': 2.0, 'burst': 1800, 'concurrent_jobs': 4, 'concurrent_seconds': 1800},
+    }
+    ADMISSION_ROLE_LIMITS = {
+        'user': {'concurrent_seconds': 3600},
+        'premium': {'concurrent_seconds': 7200},
+    }
+    ADMISSION_BUSY_RETRY_AFTER = 15  # 並發已滿時建議客戶端等待的秒數
+    
     # 安全配置
     SESSION_COOKIE_SECURE = True
     REMEMBER_COOKIE_SECURE = True
@@ -0,0 +1,28 @@
+"""Add generation job lanes
+
+Revision ID: 0a6c9e4d7b21
+Revises: f1b7d3e05a92
+Create Date: 2026-10-19 20:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0a6c9e4d7b21'
+down_revision = 'f1b7d3e05a92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('lane', sa.String(length=16), nullable=False, server_default='standard'))
+        batch_op.create_index(batch_op.f('ix_generation_job_started_at'), ['started_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_generation_job_started_at'))
+        batch_op.drop_column('lane')
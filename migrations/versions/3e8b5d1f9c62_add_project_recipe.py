@@ -0,0 +1,26 @@
+"""Add project recipe
+
+Revision ID: 3e8b5d1f9c62
+Revises: 0a6c9e4d7b21
+Create Date: 2026-10-19 21:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e8b5d1f9c62'
+down_revision = '0a6c9e4d7b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('project', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('recipe', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('project', schema=None) as batch_op:
+        batch_op.drop_column('recipe')
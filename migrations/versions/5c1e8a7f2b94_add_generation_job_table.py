@@ -0,0 +1,44 @@
+"""Add generation job table
+
+Revision ID: 5c1e8a7f2b94
+Revises: 461cae368e2a
+Create Date: 2026-10-19 11:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e8a7f2b94'
+down_revision = '461cae368e2a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('generation_job',
+    sa.Column('id', sa.String(length=32), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('params', sa.Text(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_generation_job_status'), ['status'], unique=False)
+        batch_op.create_index(batch_op.f('ix_generation_job_user_id'), ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_generation_job_user_id'))
+        batch_op.drop_index(batch_op.f('ix_generation_job_status'))
+
+    op.drop_table('generation_job')
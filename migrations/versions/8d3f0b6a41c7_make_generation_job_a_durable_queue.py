@@ -0,0 +1,48 @@
+"""Make generation job a durable queue
+
+Revision ID: 8d3f0b6a41c7
+Revises: 5c1e8a7f2b94
+Create Date: 2026-10-19 14:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f0b6a41c7'
+down_revision = '5c1e8a7f2b94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('kind', sa.String(length=32), nullable=False, server_default='generate'))
+        batch_op.add_column(sa.Column('result', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('max_attempts', sa.Integer(), nullable=False, server_default='3'))
+        batch_op.add_column(sa.Column('available_at', sa.DateTime(), nullable=False,
+                                      server_default=sa.func.current_timestamp()))
+        batch_op.add_column(sa.Column('locked_by', sa.String(length=128), nullable=True))
+        batch_op.add_column(sa.Column('locked_until', sa.DateTime(), nullable=True))
+        batch_op.alter_column('user_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.create_index('ix_generation_job_claim', ['status', 'available_at'], unique=False)
+
+    # 舊的 failed 狀態對應新的死信狀態
+    op.execute("UPDATE generation_job SET status = 'dead' WHERE status = 'failed'")
+
+
+def downgrade():
+    op.execute("UPDATE generation_job SET status = 'failed' WHERE status = 'dead'")
+
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.drop_index('ix_generation_job_claim')
+        batch_op.alter_column('user_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.drop_column('locked_until')
+        batch_op.drop_column('locked_by')
+        batch_op.drop_column('available_at')
+        batch_op.drop_column('max_attempts')
+        batch_op.drop_column('attempts')
+        batch_op.drop_column('result')
+        batch_op.drop_column('kind')
@@ -0,0 +1,26 @@
+"""Add generation job progress
+
+Revision ID: b27e94c0d5a3
+Revises: 8d3f0b6a41c7
+Create Date: 2026-10-19 16:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b27e94c0d5a3'
+down_revision = '8d3f0b6a41c7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('progress', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.drop_column('progress')
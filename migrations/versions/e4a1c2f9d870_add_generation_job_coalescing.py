@@ -0,0 +1,34 @@
+"""Add generation job coalescing
+
+Revision ID: e4a1c2f9d870
+Revises: b27e94c0d5a3
+Create Date: 2026-10-19 19:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a1c2f9d870'
+down_revision = 'b27e94c0d5a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('dedupe_key', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('leader_id', sa.String(length=32), nullable=True))
+        batch_op.create_unique_constraint('uq_generation_job_dedupe_key', ['dedupe_key'])
+        batch_op.create_index(batch_op.f('ix_generation_job_leader_id'), ['leader_id'], unique=False)
+        batch_op.create_foreign_key('fk_generation_job_leader_id', 'generation_job', ['leader_id'], ['id'])
+
+
+def downgrade():
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_generation_job_leader_id', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_generation_job_leader_id'))
+        batch_op.drop_constraint('uq_generation_job_dedupe_key', type_='unique')
+        batch_op.drop_column('leader_id')
+        batch_op.drop_column('dedupe_key')
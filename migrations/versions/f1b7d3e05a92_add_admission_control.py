@@ -0,0 +1,33 @@
+"""Add admission control
+
+Revision ID: f1b7d3e05a92
+Revises: e4a1c2f9d870
+Create Date: 2026-10-19 20:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b7d3e05a92'
+down_revision = 'e4a1c2f9d870'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rate_bucket',
+    sa.Column('key', sa.String(length=64), nullable=False),
+    sa.Column('tokens', sa.Float(), nullable=False),
+    sa.Column('updated_at', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('cost', sa.Float(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('generation_job', schema=None) as batch_op:
+        batch_op.drop_column('cost')
+    op.drop_table('rate_bucket')